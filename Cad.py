@@ -22,16 +22,13 @@
 # Import the PyQt and QGIS libraries
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
-from qgis.core import *
-from qgis.gui import *
 
-import resources_rc
+import os
 
-from CadInputWidget import CadInputWidget
-from CadEventFilter import CadEventFilter
-from CadPaintWidget import CadPaintWidget
-from CadPointList import CadPointList
-from CadHelp import CadHelp
+# Only the actions are created when QGIS starts. The widgets, the event filter (and their modules,
+# including the compiled resources) are only loaded the first time CadInput is enabled.
+
+RESOURCES_DIR = os.path.join(os.path.dirname(__file__), "resources")
 
 
 class Cad(QObject):
@@ -39,10 +36,43 @@ class Cad(QObject):
     def __init__(self, iface):
         QObject.__init__(self)
         self.iface = iface
+        self.inputWidget = None # None until CadInput is enabled for the first time
 
     def initGui(self):
+        # Create help action 
+        self.helpAction = QAction( QIcon(os.path.join(RESOURCES_DIR, "about.png")), u"Help", self.iface.mainWindow())
+        self.helpAction.triggered.connect( self.doHelpAction )
+
+        # Create enable action (it is then shared with the CadinputWidget)
+        self.enableAction = QAction( QIcon(os.path.join(RESOURCES_DIR, "icon.png")), u"Enable CAD input", self.iface.mainWindow())
+        self.enableAction.setCheckable(True)
+        self.enableAction.toggled.connect( self.enableToggled )
+
+        # Create traverse import action
+        self.traverseAction = QAction( u"Import a traverse...", self.iface.mainWindow())
+        self.traverseAction.triggered.connect( self.doTraverseAction )
+
+        # Add menu and toolbars items
+        self.iface.addPluginToMenu(u"&CadInput", self.helpAction)
+        self.iface.addPluginToMenu(u"&CadInput", self.enableAction)
+        self.iface.addPluginToMenu(u"&CadInput", self.traverseAction)
+        self.iface.addToolBarIcon(self.enableAction)
+
+    def enableToggled(self, checked):
+        if checked and self.inputWidget is None:
+            self.load()
+
+    def load(self):
+        """
+        Creates CadInput's widgets and event filter
+        """
+        from CadInputWidget import CadInputWidget
+        from CadEventFilter import CadEventFilter
+        from CadPaintWidget import CadPaintWidget
+        from CadPointList import CadPointList
+
         # CadinputWidget : this widget displays the inputs allowing numerical entry
-        self.inputWidget = CadInputWidget(self.iface)
+        self.inputWidget = CadInputWidget(self.iface, self.enableAction)
 
         # CadPointList : this stores all the points
         self.cadPointList = CadPointList(self.inputWidget)
@@ -51,50 +81,89 @@ class Cad(QObject):
         self.paintWidget = CadPaintWidget(self.iface.mapCanvas(), self.inputWidget, self.cadPointList)
 
         # CadEventFilter : this widget will filter the mouseEvents and constrain them if needed
+        # (it installs itself on the canvas while an edit map tool is set)
         self.eventFilter = CadEventFilter(self.iface, self.cadPointList, self.inputWidget, self.paintWidget)
 
-
-        #We need the canvas's viewport to track the mouse for mouseMoveEvents to happen
-        self.iface.mapCanvas().viewport().setMouseTracking(True)
-
-        #We install the eventFilter on the canvas's viewport to get the mouse events
-        self.iface.mapCanvas().viewport().installEventFilter( self.eventFilter )
-
-        #we install the eventFilter on the canvas itself to get the key events
-        self.iface.mapCanvas().installEventFilter( self.eventFilter )
-
-
-        # Create help action 
-        self.helpAction = QAction( QIcon(":/plugins/cadinput/resources/about.png"), u"Help", self.iface.mainWindow())
-        self.helpAction.triggered.connect( self.doHelpAction )
-
-        # Create enable action 
-        self.enableAction = self.inputWidget.enableAction
-
-        # Add menu and toolbars items
-        self.iface.addPluginToMenu(u"&CadInput", self.helpAction)
-        self.iface.addPluginToMenu(u"&CadInput", self.enableAction)
-        self.iface.addToolBarIcon(self.enableAction)
+        # the action was toggled before the widget listened to it
+        self.inputWidget.syncConstraints()
 
 
     def unload(self):
-        # unload event filter
-        self.eventFilter.close()
-        self.iface.mapCanvas().viewport().removeEventFilter( self.eventFilter )
-        self.iface.mapCanvas().removeEventFilter( self.eventFilter )
+        if self.inputWidget is not None:
+            # unload event filter (this removes it from the canvas)
+            self.eventFilter.close()
 
-        # unload input widget
-        self.inputWidget.close()
-        self.inputWidget.deleteLater()
+            # unload input widget
+            self.inputWidget.close()
+            self.inputWidget.deleteLater()
 
-        # unload paint widget (map canvas item)
-        self.paintWidget.close()
-        self.iface.mapCanvas().scene().removeItem(self.paintWidget)
+            # unload paint widget (map canvas item)
+            self.paintWidget.close()
+            self.iface.mapCanvas().scene().removeItem(self.paintWidget)
 
         #and remove the item menu
         self.iface.removePluginMenu(u"&CadInput", self.helpAction)
         self.iface.removePluginMenu(u"&CadInput", self.enableAction)
+        self.iface.removePluginMenu(u"&CadInput", self.traverseAction)
         self.iface.removeToolBarIcon(self.enableAction)
 
     def doHelpAction(self):
+        from CadHelp import CadHelp
         self.aboutWindow = CadHelp()
+
+    def doTraverseAction(self):
+        """
+        Reads a traverse file (see CadTraverse.parseTraverse), adjusts its closure and adds it to the active layer as one feature
+        """
+        from qgis.core import QgsMessageLog, QgsMapLayer, QgsFeature, QgsGeometry, QgsPoint, QGis
+        from CadTraverse import CadTraverse, parseTraverse, ADJUSTMENTS, BOWDITCH, TRANSIT
+
+        title = u"Import a traverse"
+        mainWindow = self.iface.mainWindow()
+        layer = self.iface.activeLayer()
+        if layer is None or layer.type() != QgsMapLayer.VectorLayer or layer.geometryType() not in (QGis.Line, QGis.Polygon) or not layer.isEditable():
+            QMessageBox.warning(mainWindow, title, u"The active layer must be a line or polygon layer in edit mode.")
+            return
+
+        path = QFileDialog.getOpenFileName(mainWindow, title, QSettings().value("CadInput/traverseDir", ""), u"Traverses (*.txt);;All files (*)")
+        if not path:
+            return
+        QSettings().setValue("CadInput/traverseDir", os.path.dirname(path))
+        adjustment, ok = QInputDialog.getItem(mainWindow, title, u"Closure adjustment :", ADJUSTMENTS, 0, False)
+        if not ok:
+            return
+
+        try:
+            with open(path) as traverseFile:
+                traverse = CadTraverse( parseTraverse(traverseFile) )
+        except (IOError, ValueError) as e:
+            QMessageBox.warning(mainWindow, title, u"Could not read %s :\n%s" % (path, e))
+            return
+
+        # the coordinates are map coordinates, as the ones typed in the CadInput fields
+        xs, ys = traverse.vertices(adjustment)
+        renderer = self.iface.mapCanvas().mapRenderer()
+        points = [renderer.mapToLayerCoordinates(layer, QgsPoint(float(x), float(y))) for x, y in zip(xs, ys)]
+        if traverse.end == traverse.start and adjustment in (BOWDITCH, TRANSIT):
+            # the traverse ends on its start point (close), the adjusted last vertex is the start point up to the rounding errors
+            points[-1] = points[0]
+        elif layer.geometryType() == QGis.Polygon:
+            points.append(points[0])
+        if layer.geometryType() == QGis.Polygon:
+            geometry = QgsGeometry.fromPolygon([points])
+        else:
+            geometry = QgsGeometry.fromPolyline(points)
+
+        feature = QgsFeature(layer.pendingFields())
+        feature.setGeometry(geometry)
+        layer.beginEditCommand(title)
+        if not layer.addFeature(feature):
+            layer.destroyEditCommand()
+            QMessageBox.warning(mainWindow, title, u"The traverse could not be added to %s." % layer.name())
+            return
+        layer.endEditCommand()
+        self.iface.mapCanvas().refresh()
+
+        report = traverse.report(adjustment)
+        QgsMessageLog.logMessage(u"CadInput : traverse %s\n%s" % (path, report))
+        QMessageBox.information(mainWindow, title, report)
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Runs CadInput's constraints without QGIS : python CadConstraintEngine.py commands.txt [--format wkt|geojson] [--output out]
+ (see CadConstraintEngine.run for the format of the commands)
+"""
+
+from CadConstraints import CadConstraints
+from CadExpression import CadExpression
+
+import argparse
+import json
+import math
+import re
+import sys
+
+
+def projectOnDirection(x, y, ox, oy, cosA, sinA):
+    """
+    Returns the projection of x, y on the line going through ox, oy with the direction cosA, sinA
+    """
+    vP = cosA*(x-ox) + sinA*(y-oy)
+    return ox+cosA*vP, oy+sinA*vP
+
+def pointAtDistance(x, y, ox, oy, d):
+    """
+    Returns the point at distance d of ox, oy towards x, y (eastwards if they're the same point)
+    """
+    dx, dy = x-ox, y-oy
+    dist = math.sqrt(dx*dx + dy*dy)
+    if dist == 0:
+        # take arbitrary horizontal line
+        return ox+d, oy
+    vP = d / dist
+    return ox+dx*vP, oy+dy*vP
+
+def bearingToAngle(text):
+    """
+    Returns the CadInput angle (degrees, counterclockwise from the x axis) of a quadrant bearing
+    such as N45E, S12.5W or N45-30-15E (degrees-minutes-seconds), or None if the text is not a bearing
+    """
+    match = BEARING.match(text.strip().upper())
+    if match is None:
+        return None
+    ns, degrees, minutes, seconds, ew = match.groups()
+    value = float(degrees) + float(minutes or 0) / 60.0 + float(seconds or 0) / 3600.0
+    if ns == 'N':
+        azimuth = value if ew == 'E' else 360.0 - value
+    else:
+        azimuth = 180.0 - value if ew == 'E' else 180.0 + value
+    return azimuthToAngle(azimuth)
+
+def azimuthToAngle(azimuth):
+    """
+    Returns the CadInput angle (degrees, counterclockwise from the x axis) of an azimuth (degrees, clockwise from north)
+    """
+    return (90.0 - azimuth) % 360.0
+
+BEARING = re.compile(r'^([NS])(\d+(?:\.\d*)?)(?:-(\d+(?:\.\d*)?)(?:-(\d+(?:\.\d*)?))?)?([EW])$')
+
+
+class CadConstraintEngine(object):
+    """
+    CadInput's constraints (x, y, angle and distance, absolute or relative) applied to plain floats, without Qt nor QGIS.
+
+    The state is a CadConstraints (as the plugin's one) and the vertices committed so far ; the cursor position
+    given to constrain plays the role of the mouse in the plugin.
+    """
+
+    def __init__(self, constraints=None):
+        self.constraints = constraints if constraints is not None else CadConstraints()
+        self.points = [] # committed vertices (x, y), the last one last
+        self.frame = None # (heading in radians, length) of the last committed segment
+        self.expressions = CadExpression()
+
+    #########################
+    # Constraints
+
+    def constrain(self, x=None, y=None):
+        """
+        Returns the point x, y constrained by the locked values, as CadInput does with the mouse position.
+        Without a position, the cursor is put one unit away from the previous vertex, along the locked angle
+        if it's locked, along the last segment otherwise.
+        """
+        c = self.constraints
+        previous = self.points[-1] if self.points else None
+        if (c.rx or c.ry or c.ra or c.la or c.ld) and previous is None:
+            # (the plugin disables them before the first vertex)
+            raise ValueError("relative values, angles and distances need a previous vertex")
+
+        if c.la:
+            a = math.radians(c.a)
+            if c.ra and self.frame is not None:
+                # the angle is relative to the last segment (0° is aligned with last segment)
+                a += self.frame[0]
+            cosA, sinA = math.cos(a), math.sin(a)
+        if x is None or y is None:
+            if previous is None:
+                x, y = 0.0, 0.0
+            elif c.la:
+                x, y = previous[0]+cosA, previous[1]+sinA
+            else:
+                heading = self.frame[0] if self.frame is not None else 0.0
+                x, y = previous[0]+math.cos(heading), previous[1]+math.sin(heading)
+
+        if c.lx:
+            x = previous[0]+c.x if c.rx else c.x
+        if c.ly:
+            y = previous[1]+c.y if c.ry else c.y
+        if c.la:
+            x, y = projectOnDirection(x, y, previous[0], previous[1], cosA, sinA)
+        if c.ld:
+            x, y = pointAtDistance(x, y, previous[0], previous[1], c.d)
+        return x, y
+
+    def addPoint(self, x=None, y=None):
+        """
+        Commits the constrained point and returns it
+        """
+        x, y = self.constrain(x, y)
+        if self.points:
+            dx, dy = x-self.points[-1][0], y-self.points[-1][1]
+            self.frame = (math.atan2(dy, dx), math.sqrt(dx*dx + dy*dy))
+        self.points.append( (x, y) )
+        self.constraints.segmentHeading = math.degrees(self.frame[0]) if self.frame is not None else 0.0
+        self.constraints.segmentLength = self.frame[1] if self.frame is not None else 0.0
+        return x, y
+
+    def finish(self):
+        """
+        Returns the committed vertices and starts a new feature
+        """
+        points, self.points, self.frame = self.points, [], None
+        self.constraints.segmentHeading = self.constraints.segmentLength = 0.0
+        return points
+
+    def unlockAll(self):
+        c = self.constraints
+        c.lx = c.ly = c.la = c.ld = False
+        c.rx = c.ry = c.ra = False
+
+    #########################
+    # Commands
+
+    def run(self, lines):
+        """
+        Yields the features (vertices, closed) described by the commands, one per line :
+
+            x=<value> y=<value>     absolute coordinates
+            rx=<value> ry=<value>   coordinates relative to the previous vertex
+            a=<value>               angle (degrees, counterclockwise from the x axis)
+            ra=<value>              angle relative to the last segment
+            az=<value>              azimuth (degrees, clockwise from north)
+            b=N45-30-15E            quadrant bearing (degrees or degrees-minutes-seconds)
+            d=<value>               distance to the previous vertex
+            at=<x>,<y>              position of the cursor (where the mouse would be)
+            close                   closes the feature (polygon) and starts a new one
+            end                     ends the feature (line) and starts a new one
+
+        A vertex is given by one or more values on a line, as typed in the CadInput fields before a click
+        (the values are locked for this vertex only). The values are expressions (see CadExpression) without spaces,
+        with x, y the previous vertex, a, d the previous values and l, h the length and heading of the last segment.
+        A coordinate can't be given with an angle or a distance on the same line (the plugin would let the latter override it).
+        Empty lines and lines starting with # are skipped. The last feature is ended at the end of the commands.
+        """
+        for number, line in enumerate(lines):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            try:
+                if words == ['close'] or words == ['end']:
+                    points = self.finish()
+                    closed = words[0] == 'close'
+                    if closed and points and points[0] != points[-1]:
+                        points.append(points[0])
+                    if points:
+                        yield points, closed
+                else:
+                    self.addPoint( *self.setValues(words) )
+            except ValueError as e:
+                raise ValueError("line %i : %s (%s)" % (number + 1, e, line.strip()))
+        points = self.finish()
+        if points:
+            yield points, False
+
+    def setValues(self, words):
+        """
+        Locks the values of a vertex line, returns the position of the cursor (or None, None)
+        """
+        c = self.constraints
+        self.unlockAll()
+        previous = self.points[-1] if self.points else (0.0, 0.0)
+        variables = {'x': previous[0], 'y': previous[1], 'a': c.a, 'd': c.d, 'l': c.segmentLength, 'h': c.segmentHeading}
+        cursor = (None, None)
+        for word in words:
+            key, sep, text = word.partition('=')
+            if not sep:
+                raise ValueError("expected key=value, got %s" % word)
+            if key == 'at':
+                cursor = tuple( self.evaluate(value, variables) for value in text.split(',') )
+                if len(cursor) != 2:
+                    raise ValueError("expected at=<x>,<y>")
+            elif key == 'b':
+                value = bearingToAngle(text)
+                if value is None:
+                    raise ValueError("invalid bearing %s" % text)
+                c.a, c.la, c.ra = value, True, False
+            elif key in ('x', 'rx'):
+                c.x, c.lx, c.rx = self.evaluate(text, variables), True, key == 'rx'
+            elif key in ('y', 'ry'):
+                c.y, c.ly, c.ry = self.evaluate(text, variables), True, key == 'ry'
+            elif key in ('a', 'ra'):
+                c.a, c.la, c.ra = self.evaluate(text, variables), True, key == 'ra'
+            elif key == 'az':
+                c.a, c.la, c.ra = azimuthToAngle(self.evaluate(text, variables)), True, False
+            elif key == 'd':
+                c.d, c.ld = self.evaluate(text, variables), True
+            else:
+                raise ValueError("unknown key %s" % key)
+        if (c.lx or c.ly) and (c.la or c.ld):
+            # the angle and distance are applied after the coordinates, which would silently be overridden
+            raise ValueError("a coordinate can't be combined with an angle or a distance")
+        if c.ra and self.frame is None:
+            # if relative mode and not enough points: do absolute angle
+            c.ra = False
+        return cursor
+
+    def evaluate(self, text, variables):
+        value = self.expressions.evaluate(text, variables)
+        if value is None:
+            raise ValueError("invalid expression %s" % text)
+        return value
+
+
+#########################
+# Output
+
+def writeWkt(features, output):
+    """
+    Writes the features, one WKT geometry per line
+    """
+    for points, closed in features:
+        coordinates = ", ".join("%r %r" % point for point in points)
+        if closed:
+            output.write("POLYGON((%s))\n" % coordinates)
+        else:
+            output.write("LINESTRING(%s)\n" % coordinates)
+
+def writeGeoJson(features, output):
+    """
+    Writes the features as a GeoJSON FeatureCollection, as they come
+    """
+    output.write('{"type": "FeatureCollection", "features": [\n')
+    for number, (points, closed) in enumerate(features):
+        coordinates = [list(point) for point in points]
+        if closed:
+            geometry = {"type": "Polygon", "coordinates": [coordinates]}
+        else:
+            geometry = {"type": "LineString", "coordinates": coordinates}
+        output.write( (",\n" if number else "") + json.dumps({"type": "Feature", "properties": {"id": number + 1}, "geometry": geometry}) )
+    output.write('\n]}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Digitizes features from CadInput commands, without QGIS")
+    parser.add_argument("commands", help="the commands file (- for the standard input)")
+    parser.add_argument("--format", choices=["wkt", "geojson"], default="wkt")
+    parser.add_argument("--output", help="the output file (the standard output by default)")
+    args = parser.parse_args()
+
+    commands = sys.stdin if args.commands == "-" else open(args.commands)
+    output = open(args.output, "w") if args.output else sys.stdout
+    write = writeGeoJson if args.format == "geojson" else writeWkt
+    try:
+        write(CadConstraintEngine().run(commands), output)
+    except ValueError as e:
+        sys.exit("%s : %s" % (args.commands, e))
+    finally:
+        if commands is not sys.stdin:
+            commands.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+
+class CadConstraints(object):
+    """
+    Plain python copy of the CadInputWidget's state (values, locks, relative flags and modes).
+
+    The widget keeps it in sync from its signals, so that the event filter and the paint widget
+    can read it on each mouse move without any Qt call.
+    """
+
+    def __init__(self):
+        # values
+        self.x = 0.0
+        self.y = 0.0
+        self.a = 0.0
+        self.d = 0.0
+
+        # locks (only True if the lock is checked and available)
+        self.lx = False
+        self.ly = False
+        self.la = False
+        self.ld = False
+
+        # relative flags (only True if the flag is checked and available)
+        self.rx = False
+        self.ry = False
+        self.ra = False
+        self.rd = True
+
+        # last committed segment (available as l and h in the fields' expressions)
+        self.segmentLength = 0.0
+        self.segmentHeading = 0.0 # in degrees
+
+        # modes
+        self.c = False
+        self.per = False
+        self.par = False
+        self.active = False
+        self.enabled = False
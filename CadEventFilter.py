@@ -26,8 +26,21 @@ from qgis.core import *
 from qgis.gui import *
 
 from CadIntersection import *
+from CadConstraintEngine import projectOnDirection, pointAtDistance
+from CadSnapIndex import CadSnapIndex
+from CadRecorder import CadRecorder, MOVE, PRESS, RELEASE, KEY, CANCEL
 
+from collections import OrderedDict
 import math
+import os
+import time
+from timeit import default_timer
+
+try:
+    import numpy
+except ImportError:
+    # the segments are magnetized one by one (see CadIntersection.BATCH)
+    numpy = None
 
 
 class CadEventFilter(QObject):
@@ -39,62 +52,231 @@ class CadEventFilter(QObject):
     according to the constrained mouse position.
     """
 
+    # the snap layers are updated once the scale or the layers stopped changing for SNAPPER_DELAY ms,
+    # and while the mouse moves meanwhile, at most once per SNAPPER_DELAY ms
+    SNAPPER_DELAY = 100
+    # number of snap layers configurations kept, so zooming back and forth doesn't rebuild them
+    SNAPPER_CACHE_SIZE = 8
+    # project entries holding the snapping settings of the layers
+    SNAP_SETTINGS_ENTRIES = ["/LayerSnappingList", "/LayerSnappingEnabledList", "/LayerSnapToList",
+                             "/LayerSnappingToleranceUnitList", "/LayerSnappingToleranceList"]
+
 
     def __init__(self, iface, cadPointList, inputWidget, paintWidget):
         QObject.__init__(self)
         self.iface = iface
         self.mapCanvas = iface.mapCanvas()
         self.inputWidget = inputWidget
+        self.constraints = inputWidget.constraints # read this rather than inputWidget's properties in the hot path
         self.paintWidget = paintWidget
+        self.transform = paintWidget.transform # cached map <-> pixel transform
         self.cadPointList = cadPointList
 
         #snapping hack
-        self.storeOtherSnapping = None #holds the layer's snapping options when snapping is suspended or None if snappig is not suspended
+        self.storeOtherSnapping = None #holds the project's snapping entries when snapping is suspended or None if snappig is not suspended
         self.otherSnappingStored = False
+        self.memoryLayer = None #technical snap layer, kept between clicks
+        self.snappingSnapshot = None #(project's snapping entries, entries written while snapping is suspended), see disableBackgroundSnapping
 
         # snap layers list
-        self.snapper = None # the snapper used to get snapped points from the map canvas. We can't use 
+        self.snapIndex = CadSnapIndex(self.mapCanvas) # in-memory index used to get snapped points from the map canvas (much faster than querying a QgsSnapper on each move)
+        self.snapper = None # QgsSnapper used as fallback for the layers whose index is still being built (None if there's no such layer)
+        self.snapLayers = [] # QgsSnapper.SnapLayer list in use
+        self.snapperKey = None # key of the snap layers in use (see updateSnapper)
+        self.snapperUpdated = 0.0 # time of the last updateSnapper call (see _processMouseEvent)
+        self.snapperConfigs = OrderedDict() # key -> QgsSnapper.SnapLayer list, least recently used first
+        self.snapperTimer = QTimer()
+        self.snapperTimer.setSingleShot(True)
+        self.snapperTimer.setInterval(self.SNAPPER_DELAY)
+        self.snapperTimer.timeout.connect(self.updateSnapper)
+        self.snapIndex.layerReady.connect(self.updateFallbackSnapper)
+        self.snapIndex.loadingChanged.connect(self.inputWidget.setLoadingLayers)
         self.updateSnapper()
-        self.mapCanvas.layersChanged.connect(self.updateSnapper)
-        self.mapCanvas.scaleChanged.connect(self.updateSnapper)
-        QgsProject.instance().readProject.connect(self.updateSnapper)
-        QgsProject.instance().snapSettingsChanged.connect(self.updateSnapper) # TODO : does not work ! see http://hub.qgis.org/issues/9465
+        self.mapCanvas.layersChanged.connect(self.scheduleSnapperUpdate)
+        self.mapCanvas.scaleChanged.connect(self.scheduleSnapperUpdate)
+        QgsProject.instance().readProject.connect(self.scheduleSnapperUpdate)
+        QgsProject.instance().snapSettingsChanged.connect(self.scheduleSnapperUpdate) # TODO : does not work ! see http://hub.qgis.org/issues/9465
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self.forgetSnapperLayers)
+
+        # mouse move coalescing : if frameBudget (in ms) is not 0, only the latest move of each frame is processed
+        self.frameBudget = QSettings().value("CadInput/frameBudget", 0, type=int)
+        self.pendingMove = None # (obj, event) of the latest move which is not processed yet
+        self.moveTimer = QTimer()
+        self.moveTimer.setSingleShot(True)
+        self.moveTimer.setInterval(self.frameBudget)
+        self.moveTimer.timeout.connect(self.flushPendingMove)
+
+        # the vertices are given in map coordinates to the map tools which accept them (see commitExactPoint)
+        self.exactCommit = QSettings().value("CadInput/exactCommit", True, type=bool)
+        self.exactCommitTool = (None, False) # (map tool, whether it accepts vertices in map coordinates)
+
+        # optional recording of the handled events, to replay the session offline (see CadRecorder and benchmarks/replay_session.py)
+        self.recorder = None
+        if QSettings().value("CadInput/recordSessions", False, type=bool):
+            self.startRecording()
+
+        # the filter is only installed while CadInput is active (an edit map tool is set), so it costs nothing otherwise
+        self.attached = False
+        self.mouseTracking = False # the viewport's mouse tracking before the filter was attached
+        self.inputWidget.activeChanged.connect(self.setAttached)
+        self.setAttached(self.constraints.active)
 
     def close(self):
-        self.mapCanvas.layersChanged.disconnect(self.updateSnapper)
-        self.mapCanvas.scaleChanged.disconnect(self.updateSnapper)
-        QgsProject.instance().readProject.disconnect(self.updateSnapper)
-        QgsProject.instance().snapSettingsChanged.disconnect(self.updateSnapper)
+        self.inputWidget.activeChanged.disconnect(self.setAttached)
+        self.setAttached(False)
+        self.stopRecording()
+        self.moveTimer.stop()
+        self.moveTimer.timeout.disconnect(self.flushPendingMove)
+        self.pendingMove = None
+        self.snapperTimer.stop()
+        self.snapperTimer.timeout.disconnect(self.updateSnapper)
+        self.mapCanvas.layersChanged.disconnect(self.scheduleSnapperUpdate)
+        self.mapCanvas.scaleChanged.disconnect(self.scheduleSnapperUpdate)
+        QgsProject.instance().readProject.disconnect(self.scheduleSnapperUpdate)
+        QgsProject.instance().snapSettingsChanged.disconnect(self.scheduleSnapperUpdate)
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.disconnect(self.forgetSnapperLayers)
+        self.snapperConfigs.clear()
+        self.snapIndex.layerReady.disconnect(self.updateFallbackSnapper)
+        self.snapIndex.loadingChanged.disconnect(self.inputWidget.setLoadingLayers)
+        self.snapIndex.close()
+
+    def setAttached(self, attached):
+        """
+        Installs the filter on the canvas and its viewport, or removes it
+        """
+        if attached == self.attached:
+            return
+        self.attached = attached
+        viewport = self.mapCanvas.viewport()
+        if attached:
+            #We need the canvas's viewport to track the mouse for mouseMoveEvents to happen
+            self.mouseTracking = viewport.hasMouseTracking()
+            viewport.setMouseTracking(True)
+            #We install the eventFilter on the canvas's viewport to get the mouse events
+            viewport.installEventFilter(self)
+            #we install the eventFilter on the canvas itself to get the key events
+            self.mapCanvas.installEventFilter(self)
+        else:
+            viewport.removeEventFilter(self)
+            self.mapCanvas.removeEventFilter(self)
+            viewport.setMouseTracking(self.mouseTracking)
+            # a move may be waiting for the frame's timer
+            self.moveTimer.stop()
+            self.pendingMove = None
+            # hide the feedback, no event will update it until the filter is attached again
+            self.paintWidget.updateRect()
+
+    def startRecording(self):
+        """
+        Starts recording the session to a new log in the CadInput/recordSessionsDir directory
+        """
+        defaultDir = os.path.join(QgsApplication.qgisSettingsDirPath(), "cadinput", "sessions")
+        directory = QSettings().value("CadInput/recordSessionsDir", defaultDir)
+        path = os.path.join(directory, time.strftime("session_%Y%m%d_%H%M%S.cadrec"))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.recorder = CadRecorder(path)
+        except (IOError, OSError) as e:
+            QgsMessageLog.logMessage("CadInput : could not record the session to %s (%s)" % (path, e))
+            return
+        QgsMessageLog.logMessage("CadInput : recording the session to %s" % path)
+        self.recordExtent()
+        self.mapCanvas.extentsChanged.connect(self.recordExtent)
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.mapCanvas.extentsChanged.disconnect(self.recordExtent)
+            self.recorder.close()
+            self.recorder = None
+
+    def recordExtent(self):
+        self.recorder.recordExtent(self.mapCanvas.extent(), self.mapCanvas.width(), self.mapCanvas.height())
+
+    def scheduleSnapperUpdate(self, *args):
+        """
+        Updates the snapper once the layers or the scale stop changing (see SNAPPER_DELAY)
+        """
+        self.snapperTimer.start()
 
     def updateSnapper(self):
         """
-            Updates self.snapper to take into consideration layers changes, layers not displayed because of the scale *TODO* and the user's input */TODO*
+            Updates self.snapIndex (and the fallback self.snapper) to take into consideration layers changes, layers not displayed because of the scale *TODO* and the user's input */TODO*
+            Nothing is rebuilt if the snappable layers (visible at this scale), the current layer and the project's snapping settings did not change,
+            and the configurations recently used are reused.
             @note : it's a shame we can't get QgsMapCanvasSnapper().mSnapper which would replace all code below (I guess)
         """
-        snapperList = []
+        self.snapperTimer.stop()
+        self.snapperUpdated = default_timer()
+
         scale = self.iface.mapCanvas().mapRenderer().scale()
         curLayer = self.iface.legendInterface().currentLayer()
-        layers = self.iface.mapCanvas().layers()
-        for layer in layers:
+        layers = []
+        for layer in self.iface.mapCanvas().layers():
             if layer.type() == QgsMapLayer.VectorLayer and layer.hasGeometryType():
                 if not layer.hasScaleBasedVisibility() or layer.minimumScale() < scale <= layer.maximumScale():
-                    (layerid, enabled, snapType, tolUnits, tol, avoidInt) = QgsProject.instance().snapSettingsForLayer(layer.id())                    
-                    if not enabled:
-                        continue
-                    snapLayer = QgsSnapper.SnapLayer()
-                    snapLayer.mLayer = layer
-                    snapLayer.mSnapTo = snapType
-                    snapLayer.mTolerance = tol
-                    snapLayer.mUnitType = tolUnits
-                    # put current layer on top
-                    if layer is curLayer:
-                        snapperList.insert(0, snapLayer)
-                    else:
-                        snapperList.append(snapLayer)
+                    layers.append(layer)
+
+        # the project's entries are compared as a whole rather than reading the settings of each layer
+        project = QgsProject.instance()
+        settings = tuple( tuple(project.readListEntry("Digitizing", entry)[0]) for entry in self.SNAP_SETTINGS_ENTRIES )
+        key = ( tuple(layer.id() for layer in layers), curLayer.id() if curLayer is not None else None, settings )
+        if key == self.snapperKey:
+            return
+        self.snapperKey = key
+
+        snapperList = self.snapperConfigs.pop(key, None)
+        if snapperList is None:
+            snapperList = []
+            for layer in layers:
+                (layerid, enabled, snapType, tolUnits, tol, avoidInt) = project.snapSettingsForLayer(layer.id())
+                if not enabled:
+                    continue
+                snapLayer = QgsSnapper.SnapLayer()
+                snapLayer.mLayer = layer
+                snapLayer.mSnapTo = snapType
+                snapLayer.mTolerance = tol
+                snapLayer.mUnitType = tolUnits
+                # put current layer on top
+                if layer is curLayer:
+                    snapperList.insert(0, snapLayer)
+                else:
+                    snapperList.append(snapLayer)
+        self.snapperConfigs[key] = snapperList
+        while len(self.snapperConfigs) > self.SNAPPER_CACHE_SIZE:
+            self.snapperConfigs.popitem(last=False)
+
+        self.snapLayers = snapperList
+        self.snapIndex.setSnapLayers(snapperList)
+        self.updateFallbackSnapper()
 
-        self.snapper = QgsSnapper(self.mapCanvas.mapRenderer())
-        self.snapper.setSnapLayers(snapperList)
-        self.snapper.setSnapMode(QgsSnapper.SnapWithResultsWithinTolerances)
+    def updateFallbackSnapper(self, *args):
+        """
+        Builds the QgsSnapper of the snap layers which are not indexed yet (self.snapper is None if they all are)
+        """
+        fallbackList = [snapLayer for snapLayer in self.snapLayers if not self.snapIndex.isReady(snapLayer.mLayer.id())]
+        if fallbackList:
+            self.snapper = QgsSnapper(self.mapCanvas.mapRenderer())
+            self.snapper.setSnapLayers(fallbackList)
+            self.snapper.setSnapMode(QgsSnapper.SnapWithResultsWithinTolerances)
+        else:
+            self.snapper = None
+
+    def forgetSnapperLayers(self, layerIds):
+        """
+        Drops the cached configurations using the layers about to be removed
+        """
+        layerIds = set(layerIds)
+        for key in list(self.snapperConfigs):
+            if layerIds.intersection(key[0]):
+                del self.snapperConfigs[key]
+        if self.snapperKey is not None and layerIds.intersection(self.snapperKey[0]):
+            # the layers are still alive, but must not be snapped to until the snapper is updated
+            self.snapperKey = None
+            self.snapLayers = [snapLayer for snapLayer in self.snapLayers if snapLayer.mLayer.id() not in layerIds]
+            self.snapIndex.setSnapLayers(self.snapLayers)
+            self.updateFallbackSnapper()
+            self.scheduleSnapperUpdate()
 
 
     ############################
@@ -109,72 +291,30 @@ class CadEventFilter(QObject):
             return QObject.eventFilter(self, obj, event)
 
         # MOUSE MOVE OR LEFT CLICK
-        if ( self.inputWidget.active and self.inputWidget.enabled and
+        if ( self.constraints.active and self.constraints.enabled and
                     (  (event.type() == QEvent.MouseMove and event.button() != Qt.MidButton) or
                        (event.type() == QEvent.MouseButtonPress and event.button() == Qt.LeftButton) or
                        (event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton) ) ):
-            
-            # Get the snaps
-            (self.cadPointList.snapPoint, self.cadPointList.snapSegment) = self._toMapSnap( event.pos() )
-
-            # Set the current mouse position (either from snapPoint, from snapSegment, or regular coordinate transform)
-            if self.cadPointList.snapPoint is not None:
-                curPoint = QgsPoint(self.cadPointList.snapPoint)
-            elif self.cadPointList.snapSegment is not None:
-                curPoint = self.cadPointList.snapSegment[0]
-            else:
-                curPoint = self.iface.mapCanvas().getCoordinateTransform().toMapCoordinates( event.pos() )
-
-            curPoint = self._constrain(curPoint)
-            self.cadPointList.updateCurrentPoint(curPoint)
 
+            if self.frameBudget and event.type() == QEvent.MouseMove:
+                # We only keep the latest move, it will be processed when the frame's timer times out
+                # (the event is copied since Qt deletes it once it's been filtered)
+                self.pendingMove = (obj, QMouseEvent( event.type(), event.pos(), event.button(), event.buttons(), event.modifiers() ))
+                if not self.moveTimer.isActive():
+                    self.moveTimer.start()
+                return True
 
-            # A perpendicular or parallel mode
-            if self.inputWidget.par or self.inputWidget.per:
-                #A. Set segment mode (we set the angle)
-                if event.type() == QEvent.MouseButtonPress:
-                    self._alignToSegment()
-                elif event.type() == QEvent.MouseButtonRelease and self.cadPointList.snapSegment:
-                    self.inputWidget.par = False
-                    self.inputWidget.per = False
-
-            # B standard input mode
-            else:
-
-                # B1. Construction mode
-                if self.inputWidget.c:
-                    pass
-
-                # B2. Normal input mode
-                else:
-                    if event.type() == QEvent.MouseButtonPress or event.type() == QEvent.MouseButtonRelease:
-                        #B2a. Mouse press input mode
-                        self.createSnappingPoint()
-                        modifiedEvent = QMouseEvent( event.type(), self._toPixels(curPoint), event.button(), event.buttons(), event.modifiers() )
-                        QCoreApplication.sendEvent(obj,modifiedEvent)
-                        self.removeSnappingPoint()
-
-                    else:
-                        #B2B. Mouse move input mode
-                        modifiedEvent = QMouseEvent( event.type(), self._toPixels(curPoint), event.button(), event.buttons(), event.modifiers() )
-                        QCoreApplication.sendEvent(obj,modifiedEvent)
-
-                # We unlock all the inputs, since we don't want locking to stay for the next point (actually, sometimes we do, this could be an option)
-                if event.type() == QEvent.MouseButtonRelease:
-                    self.inputWidget.unlockAll()
-
-                # In input mode (B), we register the last points for following relative calculation in case of mousePress
-                if event.type() == QEvent.MouseButtonRelease:
-                    self.cadPointList.newPoint()
-
-            # update the map canvas item
-            self.paintWidget.updateRect()
+            # Presses and releases are never coalesced, but the pending move must be processed before them
+            self.flushPendingMove()
+            self._processMouseEvent(obj, event)
 
             # By returning True, we inform the eventSystem that the event must not be sent further (since a new event has been sent through QCoreApplication)
             return True
 
         # KEYPRESS
-        elif self.inputWidget.active and event.type() == QEvent.KeyPress:
+        elif self.constraints.active and event.type() == QEvent.KeyPress:
+            if self.recorder is not None:
+                self.recorder.record(KEY, self.constraints, event.modifiers(), key=event.key())
             # remove last point
             if event.key() == Qt.Key_Backspace or event.key() == Qt.Key_Delete:
                 self.cadPointList.removeLastPoint()
@@ -189,9 +329,12 @@ class CadEventFilter(QObject):
         # RIGHT CLICK
         elif event.type() == QEvent.MouseButtonRelease and event.button() == Qt.RightButton:
             # cancel digitization on right click
+            if self.recorder is not None:
+                self.recorder.record(CANCEL, self.constraints)
             self.cadPointList.empty()
             self.cadPointList.snapSegment = None # segment snapped at current position (if any)
             self.cadPointList.snapPoint = None # point snapped at current position (if any)
+            self.cadPointList.snapSegments = [] # segments within tolerance at current position
             QCoreApplication.sendEvent(obj,event)
             return True
 
@@ -200,52 +343,171 @@ class CadEventFilter(QObject):
             #In case we don't manage this type of event, we return the normal implementation
             return QObject.eventFilter(self, obj, event)
 
+    def flushPendingMove(self):
+        """
+        Processes the latest coalesced mouse move (if any)
+        """
+        self.moveTimer.stop()
+        pendingMove, self.pendingMove = self.pendingMove, None
+        if pendingMove is not None and self.constraints.active and self.constraints.enabled:
+            obj, event = pendingMove
+            self._processMouseEvent(obj, event)
+
+    def _processMouseEvent(self, obj, event):
+        """
+        Snaps and constrains a mouse move, left press or left release, and sends the constrained event to obj
+        """
+        # the snap layers must be up to date before a click, but moves only update them once per SNAPPER_DELAY ms
+        # (updateSnapper only rebuilds them if they actually changed)
+        if self.snapperTimer.isActive():
+            if event.type() != QEvent.MouseMove or 1000 * (default_timer() - self.snapperUpdated) >= self.SNAPPER_DELAY:
+                self.updateSnapper()
+
+        # timing of each stage (only if profiling is enabled)
+        profiler = self.inputWidget.profiler
+        if profiler is not None:
+            start = t = profiler.now()
+
+        # Get the snaps
+        (self.cadPointList.snapPoint, self.cadPointList.snapSegment, self.cadPointList.snapSegments) = self._toMapSnap( event.pos() )
+        if profiler is not None:
+            t = profiler.lap('snapping', t)
+
+        # Set the current mouse position (either from snapPoint, from snapSegment, or regular coordinate transform)
+        mousePoint = QgsPoint( *self.transform.toMap( event.x(), event.y() ) )
+        if self.cadPointList.snapPoint is not None:
+            curPoint = QgsPoint(self.cadPointList.snapPoint)
+        elif self.cadPointList.snapSegment is not None:
+            curPoint = self.cadPointList.snapSegment[0]
+        else:
+            curPoint = QgsPoint(mousePoint)
+
+        if self.recorder is not None:
+            kind = {QEvent.MouseMove: MOVE, QEvent.MouseButtonPress: PRESS, QEvent.MouseButtonRelease: RELEASE}[event.type()]
+            self.recorder.record(kind, self.constraints, event.modifiers(), mousePoint.x(), mousePoint.y(),
+                                 self.cadPointList.snapPoint, self.cadPointList.snapSegment)
+
+        curPoint = self._constrain(curPoint, mousePoint)
+        self.cadPointList.updateCurrentPoint(curPoint)
+        if profiler is not None:
+            t = profiler.lap('constrain', t)
+
+
+        # A perpendicular or parallel mode
+        if self.constraints.par or self.constraints.per:
+            #A. Set segment mode (we set the angle)
+            if event.type() == QEvent.MouseButtonPress:
+                self._alignToSegment()
+            elif event.type() == QEvent.MouseButtonRelease and self.cadPointList.snapSegment:
+                self.inputWidget.par = False
+                self.inputWidget.per = False
+
+        # B standard input mode
+        else:
+
+            # B1. Construction mode
+            if self.constraints.c:
+                pass
+
+            # B2. Normal input mode
+            else:
+                if (event.type() == QEvent.MouseButtonPress or event.type() == QEvent.MouseButtonRelease) and self.commitExactPoint(obj, event, curPoint):
+                    #B2a. Mouse press input mode, the map tool takes the point in map coordinates
+                    if profiler is not None:
+                        t = profiler.lap('dispatch', t)
+
+                elif event.type() == QEvent.MouseButtonPress or event.type() == QEvent.MouseButtonRelease:
+                    #B2a. Mouse press input mode, the map tool snaps to the technical snap layer
+                    self.createSnappingPoint()
+                    if profiler is not None:
+                        t1 = profiler.now()
+                    modifiedEvent = QMouseEvent( event.type(), self._toPixels(curPoint), event.button(), event.buttons(), event.modifiers() )
+                    QCoreApplication.sendEvent(obj,modifiedEvent)
+                    if profiler is not None:
+                        t2 = profiler.now()
+                    self.removeSnappingPoint()
+                    if profiler is not None:
+                        # creating and removing the snapping point are one sample
+                        t3 = profiler.now()
+                        profiler.add('snappingPoint', (t1 - t) + (t3 - t2))
+                        profiler.add('dispatch', t2 - t1)
+                        t = t3
+
+                else:
+                    #B2B. Mouse move input mode
+                    modifiedEvent = QMouseEvent( event.type(), self._toPixels(curPoint), event.button(), event.buttons(), event.modifiers() )
+                    QCoreApplication.sendEvent(obj,modifiedEvent)
+                    if profiler is not None:
+                        t = profiler.lap('dispatch', t)
+
+            # We unlock all the inputs, since we don't want locking to stay for the next point (actually, sometimes we do, this could be an option)
+            if event.type() == QEvent.MouseButtonRelease:
+                self.inputWidget.unlockAll()
+
+            # In input mode (B), we register the last points for following relative calculation in case of mousePress
+            if event.type() == QEvent.MouseButtonRelease:
+                self.cadPointList.newPoint()
+
+        # update the map canvas item
+        self.paintWidget.updateRect()
+        if profiler is not None:
+            profiler.lap('repaint', t)
+            profiler.lap('total', start)
+
 
     ########################
     ##### CONSTRAINING #####
     ########################
 
-    def _constrain(self, point):
+    def _constrain(self, point, mousePoint=None):
         """
         This method returns a point constrained by the w's settings and, by the way, updates the w's displayed values.
+        When a locked value is magnetized to the snapped segments, the intersection nearest to mousePoint (defaults to point) is used.
         """
+        if mousePoint is None:
+            mousePoint = QgsPoint(point)
         previousPoint = self.cadPointList.previousPoint()
-        penulPoint = self.cadPointList.penultimatePoint()
-        dx, dy, ddx, ddy, dist = None, None, None, None, None
+        dx, dy, dist = None, None, None
 
 
         #################
         # X constrain
-        if self.inputWidget.lx:
-            if self.inputWidget.rx:
-                point.setX( previousPoint.x() + self.inputWidget.x )
+        if self.constraints.lx:
+            if self.constraints.rx:
+                point.setX( previousPoint.x() + self.constraints.x )
             else:
-                point.setX( self.inputWidget.x )
+                point.setX( self.constraints.x )
 
-            if self.cadPointList.snapSegment is not None and not self.inputWidget.ly:
+            if self.cadPointList.snapSegment is not None and not self.constraints.ly:
                 # we will magnietize to the intersection of that segment and the lockedX !
-                y = CadIntersection.LineIntersectionAtX( self.cadPointList.snapSegment[1], self.cadPointList.snapSegment[2], point.x() )
-                point.setY( y )
+                if CadIntersection.BATCH:
+                    self._magnetize( point, mousePoint, *CadIntersection.LineIntersectionAtXBatch( self.cadPointList.snapSegments, point.x() ) )
+                else:
+                    y = CadIntersection.LineIntersectionAtX( self.cadPointList.snapSegment[1], self.cadPointList.snapSegment[2], point.x() )
+                    point.setY( y )
         else:
-            if self.inputWidget.rx:
+            if self.constraints.rx:
                 self.inputWidget.x = point.x() - previousPoint.x()
             else:
                 self.inputWidget.x = point.x()
 
         #################
         # Y constrain
-        if self.inputWidget.ly:
-            if self.inputWidget.ry:
-                point.setY( previousPoint.y() + self.inputWidget.y )
+        if self.constraints.ly:
+            if self.constraints.ry:
+                point.setY( previousPoint.y() + self.constraints.y )
             else:
-                point.setY( self.inputWidget.y )
+                point.setY( self.constraints.y )
 
-            if self.cadPointList.snapSegment is not None and not self.inputWidget.lx:
+            if self.cadPointList.snapSegment is not None and not self.constraints.lx:
                 # we will magnietize to the intersection of that segment and the lockedY !
-                x = CadIntersection.LineIntersectionAtY( self.cadPointList.snapSegment[1], self.cadPointList.snapSegment[2], point.y() )
-                point.setX( x )
+                if CadIntersection.BATCH:
+                    self._magnetize( point, mousePoint, *CadIntersection.LineIntersectionAtYBatch( self.cadPointList.snapSegments, point.y() ) )
+                else:
+                    x = CadIntersection.LineIntersectionAtY( self.cadPointList.snapSegment[1], self.cadPointList.snapSegment[2], point.y() )
+                    point.setX( x )
         else:
-            if self.inputWidget.ry:
+            if self.constraints.ry:
                 self.inputWidget.y = point.y() - previousPoint.y()
 
             else:
@@ -256,30 +518,21 @@ class CadEventFilter(QObject):
         if len(self.cadPointList)>1:
             dx = point.x() - previousPoint.x()
             dy = point.y() - previousPoint.y()
-        if self.inputWidget.ra and len(self.cadPointList)>2:
-            ddx = previousPoint.x() - penulPoint.x()
-            ddy = previousPoint.y() - penulPoint.y()
-
-        if len(self.cadPointList)>1 and self.inputWidget.la:
-            a = self.inputWidget.a/180.0*math.pi
-            if self.inputWidget.ra and len(self.cadPointList)>2:
-                # We compute the angle relative to the last segment (0° is aligned with last segment)
-                a += math.atan2(ddy, ddx)
-            else:
-                # if relative mode and not enough points: do absolute angle
-                pass
 
-            cosA = math.cos( a )
-            sinA = math.sin( a )
-            v1 = [ cosA, sinA ]
-            v2 = [ dx, dy ]
-            vP = v1[0]*v2[0]+v1[1]*v2[1]
-            point.set( previousPoint.x()+cosA*vP, previousPoint.y()+sinA*vP)
+        if len(self.cadPointList)>1 and self.constraints.la:
+            # In relative mode, the angle is relative to the last segment (0° is aligned with last segment)
+            # if relative mode and not enough points: do absolute angle
+            a, cosA, sinA = self.cadPointList.lockedAngle(self.constraints.a, self.constraints.ra)
+            point.set( *projectOnDirection(point.x(), point.y(), previousPoint.x(), previousPoint.y(), cosA, sinA) )
+
+            if self.cadPointList.snapSegment is not None and not self.constraints.ld and CadIntersection.BATCH:
+                # we will magnietize to the intersection of those segments and the lockedAngle !
+                self._magnetize( point, mousePoint, *CadIntersection.LineAngleIntersectionBatch( self.cadPointList.snapSegments, (previousPoint.x(), previousPoint.y()), a ) )
 
-            if self.cadPointList.snapSegment is not None and not self.inputWidget.ld:
+            elif self.cadPointList.snapSegment is not None and not self.constraints.ld:
                 # we will magnietize to the intersection of that segment and the lockedAngle !
 
-                l1 = QLineF(previousPoint.x(), previousPoint.y(), previousPoint.x()+math.cos(a), previousPoint.y()+math.sin(a))
+                l1 = QLineF(previousPoint.x(), previousPoint.y(), previousPoint.x()+cosA, previousPoint.y()+sinA)
                 l2 = QLineF(self.cadPointList.snapSegment[1].x(), self.cadPointList.snapSegment[1].y(), self.cadPointList.snapSegment[2].x() ,self.cadPointList.snapSegment[2].y())
 
                 intP = QPointF()
@@ -290,8 +543,9 @@ class CadEventFilter(QObject):
                     point.set( intP.x(), intP.y() )
         else:
             if len(self.cadPointList)>1:
-                if self.inputWidget.ra and len(self.cadPointList)>2:
-                    lastA = math.atan2(ddy, ddx)
+                frame = self.cadPointList.lastSegmentFrame()
+                if self.constraints.ra and frame is not None:
+                    lastA = frame[0]
                 else:
                     lastA = 0
                 self.inputWidget.a = (math.atan2( dy, dx )-lastA)/math.pi*180
@@ -301,23 +555,21 @@ class CadEventFilter(QObject):
         #################
         # Distance constrain
         if len(self.cadPointList)>1:
-            dx = point.x() - previousPoint.x()
-            dy = point.y() - previousPoint.y()
             dist = math.sqrt(point.sqrDist(previousPoint))
 
-        if len(self.cadPointList)>1 and self.inputWidget.ld:
-            if dist == 0:
-                # handle case where mouse is over origin and distance constraint is enabled
-                # take arbitrary horizontal line
-                point.set( previousPoint.x()+self.inputWidget.d, previousPoint.y() )
-            else:
-                vP = self.inputWidget.d / dist
-                point.set( previousPoint.x()+dx*vP,  previousPoint.y()+dy*vP )
+        if len(self.cadPointList)>1 and self.constraints.ld:
+            # (if the mouse is over origin, an arbitrary horizontal line is taken)
+            point.set( *pointAtDistance(point.x(), point.y(), previousPoint.x(), previousPoint.y(), self.constraints.d) )
+
+            if self.cadPointList.snapSegment is not None and not self.constraints.la and CadIntersection.BATCH:
+                # we will magnietize to the intersection of those segments and the lockedDistance !
+                p1, p2, valid = CadIntersection.CircleLineIntersectionBatch( self.cadPointList.snapSegments, (previousPoint.x(), previousPoint.y()), self.constraints.d )
+                self._magnetize( point, mousePoint, numpy.vstack((p1, p2)), numpy.concatenate((valid, valid)) )
 
-            if self.cadPointList.snapSegment is not None and not self.inputWidget.la:
+            elif self.cadPointList.snapSegment is not None and not self.constraints.la:
                 # we will magnietize to the intersection of that segment and the lockedDistance !
                 p1, p2 = CadIntersection.CircleLineIntersection(self.cadPointList.snapSegment[1], self.cadPointList.snapSegment[2],
-                                                                previousPoint, self.inputWidget.d)
+                                                                previousPoint, self.constraints.d)
                 #we snap to the nearest intersection
                 if p1 is not None:
                     if point.sqrDist(p1) < point.sqrDist(p2):
@@ -328,45 +580,54 @@ class CadEventFilter(QObject):
             self.inputWidget.d = dist
 
         #Update the widget's x&y values (for display only)
-        if self.inputWidget.rx:
+        if self.constraints.rx:
             if len(self.cadPointList)>1:
                 self.inputWidget.x = point.x() - previousPoint.x()
             else:
                 self.inputWidget.rx = False
-        if not self.inputWidget.rx:
+        if not self.constraints.rx:
             self.inputWidget.x = point.x()
 
-        if self.inputWidget.ry:
+        if self.constraints.ry:
             if len(self.cadPointList)>1:
                 self.inputWidget.y = point.y() - previousPoint.y()
             else:
                 self.inputWidget.ry = False
-        if not self.inputWidget.ry:
+        if not self.constraints.ry:
             self.inputWidget.y = point.y()
 
         return point
 
 
+    def _magnetize(self, point, mousePoint, intersections, valid):
+        """
+        Moves point to the valid intersection (from the CadIntersection batch methods) which is the nearest to mousePoint, if any
+        """
+        if not valid.any():
+            return
+        dist = (intersections[:,0] - mousePoint.x())**2 + (intersections[:,1] - mousePoint.y())**2
+        nearest = numpy.where(valid, dist, numpy.inf).argmin()
+        point.set( float(intersections[nearest,0]), float(intersections[nearest,1]) )
+
     def _alignToSegment(self):
         """
         Set's the CadWidget's angle value to be parrelel to self.cadPointList.snapSegment's angle
         """
         
         previousPoint = self.cadPointList.previousPoint()
-        penulPoint = self.cadPointList.penultimatePoint()
+        frame = self.cadPointList.lastSegmentFrame()
 
         # do not authorize per or par if there is no previous point
         if previousPoint is None or self.cadPointList.snapSegment is None:
             return
 
         angle = math.atan2( self.cadPointList.snapSegment[1].y()-self.cadPointList.snapSegment[2].y(), self.cadPointList.snapSegment[1].x()-self.cadPointList.snapSegment[2].x() )
-        if self.inputWidget.ra:
-            lastangle = math.atan2(previousPoint.y()-penulPoint.y(),previousPoint.x()-penulPoint.x())
-            angle -= lastangle
+        if self.constraints.ra and frame is not None:
+            angle -= frame[0]
 
-        if self.inputWidget.par:
+        if self.constraints.par:
             pass
-        elif self.inputWidget.per:
+        elif self.constraints.per:
             angle += math.pi / 2.0
 
         self.inputWidget.la = True
@@ -379,31 +640,99 @@ class CadEventFilter(QObject):
 
     def _toMapSnap(self, qpoint):
         """
-        returns the current snapped point (if any) and the current snapped segment (if any) in map coordinates
-        The current snapped segment is returned as (snapped point on segment, startPoint, endPoint)
+        returns the current snapped point (if any), the current snapped segment (if any) and the segments within tolerance in map coordinates
+        The current snapped segment is returned as (snapped point on segment, startPoint, endPoint), the segments within tolerance as a list of (x1, y1, x2, y2), nearest first
         """
-        ok, snappingResults = self.snapper.snapPoint(qpoint, [])
-        for result in snappingResults:
-            if result.snappedVertexNr != -1:
-                return QgsPoint(result.snappedVertex), None
-        if len(snappingResults):
-            output = (QgsPoint(snappingResults[0].snappedVertex), QgsPoint(snappingResults[0].beforeVertex), QgsPoint(snappingResults[0].afterVertex))
-            return None, output
-        else:
-            return None, None
+        mapPoint = QgsPoint( *self.transform.toMap( qpoint.x(), qpoint.y() ) )
+        snapPoint, snapSegment, snapSegments = self.snapIndex.snapPoint(mapPoint)
+
+        if self.snapper is not None:
+            ok, snappingResults = self.snapper.snapPoint(qpoint, [])
+            for result in snappingResults:
+                if result.snappedVertexNr != -1:
+                    vertex = QgsPoint(result.snappedVertex)
+                    if snapPoint is None or vertex.sqrDist(mapPoint) < snapPoint.sqrDist(mapPoint):
+                        snapPoint = vertex
+            if snapPoint is None and len(snappingResults):
+                segment = (QgsPoint(snappingResults[0].snappedVertex), QgsPoint(snappingResults[0].beforeVertex), QgsPoint(snappingResults[0].afterVertex))
+                coords = [ (r.beforeVertex.x(), r.beforeVertex.y(), r.afterVertex.x(), r.afterVertex.y()) for r in snappingResults[:self.snapIndex.MAX_SNAP_SEGMENTS] ]
+                if snapSegment is None or segment[0].sqrDist(mapPoint) < snapSegment[0].sqrDist(mapPoint):
+                    snapSegment = segment
+                    snapSegments = coords + snapSegments
+                else:
+                    snapSegments = snapSegments + coords
+                snapSegments = snapSegments[:self.snapIndex.MAX_SNAP_SEGMENTS]
+
+        if snapPoint is not None:
+            return snapPoint, None, []
+        return None, snapSegment, snapSegments
 
     def _toPixels(self, qgspoint):
         """
         Given a point in project's coordinates, returns a point in screen (pixel) coordinates
         """
-        try:
-            p = self.iface.mapCanvas().getCoordinateTransform().transform( qgspoint )
-            return QPoint( int(p.x()), int(p.y()) )
-        except ValueError:
+        x, y = self.transform.toPixel( qgspoint.x(), qgspoint.y() )
+        if math.isnan(x) or math.isnan(y):
             #this happens sometimes at loading, it seems the mapCanvas is not ready and returns a point at NaN;NaN
             return QPoint()
+        return QPoint( int(x), int(y) )
+
+
+
+
+    ########################
+    ##### EXACT COMMIT #####
+    ########################
 
+    # QgsMapToolCapture's CaptureLine and CapturePolygon modes (the class is not in the python bindings of every QGIS version)
+    CAPTURE_MODES = (2, 3)
+
+    def mapToolAcceptsMapVertices(self):
+        """
+        Returns whether the current map tool is a capture tool whose addVertex takes a point in map coordinates.
+        The answer is kept until the map tool changes.
+        """
+        tool = self.mapCanvas.mapTool()
+        if tool is not self.exactCommitTool[0]:
+            accepts = False
+            try:
+                accepts = callable(getattr(tool, 'addVertex', None)) and tool.mode() in self.CAPTURE_MODES
+            except (AttributeError, RuntimeError, TypeError):
+                #no mode(), or a protected method of a tool created by QGIS
+                pass
+            self.exactCommitTool = (tool, accepts)
+        return self.exactCommitTool[1]
+
+    def commitExactPoint(self, obj, event, point):
+        """
+        Gives the point of a click to the map tool in map coordinates, so it's not rounded to the screen's pixels
+        and the technical snap layer is not needed. The press is sent as is (capture tools add the vertex on release)
+        and the release is replaced by a call to the tool's addVertex.
+        Returns False if the map tool doesn't accept the point this way, if the active layer is not an editable vector layer
+        (the tool is then left untouched, as the normal click would) or if the tool fails to add it (addVertex returns a non-zero code,
+        e.g. a failed coordinates transform), the click must then go through the snapping hack.
+        """
+        if not self.exactCommit or not self.mapToolAcceptsMapVertices():
+            return False
+        layer = self.iface.activeLayer()
+        if layer is None or layer.type() != QgsMapLayer.VectorLayer or not layer.isEditable():
+            return False
+        if event.type() == QEvent.MouseButtonPress:
+            modifiedEvent = QMouseEvent( event.type(), self._toPixels(point), event.button(), event.buttons(), event.modifiers() )
+            QCoreApplication.sendEvent(obj,modifiedEvent)
+            return True
 
+        tool = self.exactCommitTool[0]
+        try:
+            if hasattr(tool, 'isCapturing') and not tool.isCapturing():
+                tool.startCapturing()
+            result = tool.addVertex( QgsPoint(point) )
+        except (AttributeError, RuntimeError, TypeError):
+            #the tool's methods don't have the expected signatures, we won't try again with this tool
+            self.exactCommitTool = (tool, False)
+            return False
+        #0 (or None for the tools which don't return a code) means the vertex was added
+        return not result
 
 
     #########################
@@ -413,26 +742,14 @@ class CadEventFilter(QObject):
     def createSnappingPoint(self):
         """
         This method creates a point that will be snapped by the next click so that the point will be at model precision and not at screen precision.
-        It also disables all the other layer's snapping so they won't interfere. Those are reset in rmeoveSnapping point.
+        It also disables all the other layer's snapping so they won't interfere. Those are reset in removeSnappingPoint.
         """
         activeLayer = self.iface.activeLayer()
 
-        #store and remove all the snapping options
-        self.disableBackgroundSnapping()
-
-        try:
-            provider = self.memoryLayer.dataProvider()
-        except (RuntimeError, AttributeError):
-            #RuntimeError : if the user removed the layer, the underlying c++ object will be deleted
-            #AttributeError : if self.memory is None
-            self.cleanLayers("(cadinput_techical_snap_layer)")
-            self.memoryLayer = QgsVectorLayer("point", "(cadinput_techical_snap_layer)", "memory")
-            QgsMapLayerRegistry.instance().addMapLayer(self.memoryLayer, False)
-            provider = self.memoryLayer.dataProvider()
+        provider = self.snappingLayerProvider()
 
-        QgsProject.instance().blockSignals(True) #we don't want to refresh the snapping UI
-        QgsProject.instance().setSnapSettingsForLayer(self.memoryLayer.id(),  True, QgsSnapper.SnapToVertex , QgsTolerance.Pixels, 20.0, False )
-        QgsProject.instance().blockSignals(False) #we don't want to refresh the snapping UI
+        #store and remove all the snapping options (the technical layer's ones are written at the same time)
+        self.disableBackgroundSnapping()
 
         feature = QgsFeature()
         feature.setGeometry( QgsGeometry.fromPoint( self.cadPointList.currentPoint() ) )
@@ -448,55 +765,89 @@ class CadEventFilter(QObject):
         It must be called after createSnappingPoint (once the snapping has been done), since it also reenables the other layer's snapping
         """
 
-        #empty the layer
+        #empty the layer in one call
         provider = self.memoryLayer.dataProvider()
-        features = provider.getFeatures( QgsFeatureRequest() )
-
-        for feature in features:
-            provider.deleteFeatures([feature.id()])
-
-        #In 2.2, this will be  (untested):
-        #provider = self.memoryLayer.dataProvider()
-        #provider.deleteFeatures( self.memoryLayer.allFeatureIds() )
-
+        if hasattr(self.memoryLayer, 'allFeatureIds'):
+            featureIds = self.memoryLayer.allFeatureIds()
+        else:
+            #QGIS < 2.2
+            featureIds = [feature.id() for feature in provider.getFeatures( QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry) )]
+        provider.deleteFeatures(featureIds)
 
         #restore the snapping options
         self.restoreBackgroundSnapping()
 
+    def snappingLayerProvider(self):
+        """
+        Returns the provider of the technical snap layer, which is created once and then kept (hidden) in the layer registry
+        """
+        try:
+            return self.memoryLayer.dataProvider()
+        except (RuntimeError, AttributeError):
+            #RuntimeError : if the user removed the layer, the underlying c++ object will be deleted
+            #AttributeError : if self.memoryLayer is None
+            self.cleanLayers("(cadinput_techical_snap_layer)")
+            self.memoryLayer = QgsVectorLayer("point", "(cadinput_techical_snap_layer)", "memory")
+            QgsMapLayerRegistry.instance().addMapLayer(self.memoryLayer, False)
+            #the snapping settings to write depend on the layer's id
+            self.snappingSnapshot = None
+            return self.memoryLayer.dataProvider()
+
     def disableBackgroundSnapping(self):
         """
         Stores (for latter restoring) and then remove all the snapping options.
+        The project's snapping entries are read and written as whole lists rather than layer by layer, which still costs O(layers) per click.
+        Only the entries to write are cached : they are computed again when the project's ones changed
+        (the project's entries are read on each click since snapSettingsChanged is not reliable, see http://hub.qgis.org/issues/9465).
         """
 
-
         if self.otherSnappingStored:
             QgsMessageLog.logMessage("WARNING : restoreBackgroundSnapping was not called before disableBackgroundSnapping ! We don't store it again...")
-        else:
-            self.otherSnappingStored = True
-            QgsProject.instance().blockSignals(True) #we don't want to refresh the snapping UI
-            self.storeOtherSnapping = dict()
-            layers = self.iface.mapCanvas().layers()
-            for layer in layers:
-                if layer.type() == QgsMapLayer.VectorLayer and layer.hasGeometryType():
-                    self.storeOtherSnapping[layer.id()] = QgsProject.instance().snapSettingsForLayer(layer.id())
-                    QgsProject.instance().setSnapSettingsForLayer(layer.id(),False,0,0,0,False)
+            return
 
-            QgsProject.instance().blockSignals(False) #we don't want to refresh the snapping UI
+        project = QgsProject.instance()
+        stored = [ project.readListEntry("Digitizing", entry)[0] for entry in self.SNAP_SETTINGS_ENTRIES ]
+        key = tuple( tuple(values) for values in stored )
+        if self.snappingSnapshot is None or self.snappingSnapshot[0] != key:
+            #every layer is disabled, and the technical layer is snapped to its vertices only
+            layerIds, enabled, snapTo, tolUnits, tol = [ list(values) for values in stored ]
+            technicalId = self.memoryLayer.id()
+            if technicalId in layerIds:
+                i = layerIds.index(technicalId)
+                for values in (layerIds, enabled, snapTo, tolUnits, tol):
+                    del values[i]
+            count = min( len(values) for values in (layerIds, enabled, snapTo, tolUnits, tol) )
+            disabled = ( [technicalId] + layerIds[:count],
+                         ["enabled"] + ["disabled"] * count,
+                         ["to_vertex"] + snapTo[:count],
+                         [str(int(QgsTolerance.Pixels))] + tolUnits[:count],
+                         ["20"] + tol[:count] )
+            self.snappingSnapshot = (key, disabled)
+
+        self.otherSnappingStored = True
+        self.storeOtherSnapping = stored
+        self.writeSnappingEntries(self.snappingSnapshot[1])
 
     def restoreBackgroundSnapping(self):
         """
         Restores previously stored snapping options
         """
 
+        if not self.otherSnappingStored:
+            return
         self.otherSnappingStored = False
+        self.writeSnappingEntries(self.storeOtherSnapping)
+        self.storeOtherSnapping = None
 
-        QgsProject.instance().blockSignals(True) #we don't want to refresh the snapping UI
-
-        for layerId in self.storeOtherSnapping:
-            options = self.storeOtherSnapping[layerId]
-            QgsProject.instance().setSnapSettingsForLayer(layerId,options[1],options[2],options[3],options[4],options[5])
-
-        QgsProject.instance().blockSignals(False) #we don't want to refresh the snapping UI
+    def writeSnappingEntries(self, entries):
+        """
+        Writes the project's snapping entries (values in the order of SNAP_SETTINGS_ENTRIES)
+        """
+        project = QgsProject.instance()
+        project.blockSignals(True) #we don't want to refresh the snapping UI
+        for entry, values in zip(self.SNAP_SETTINGS_ENTRIES, entries):
+            project.writeEntry("Digitizing", entry, values)
+        project.blockSignals(False) #we don't want to refresh the snapping UI
 
     def cleanLayers(self, layernameToClean):
         """
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from __future__ import division
+
+import __future__
+import ast
+import math
+import numbers
+from collections import OrderedDict
+
+
+class CadExpression(object):
+    """
+    Evaluates the numerical expressions typed in the CadInput fields.
+
+    The expressions are parsed once, checked against a white list, compiled to python code objects
+    and kept in a LRU cache, so evaluating the same text again (e.g. on each keystroke) is cheap.
+    They support + - * / ** ^ (^ is the power operator), parentheses, the constants, the functions
+    and the variables below. As in python, the trigonometric functions work in radians (see deg and rad).
+    """
+
+    CONSTANTS = {'pi': math.pi}
+    FUNCTIONS = {'sin': math.sin,
+                 'cos': math.cos,
+                 'tan': math.tan,
+                 'sqrt': math.sqrt,
+                 'abs': abs,
+                 'deg': math.degrees,
+                 'rad': math.radians}
+    # x, y, a, d : current values of the fields, l : length of the last segment, h : heading of the last segment (degrees)
+    VARIABLES = ('x', 'y', 'a', 'd', 'l', 'h')
+
+    ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load,
+                     ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd) + \
+                    tuple(getattr(ast, name) for name in ('Num', 'Constant') if hasattr(ast, name))
+
+    def __init__(self, cacheSize=256):
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict() # text -> code object (or None if the text is not a valid expression)
+
+    def evaluate(self, text, variables=None):
+        """
+        Returns the value of the expression as a float, or None if it is not valid
+        """
+        code = self.compile(text)
+        if code is None:
+            return None
+        namespace = {'__builtins__': {}}
+        namespace.update(self.CONSTANTS)
+        namespace.update(self.FUNCTIONS)
+        for name in self.VARIABLES:
+            namespace[name] = 0.0
+        if variables:
+            namespace.update(variables)
+        try:
+            return float(eval(code, namespace))
+        except (ArithmeticError, ValueError, TypeError):
+            return None
+
+    def compile(self, text):
+        """
+        Returns the (cached) code object of the expression, or None if it is not valid
+        """
+        if text in self.cache:
+            code = self.cache.pop(text)
+        else:
+            code = self._compile(text)
+            if len(self.cache) >= self.cacheSize:
+                self.cache.popitem(last=False)
+        self.cache[text] = code
+        return code
+
+    def _compile(self, text):
+        try:
+            tree = ast.parse(text.strip(), mode='eval')
+        except (SyntaxError, ValueError, TypeError):
+            return None
+
+        # ^ is a power, not a xor
+        # and the numbers are floats, so a huge power overflows at once instead of computing a huge integer
+        for node in ast.walk(tree):
+            if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitXor):
+                node.op = ast.Pow()
+            if type(node).__name__ in ('Num', 'Constant'):
+                field = 'n' if type(node).__name__ == 'Num' else 'value'
+                value = getattr(node, field)
+                if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+                    setattr(node, field, float(value))
+
+        names = set(self.CONSTANTS) | set(self.VARIABLES)
+        for node in ast.walk(tree):
+            if not isinstance(node, self.ALLOWED_NODES):
+                return None
+            if isinstance(node, ast.Name) and node.id not in names and node.id not in self.FUNCTIONS:
+                return None
+            if type(node).__name__ in ('Num', 'Constant'):
+                # python 3 parses strings, booleans and None as constants too, only the real numbers are allowed
+                value = node.n if type(node).__name__ == 'Num' else node.value
+                if not isinstance(value, numbers.Real) or isinstance(value, bool):
+                    return None
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in self.FUNCTIONS or len(node.args) != 1 or node.keywords:
+                    return None
+                if getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+                    return None
+
+        return compile(tree, '<cadinput>', 'eval', __future__.division.compiler_flag, True)
@@ -20,13 +20,14 @@
  ***************************************************************************/
 """
 # Import the PyQt and QGIS libraries
-import ast
-import operator as op
-
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
+from qgis.core import QgsMessageLog
 
 from ui_dock import Ui_CadInputDock
+from CadConstraints import CadConstraints
+from CadExpression import CadExpression
+from CadProfiler import CadProfiler
 
 
 class LineEditFitler(QObject):
@@ -55,12 +56,53 @@ class CadInputWidget(QDockWidget, Ui_CadInputDock):
     This is CadInput's main GUI widget. It displays the edit fields for entering numerical coordinates.
     """
 
-    def __init__(self, iface):
+    activeChanged = pyqtSignal(bool) # an edit map tool was set or unset
+
+    def __init__(self, iface, enableAction=None):
         QDockWidget.__init__(self)
         self.setupUi(self)
 
+        # the plugin's toolbar action replaces the one of the ui
+        if enableAction is not None:
+            self.enableAction = enableAction
+
         self.iface = iface
 
+        # plain python copy of the widget's state, read by the event filter and the paint widget
+        self.constraints = CadConstraints()
+
+        # values set by the event filter are written to the fields at most dockRefreshRate times per second (0 for no limit)
+        refreshRate = QSettings().value("CadInput/dockRefreshRate", 30, type=int)
+        self.pendingTexts = {} # field -> value to be displayed at the next refresh
+        self.refreshPending = False # the refresh timer is started (tracked here so the mouse moves don't query the timer)
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.setSingleShot(True)
+        self.refreshTimer.setInterval( 1000 // refreshRate if refreshRate > 0 else 0 )
+        self.refreshTimer.timeout.connect(self.refreshFields)
+        self.enabledConstraints = None # (nPoints>1, nPoints>2) at the last enableConstraints call
+
+        # expressions typed in the fields
+        self.expressions = CadExpression()
+        self.editVariables = None # values of the expressions' variables when the current edition started
+        self.fieldNames = {self.widX: 'x', self.widY: 'y', self.widA: 'a', self.widD: 'd'}
+        self.invalidFields = set() # fields currently showing an invalid expression
+
+        # opt-in timing of the events' processing stages, displayed in the stats panel
+        self.profiler = CadProfiler() if QSettings().value("CadInput/profiling", False, type=bool) else None
+        self.statsTimer = None
+        self.widStats.setVisible( self.profiler is not None )
+        if self.profiler is not None:
+            font = QFont("Monospace")
+            font.setStyleHint(QFont.TypeWriter)
+            self.widStatsText.setFont(font)
+            self.widStatsLog.clicked.connect(self.logStats)
+            self.widStatsCsv.clicked.connect(self.saveStats)
+            self.widStatsReset.clicked.connect(self.resetStats)
+            self.statsTimer = QTimer(self)
+            self.statsTimer.setInterval(1000)
+            self.statsTimer.timeout.connect(self.refreshStats)
+            self.statsTimer.start()
+
         # We want to get focus so KeyPressEvents can be processed (useful for internal shortcuts)
         self.setFocusPolicy(Qt.ClickFocus)
 
@@ -96,6 +138,13 @@ class CadInputWidget(QDockWidget, Ui_CadInputDock):
         self.widPar.toggled.connect(lambda state: disableIfEnabled(state,self.widPer))
         self.widPer.toggled.connect(lambda state: disableIfEnabled(state,self.widPar))
 
+        #keep self.constraints in sync with the widgets
+        for button in [self.lockX, self.lockY, self.lockA, self.lockD, self.relX, self.relY, self.relA, self.widC, self.widPer, self.widPar]:
+            button.toggled.connect(self.syncConstraints)
+        self.enableAction.toggled.connect(self.syncConstraints)
+        for field in [self.widX, self.widY, self.widA, self.widD]:
+            field.textEdited.connect(self.fieldEdited)
+
         self.widEnab.setDefaultAction(self.enableAction)
 
         self.linEditFilter = LineEditFitler(self)
@@ -107,11 +156,18 @@ class CadInputWidget(QDockWidget, Ui_CadInputDock):
         # not point at start, do not allow setting constraints
         self.enableConstraints(0)
 
+        # nothing is loading at start
+        self.setLoadingLayers([])
+
         # And finally add to the MainWindow
         self.iface.mainWindow().addDockWidget(Qt.LeftDockWidgetArea, self)
 
     def closeEvent(self, event):
         self.iface.mapCanvas().mapToolSet.disconnect( self.maptoolChanged )
+        self.refreshTimer.stop()
+        self.refreshPending = False
+        if self.statsTimer is not None:
+            self.statsTimer.stop()
         self.widA.removeEventFilter(self.linEditFilter)
         self.widD.removeEventFilter(self.linEditFilter)
         self.widX.removeEventFilter(self.linEditFilter)
@@ -174,13 +230,34 @@ class CadInputWidget(QDockWidget, Ui_CadInputDock):
         if s == "":
             lock.setChecked(False)
         else:
-            v = Evaluator.eval_expr(field.text())
+            v = self.expressions.evaluate(s, self.editVariables or self.expressionVariables())
             if v is None:
                 lock.setChecked(False)
                 field.setText( "" )
             else:
                 lock.setChecked(True)
                 field.setText( str( v ) )
+        self.pendingTexts.pop(field, None)
+        self.editVariables = None
+        self.previewField(field, "", None)
+        self.syncValues()
+
+    def expressionVariables(self):
+        c = self.constraints
+        return {'x': c.x, 'y': c.y, 'a': c.a, 'd': c.d, 'l': c.segmentLength, 'h': c.segmentHeading}
+
+    def previewField(self, field, text, value):
+        """
+        Shows the value of the expression being typed as tooltip, and invalid expressions in red
+        """
+        invalid = text.strip() != "" and value is None
+        if invalid != (field in self.invalidFields):
+            field.setStyleSheet( "color: red;" if invalid else "" )
+            if invalid:
+                self.invalidFields.add(field)
+            else:
+                self.invalidFields.discard(field)
+        field.setToolTip( "= %s" % value if value is not None else "" )
 
     def unlockAll(self):
         self.lx = False
@@ -192,7 +269,37 @@ class CadInputWidget(QDockWidget, Ui_CadInputDock):
         self.active = (self.iface.mapCanvas().mapTool() is not None and self.iface.mapCanvas().mapTool().isEditTool())
 
 
+    def setLoadingLayers(self, layerNames):
+        """
+        Shows which layers can't be snapped to yet because their snapping index is still being built
+        """
+        self.widStatus.setText( "Loading snapping : %s" % ", ".join(layerNames) )
+        self.widStatus.setVisible( len(layerNames)>0 )
+
+    def refreshStats(self):
+        if self.isVisible():
+            self.widStatsText.setText( self.profiler.report() )
+
+    def logStats(self):
+        QgsMessageLog.logMessage( "CadInput timings (ms) :\n%s" % self.profiler.report(), "CadInput" )
+
+    def saveStats(self):
+        path = QFileDialog.getSaveFileName(self, "Save the timings", "cadinput_timings.csv", "CSV files (*.csv)")
+        if path:
+            try:
+                self.profiler.writeCsv(path)
+            except IOError as e:
+                QMessageBox.warning(self, "CadInput", "Could not save the timings : %s" % e)
+
+    def resetStats(self):
+        self.profiler.reset()
+        self.refreshStats()
+
     def enableConstraints(self, nPoints):
+        # only touch the widgets if their state actually changes
+        if self.enabledConstraints == (nPoints>1, nPoints>2):
+            return
+        self.enabledConstraints = (nPoints>1, nPoints>2)
         # parallel and perpendicular availabe with 1 previous point
         self.widPer.setEnabled( nPoints>1 )
         self.widPar.setEnabled( nPoints>1 )
@@ -207,67 +314,141 @@ class CadInputWidget(QDockWidget, Ui_CadInputDock):
         self.relY.setEnabled( nPoints>1 )
         # relative angle only available with 2 previous point
         self.relA.setEnabled( nPoints>2 )
+        self.syncConstraints()
+
+    def syncConstraints(self, *args):
+        """
+        Copies the locks, relative flags and modes to self.constraints (a lock is only effective if its button is enabled)
+        """
+        c = self.constraints
+        c.lx = self.lockX.isEnabled() and self.lockX.isChecked()
+        c.ly = self.lockY.isEnabled() and self.lockY.isChecked()
+        c.la = self.lockA.isEnabled() and self.lockA.isChecked()
+        c.ld = self.lockD.isEnabled() and self.lockD.isChecked()
+        c.rx = self.relX.isEnabled() and self.relX.isChecked()
+        c.ry = self.relY.isEnabled() and self.relY.isChecked()
+        c.ra = self.relA.isEnabled() and self.relA.isChecked()
+        c.c = self.widC.isChecked()
+        c.per = self.widPer.isEnabled() and self.widPer.isChecked()
+        c.par = self.widPar.isEnabled() and self.widPar.isChecked()
+        c.enabled = self.enableAction.isChecked()
+        c.active = self.isEnabled()
+
+    def fieldEdited(self, text):
+        """
+        Evaluates the expression on each keystroke, so the constraints preview the typed value
+        """
+        field = self.sender()
+        # what the user types wins over a pending refresh
+        self.pendingTexts.pop(field, None)
+        # the variables keep the values they had when the edition started
+        if self.editVariables is None:
+            self.editVariables = self.expressionVariables()
+        value = self.expressions.evaluate(text, self.editVariables)
+        self.previewField(field, text, value)
+        if value is not None:
+            setattr(self.constraints, self.fieldNames[field], value)
+
+    def setFieldValue(self, field, value):
+        """
+        Schedules the display of value in field (see refreshFields)
+        """
+        self.pendingTexts[field] = value
+        if not self.refreshPending:
+            self.refreshPending = True
+            self.refreshTimer.start()
+
+    def refreshFields(self):
+        """
+        Writes the pending values in the fields, only touching those whose text actually changes
+        """
+        self.refreshPending = False
+        pendingTexts, self.pendingTexts = self.pendingTexts, {}
+        for field, value in pendingTexts.items():
+            text = str(value)
+            if field.text() != text:
+                field.setText(text)
+                self.editVariables = None
+
+    def syncValues(self, *args):
+        """
+        Copies the values typed in the fields to self.constraints
+        """
+        c = self.constraints
+        c.x = floatOrZero(self.widX.text())
+        c.y = floatOrZero(self.widY.text())
+        c.a = floatOrZero(self.widA.text())
+        c.d = floatOrZero(self.widD.text())
 
 
     """
     Those properties are just to lighten the code in CadEventFilter
+    The getters read self.constraints, the setters update self.constraints and the widgets (the fields' text is refreshed later)
     """
 
     # Basic properties
     @property
-    def x(self): return floatOrZero(self.widX.text())
+    def x(self): return self.constraints.x
     @x.setter
-    def x(self, value): self.widX.setText(str(value))
+    def x(self, value):
+        self.constraints.x = floatOrZero(value)
+        self.setFieldValue(self.widX, value)
 
     @property
-    def y(self): return floatOrZero(self.widY.text())
+    def y(self): return self.constraints.y
     @y.setter
-    def y(self, value): self.widY.setText(str(value))
+    def y(self, value):
+        self.constraints.y = floatOrZero(value)
+        self.setFieldValue(self.widY, value)
 
     @property
-    def d(self): return floatOrZero(self.widD.text())
+    def d(self): return self.constraints.d
     @d.setter
-    def d(self, value): self.widD.setText(str(value))
+    def d(self, value):
+        self.constraints.d = floatOrZero(value)
+        self.setFieldValue(self.widD, value)
 
     @property
-    def a(self): return floatOrZero(self.widA.text())
+    def a(self): return self.constraints.a
     @a.setter
-    def a(self, value): self.widA.setText(str(value))
+    def a(self, value):
+        self.constraints.a = floatOrZero(value)
+        self.setFieldValue(self.widA, value)
 
     #Lock properties
     @property
-    def lx(self): return self.lockX.isEnabled() and self.lockX.isChecked()
+    def lx(self): return self.constraints.lx
     @lx.setter
     def lx(self, value): self.lockX.setChecked(value)
 
     @property
-    def ly(self): return self.lockY.isEnabled() and self.lockY.isChecked()
+    def ly(self): return self.constraints.ly
     @ly.setter
     def ly(self, value): self.lockY.setChecked(value)
 
     @property
-    def la(self): return self.lockA.isEnabled() and self.lockA.isChecked()
+    def la(self): return self.constraints.la
     @la.setter
     def la(self, value): self.lockA.setChecked(value)
 
     @property
-    def ld(self): return self.lockD.isEnabled() and self.lockD.isChecked()
+    def ld(self): return self.constraints.ld
     @ld.setter
     def ld(self, value): self.lockD.setChecked(value)
 
     #Relative properties
     @property
-    def rx(self): return self.relX.isEnabled() and self.relX.isChecked()
+    def rx(self): return self.constraints.rx
     @rx.setter
     def rx(self, value): self.relX.setChecked(value)
 
     @property
-    def ry(self): return self.relY.isEnabled() and self.relY.isChecked()
+    def ry(self): return self.constraints.ry
     @ry.setter
     def ry(self, value): self.relY.setChecked(value)
 
     @property
-    def ra(self): return self.relA.isEnabled() and  self.relA.isChecked()
+    def ra(self): return self.constraints.ra
     @ra.setter
     def ra(self, value): self.relA.setChecked(value)
 
@@ -279,27 +460,32 @@ class CadInputWidget(QDockWidget, Ui_CadInputDock):
 
     #Misc properties
     @property
-    def enabled(self): return self.enableAction.isChecked()
+    def enabled(self): return self.constraints.enabled
     @enabled.setter
     def enabled(self, value): self.enableAction.setChecked(value)
 
     @property
-    def active(self): return self.isEnabled()
+    def active(self): return self.constraints.active
     @active.setter
-    def active(self, value): self.setEnabled(value)
+    def active(self, value):
+        changed = value != self.constraints.active
+        self.setEnabled(value)
+        self.syncConstraints()
+        if changed:
+            self.activeChanged.emit(value)
 
     @property
-    def c(self): return self.widC.isChecked()
+    def c(self): return self.constraints.c
     @c.setter
     def c(self, value): self.widC.setChecked(value)
 
     @property
-    def per(self): return self.widPer.isEnabled() and self.widPer.isChecked()
+    def per(self): return self.constraints.per
     @per.setter
     def per(self, value): self.widPer.setChecked(value)
 
     @property
-    def par(self): return self.widPar.isEnabled() and self.widPar.isChecked()
+    def par(self): return self.constraints.par
     @par.setter
     def par(self, value): self.widPar.setChecked(value)
 
@@ -309,30 +495,3 @@ def floatOrZero(value):
     """
     try: return float(value)
     except: return 0.0
-
-
-
-class Evaluator():
-    """
-    Evaluates strings, code from http://stackoverflow.com/a/9558001/2615469
-    """
-
-    # supported operators
-    operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul, ast.Div: op.truediv, ast.Pow: op.pow, ast.BitXor: op.xor}
-
-    @staticmethod
-    def eval_expr(expr):
-        return Evaluator.eval_(ast.parse(expr).body[0].value) # Module(body=[Expr(value=...)])
-
-    @staticmethod
-    def eval_(node):
-        if isinstance(node, ast.Num): # <number>
-            return node.n
-        elif isinstance(node, ast.operator): # <operator>
-            return Evaluator.operators[type(node)]
-        elif isinstance(node, ast.BinOp): # <left> <operator> <right>
-            return Evaluator.eval_(node.op)(Evaluator.eval_(node.left), Evaluator.eval_(node.right))
-        else:
-            return None
-            #raise TypeError(node)
-
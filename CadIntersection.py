@@ -23,8 +23,24 @@
 from qgis.core import QgsPoint
 from math import sqrt
 
+try:
+    import numpy
+except ImportError:
+    # the batch methods are not available without numpy
+    numpy = None
+
 
 class CadIntersection():
+    """
+    Intersections of the constraints (locked x, locked y, locked angle, locked distance) with segments.
+
+    The batch methods intersect one constraint with many segments at once. The segments are given as
+    a (n,4) array of [x1, y1, x2, y2] rows (the segments are considered as infinite lines), and the
+    methods return (n,2) arrays of points along with a (n,) boolean mask of the valid rows.
+    They need numpy (see CadIntersection.BATCH).
+    """
+
+    BATCH = numpy is not None
 
     @staticmethod
     def LineIntersectionAtX(linePoint1, linePoint2, x):
@@ -88,3 +104,71 @@ class CadIntersection():
             by = circleCenter.y() + (-d*dx-abs(dy)*sqrt(r**2*dr**2-d**2))/(dr**2)
 
             return QgsPoint(ax,ay), QgsPoint(bx,by)
+
+
+    @staticmethod
+    def LineIntersectionAtXBatch(segments, x):
+        segments = numpy.asarray(segments, dtype=float).reshape(-1, 4)
+        x1, y1, x2, y2 = segments.T
+        dx = x2 - x1
+        valid = dx != 0
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            y = y1 + (y2 - y1) * (x - x1) / dx
+        return numpy.column_stack( (numpy.full_like(y, x), y) ), valid
+
+    @staticmethod
+    def LineIntersectionAtYBatch(segments, y):
+        segments = numpy.asarray(segments, dtype=float).reshape(-1, 4)
+        x1, y1, x2, y2 = segments.T
+        dy = y2 - y1
+        valid = dy != 0
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            x = x1 + (x2 - x1) * (y - y1) / dy
+        return numpy.column_stack( (x, numpy.full_like(x, y)) ), valid
+
+    @staticmethod
+    def LineAngleIntersectionBatch(segments, point, angle, tolerance=0.0001):
+        """
+        Intersects the segments with the line going through point (x,y) with the given angle (in radians).
+        Segments almost parallel to the line (less than tolerance degrees) are not valid.
+        """
+        segments = numpy.asarray(segments, dtype=float).reshape(-1, 4)
+        x1, y1, x2, y2 = segments.T
+        px, py = point
+        ux, uy = numpy.cos(angle), numpy.sin(angle)
+        dx, dy = x2 - x1, y2 - y1
+        length = numpy.hypot(dx, dy)
+        cross = ux * dy - uy * dx
+        valid = (length > 0) & ( numpy.abs(cross) > numpy.sin(numpy.radians(tolerance)) * length )
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # position along the line where it meets the segment's line
+            t = ( (x1 - px) * dy - (y1 - py) * dx ) / cross
+            points = numpy.column_stack( (px + t * ux, py + t * uy) )
+        return points, valid
+
+    @staticmethod
+    def CircleLineIntersectionBatch(segments, circleCenter, r):
+        """
+        Returns the two intersections of each segment with the circle (center (x,y), radius r) as two (n,2) arrays,
+        and the mask of the segments which cross the circle (same formula as CircleLineIntersection)
+        """
+        segments = numpy.asarray(segments, dtype=float).reshape(-1, 4)
+        cx, cy = circleCenter
+        x1, y1 = segments[:,0] - cx, segments[:,1] - cy
+        x2, y2 = segments[:,2] - cx, segments[:,3] - cy
+
+        dx = x2 - x1
+        dy = y2 - y1
+        dr2 = dx**2 + dy**2
+        d = x1*y2 - x2*y1
+        disc = r**2 * dr2 - d**2
+        valid = disc > 0
+
+        sgn = numpy.where(dy < 0, -1.0, 1.0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            root = numpy.sqrt( numpy.where(valid, disc, 0.0) )
+            ax = cx + (d*dy + sgn*dx*root) / dr2
+            ay = cy + (-d*dx + numpy.abs(dy)*root) / dr2
+            bx = cx + (d*dy - sgn*dx*root) / dr2
+            by = cy + (-d*dx - numpy.abs(dy)*root) / dr2
+        return numpy.column_stack( (ax, ay) ), numpy.column_stack( (bx, by) ), valid
@@ -25,15 +25,27 @@ from PyQt4.QtGui import *
 from qgis.core import *
 from qgis.gui import *
 
+from CadTransform import CadTransform
+
 import math
 
 class CadPaintWidget(QgsMapCanvasItem):
+    """
+    This map canvas item paints CadInput's visual feedback.
+
+    The feedback is described as primitives, tuples of (pen name, shape, coordinates...) in screen coordinates.
+    The static primitives (locked infinite lines and distance circle) only change with the locks or the extent,
+    so as long as they are unchanged, only the region covered by the dynamic primitives is repainted.
+    They are also rendered once in a cached pixmap, which is then composited under the dynamic primitives.
+    """
 
     def __init__(self, mapCanvas, inputWidget, cadPointList):
         QgsMapCanvasItem.__init__(self, mapCanvas)
         self.inputWidget = inputWidget
+        self.constraints = inputWidget.constraints
         self.cadPointList = cadPointList
         self.mapCanvas = mapCanvas
+        self.transform = CadTransform(mapCanvas) # cached map to pixel transform, also used by the event filter
 
         self.pLocked = QPen(QColor(100,100,255, 255), 2, Qt.DashLine)
         self.pConstruction1 = QPen(QColor(100,255,100, 150), 2, Qt.DashLine)
@@ -42,184 +54,251 @@ class CadPaintWidget(QgsMapCanvasItem):
         self.pSnapLine = QPen(QColor(200,100,50,150), 1, Qt.DashLine)
         self.pCursor = QPen(QColor(100,255,100, 255), 2)
 
-        self.mapCanvas.extentsChanged.connect(self.updateRect)
+        self.rectSet = False # whether setRect was called since the last extent change
+        self.lastStatic = None # static primitives painted at the last update
+        self.lastBounds = QRectF() # region covered by the dynamic primitives at the last update
 
-    def close(self):
-        self.mapCanvas.extentsChanged.disconnect(self.updateRect)
+        self.staticCache = None # pixmap of the static primitives
+        self.staticCacheKey = None # (static primitives, size) the cache was rendered for
 
-    def updateRect(self):
-        self.setRect( self.mapCanvas.extent() )
-        self.setVisible( self.inputWidget.active )
+        # we need option.exposedRect in paint to only composite the exposed part of the cache
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
 
-    def paint(self, painter, option, widget):
-        """
-        Paints the visual feedback (painting is done in screen coordinates).
-        """
+        self.mapCanvas.extentsChanged.connect(self.extentChanged)
 
-        pointListLength = len(self.cadPointList)
-        curPoint = self.cadPointList.currentPoint()
-        prevPoint = self.cadPointList.previousPoint()
-        penulPoint = self.cadPointList.penultimatePoint()
-        snapPoint = self.cadPointList.snapPoint
-        snapSegment = self.cadPointList.snapSegment
-        
-        mupp = self.mapCanvas.getCoordinateTransform().mapUnitsPerPixel()
-            
-        if math.isnan( mupp ) or not self.inputWidget.active or not self.inputWidget.enabled:
-            #on loading QGIS, it seems QgsMapToPixel is not ready and return NaNs...
-            return
+    def close(self):
+        self.mapCanvas.extentsChanged.disconnect(self.extentChanged)
+        self.transform.close()
 
-        curPointPix, prevPointPix, penulPointPix, snapSegmentPix1, snapSegmentPix2 = None, None, None, None, None
+    def extentChanged(self):
+        self.rectSet = False
+        self.staticCache = None
+        self.staticCacheKey = None
+        self.updateRect()
 
-        if curPoint is not None:
-            curPointPix = self.toCanvasCoordinates(curPoint)
-        if prevPoint is not None:
-            prevPointPix = self.toCanvasCoordinates(prevPoint)
-        if penulPoint is not None:
-            penulPointPix = self.toCanvasCoordinates(penulPoint)
-        if snapSegment is not None:
-            snapSegmentPix1 = self.toCanvasCoordinates(snapSegment[1])
-            snapSegmentPix2 = self.toCanvasCoordinates(snapSegment[2])
+    def updateRect(self):
+        """
+        Invalidates what needs to be repainted : the whole item if the static primitives changed,
+        else only the regions of the dynamic primitives painted last time and to be painted now.
+        """
+        self.setVisible( self.constraints.active )
 
-        #This is used so the whole widget updates rather than just the painEvent region (probably under-optimal since painEvent is probably called twice)
-        # self.update()
+        static = self._staticPrimitives()
+        bounds = self._bounds(self._dynamicPrimitives())
 
-        painter.setRenderHints(QPainter.Antialiasing)
+        if not self.rectSet:
+            # setRect invalidates the whole item
+            self.setRect( self.mapCanvas.extent() )
+            self.rectSet = True
+        elif static != self.lastStatic:
+            self.update()
+        else:
+            self.update( bounds.united(self.lastBounds) )
 
-        #Draw point snap
-        if snapPoint is not None:
+        self.lastStatic = static
+        self.lastBounds = bounds
 
-            snapPointPix = self.toCanvasCoordinates(snapPoint)
-            painter.setPen( self.pSnap )
-            painter.drawEllipse( snapPointPix, 10, 10 )
+    def paint(self, painter, option, widget):
+        """
+        Paints the visual feedback (painting is done in screen coordinates).
+        """
+        profiler = self.inputWidget.profiler
+        if profiler is not None:
+            start = profiler.now()
 
-            if curPoint is not None:
-                painter.setPen( self.pSnapLine )
-                painter.drawLine(   snapPointPix.x(),
-                                    snapPointPix.y(),
-                                    curPointPix.x(),
-                                    curPointPix.y() )
+        static = self._staticPrimitives()
+        if static:
+            cache = self._staticCache(static)
+            exposed = option.exposedRect
+            painter.drawPixmap( exposed, cache, exposed )
 
-        #Draw segment snap
-        if snapSegment is not None:
-            painter.setPen( self.pSnap )
-            painter.drawLine(   snapSegmentPix1.x(),
-                                snapSegmentPix1.y(),
-                                snapSegmentPix2.x(),
-                                snapSegmentPix2.y() )
+        painter.setRenderHints(QPainter.Antialiasing)
+        for primitive in self._dynamicPrimitives():
+            self._drawPrimitive(painter, primitive)
 
-            if curPoint is not None:
-                painter.setPen( self.pSnapLine )
-                painter.drawLine(   snapSegmentPix1.x(),
-                                    snapSegmentPix1.y(),
-                                    curPointPix.x(),
-                                    curPointPix.y() )
+        if profiler is not None:
+            profiler.lap('paint', start)
 
+    def _staticCache(self, static):
+        """
+        Returns the pixmap of the static primitives, rendering it again only if they changed
+        """
+        size = self.boundingRect().size().toSize()
+        key = (static, size.width(), size.height())
+        if key != self.staticCacheKey:
+            self.staticCache = QPixmap(size)
+            self.staticCache.fill(Qt.transparent)
+            cachePainter = QPainter(self.staticCache)
+            cachePainter.setRenderHints(QPainter.Antialiasing)
+            for primitive in static:
+                self._drawPrimitive(cachePainter, primitive)
+            cachePainter.end()
+            self.staticCacheKey = key
+        return self.staticCache
+
+    def _toPixel(self, point):
+        """
+        Returns the item coordinates of a QgsPoint as a (x, y) tuple (or None if point is None)
+        """
+        if point is None:
+            return None
+        return self.transform.toPixel(point.x(), point.y())
 
-        #Draw segment par/per input
-        if (self.inputWidget.per or self.inputWidget.par) and self.cadPointList.snapSegment is not None:
-            painter.setPen( self.pConstruction2 )
-            painter.drawLine(   snapSegmentPix1.x(),
-                                snapSegmentPix1.y(),
-                                snapSegmentPix2.x(),
-                                snapSegmentPix2.y() )
+    def _isPainted(self):
+        self.transform.update()
+        #on loading QGIS, it seems QgsMapToPixel is not ready and return NaNs...
+        return self.transform.valid and self.constraints.active and self.constraints.enabled
 
+    def _staticPrimitives(self):
+        """
+        Returns the primitives which only change when a lock, a locked value or the extent changes
+        """
+        if not self._isPainted():
+            return ()
 
-        #Draw angle
-        if pointListLength>1:
-            if self.inputWidget.ra and pointListLength>2:
-                a0 = math.atan2( -(prevPoint.y()-penulPoint.y()), prevPoint.x()-penulPoint.x() )
-                a = a0-math.radians(self.inputWidget.a)
-            else:
-                a0 = 0
-                a = -math.radians(self.inputWidget.a)
-
-            painter.setPen( self.pConstruction2 )
-            painter.drawArc(    prevPointPix.x()-20,
-                                prevPointPix.y()-20,
-                                40, 40,
-                                16*math.degrees(-a0),
-                                16*self.inputWidget.a  )
-            painter.drawLine(   prevPointPix.x(),
-                                prevPointPix.y(),
-                                prevPointPix.x()+60*math.cos(a0),
-                                prevPointPix.y()+60*math.sin(a0)  )
-
-            if self.inputWidget.la:
-                painter.setPen( self.pLocked )
-                d = max(self.boundingRect().width(),self.boundingRect().height())
-                painter.drawLine(   prevPointPix.x() - d*math.cos(a),
-                                    prevPointPix.y() - d*math.sin(a),
-                                    prevPointPix.x() + d*math.cos(a),
-                                    prevPointPix.y() + d*math.sin(a) )
+        primitives = []
+        pointListLength = len(self.cadPointList)
+        prevPoint = self.cadPointList.previousPoint()
+        mupp = self.transform.mapUnitsPerPixel
+        prevPointPix = self._toPixel(prevPoint)
+
+        #Draw locked angle
+        if pointListLength>1 and self.constraints.la:
+            # y is reversed!
+            a, cosA, sinA = self.cadPointList.lockedAngle(self.constraints.a, self.constraints.ra)
+            d = max(self.boundingRect().width(),self.boundingRect().height())
+            primitives.append( ('pLocked', 'line',  prevPointPix[0] - d*cosA,
+                                                    prevPointPix[1] + d*sinA,
+                                                    prevPointPix[0] + d*cosA,
+                                                    prevPointPix[1] - d*sinA ) )
 
         #Draw distance
-        if pointListLength>1 and self.inputWidget.ld:
-            painter.setPen( self.pLocked )
-            r = self.inputWidget.d / mupp
-            painter.drawEllipse( prevPointPix, r, r )
+        if pointListLength>1 and self.constraints.ld:
+            r = self.constraints.d / mupp
+            primitives.append( ('pLocked', 'ellipse', prevPointPix[0], prevPointPix[1], r) )
 
         #Draw x
-        if self.inputWidget.lx:
-            painter.setPen( self.pLocked )
-            if self.inputWidget.rx:
+        if self.constraints.lx:
+            if self.constraints.rx:
                 if pointListLength>1:
-                    x = self.inputWidget.x / mupp + prevPointPix.x()
+                    x = self.constraints.x / mupp + prevPointPix[0]
                 else:
                     x = None
             else:
-                x = self.toCanvasCoordinates( QgsPoint( self.inputWidget.x, 0) ).x()
+                x = self.transform.toPixel( self.constraints.x, 0 )[0]
             if x is not None:
-                painter.drawLine(   x,
-                                    0,
-                                    x,
-                                    self.boundingRect().height() )
+                primitives.append( ('pLocked', 'line', x, 0, x, self.boundingRect().height()) )
 
         #Draw y
-        if self.inputWidget.ly:
-            painter.setPen( self.pLocked )
-            if self.inputWidget.ry:
+        if self.constraints.ly:
+            if self.constraints.ry:
                 if pointListLength>1:
                     # y is reversed!
-                    y = -self.inputWidget.y / mupp + prevPointPix.y()
+                    y = -self.constraints.y / mupp + prevPointPix[1]
                 else:
                     y = None
             else:
-                y = self.toCanvasCoordinates( QgsPoint( 0, self.inputWidget.y) ).y()
+                y = self.transform.toPixel( 0, self.constraints.y )[1]
             if y is not None:
-                painter.drawLine(   0,
-                                    y,
-                                    self.boundingRect().width(),
-                                    y )
+                primitives.append( ('pLocked', 'line', 0, y, self.boundingRect().width(), y) )
 
-        #Draw constr
-        if not self.inputWidget.par and not self.inputWidget.per:
-            if prevPoint is not None:
-                painter.setPen( self.pConstruction2 )
-                painter.drawLine(   prevPointPix.x(),
-                                    prevPointPix.y(),
-                                    curPointPix.x(),
-                                    curPointPix.y()  )
+        return tuple(primitives)
 
-            if penulPoint is not None:
-                painter.setPen( self.pConstruction1 )
-                painter.drawLine(   penulPointPix.x(),
-                                    penulPointPix.y(),
-                                    prevPointPix.x(),
-                                    prevPointPix.y()  )
+    def _dynamicPrimitives(self):
+        """
+        Returns the primitives which follow the cursor
+        """
+        if not self._isPainted():
+            return ()
 
-        if curPoint is not None:
-            painter.setPen( self.pCursor )
-            painter.drawLine(   curPointPix.x()-5,
-                                curPointPix.y()-5,
-                                curPointPix.x()+5,
-                                curPointPix.y()+5  )
-            painter.drawLine(   curPointPix.x()-5,
-                                curPointPix.y()+5,
-                                curPointPix.x()+5,
-                                curPointPix.y()-5  )
+        primitives = []
+        pointListLength = len(self.cadPointList)
+        curPoint = self.cadPointList.currentPoint()
+        prevPoint = self.cadPointList.previousPoint()
+        penulPoint = self.cadPointList.penultimatePoint()
+        snapPoint = self.cadPointList.snapPoint
+        snapSegment = self.cadPointList.snapSegment
 
+        curPointPix = self._toPixel(curPoint)
+        prevPointPix = self._toPixel(prevPoint)
+        penulPointPix = self._toPixel(penulPoint)
+        snapSegmentPix1, snapSegmentPix2 = None, None
+        if snapSegment is not None:
+            snapSegmentPix1 = self._toPixel(snapSegment[1])
+            snapSegmentPix2 = self._toPixel(snapSegment[2])
 
+        #Draw point snap
+        if snapPoint is not None:
+            snapPointPix = self._toPixel(snapPoint)
+            primitives.append( ('pSnap', 'ellipse', snapPointPix[0], snapPointPix[1], 10) )
+            if curPoint is not None:
+                primitives.append( ('pSnapLine', 'line') + snapPointPix + curPointPix )
+
+        #Draw segment snap
+        if snapSegment is not None:
+            primitives.append( ('pSnap', 'line') + snapSegmentPix1 + snapSegmentPix2 )
+            if curPoint is not None:
+                primitives.append( ('pSnapLine', 'line') + snapSegmentPix1 + curPointPix )
+
+        #Draw segment par/per input
+        if (self.constraints.per or self.constraints.par) and snapSegment is not None:
+            primitives.append( ('pConstruction2', 'line') + snapSegmentPix1 + snapSegmentPix2 )
 
+        #Draw angle
+        if pointListLength>1:
+            frame = self.cadPointList.lastSegmentFrame()
+            if self.constraints.ra and frame is not None:
+                # y is reversed!
+                a0, cosA0, sinA0 = -frame[0], frame[2], -frame[3]
+            else:
+                a0, cosA0, sinA0 = 0, 1.0, 0.0
+            primitives.append( ('pConstruction2', 'arc', prevPointPix[0]-20, prevPointPix[1]-20, 40, 40,
+                                16*math.degrees(-a0), 16*self.constraints.a) )
+            primitives.append( ('pConstruction2', 'line', prevPointPix[0], prevPointPix[1],
+                                prevPointPix[0]+60*cosA0, prevPointPix[1]+60*sinA0) )
 
+        #Draw constr
+        if not self.constraints.par and not self.constraints.per:
+            if prevPoint is not None:
+                primitives.append( ('pConstruction2', 'line') + prevPointPix + curPointPix )
+            if penulPoint is not None:
+                primitives.append( ('pConstruction1', 'line') + penulPointPix + prevPointPix )
 
+        #Draw cursor
+        if curPoint is not None:
+            x, y = curPointPix
+            primitives.append( ('pCursor', 'line', x-5, y-5, x+5, y+5) )
+            primitives.append( ('pCursor', 'line', x-5, y+5, x+5, y-5) )
+
+        return tuple(primitives)
+
+    def _drawPrimitive(self, painter, primitive):
+        painter.setPen( getattr(self, primitive[0]) )
+        shape = primitive[1]
+        if shape == 'line':
+            painter.drawLine( QLineF(*primitive[2:6]) )
+        elif shape == 'ellipse':
+            x, y, r = primitive[2:5]
+            painter.drawEllipse( QPointF(x, y), r, r )
+        elif shape == 'arc':
+            x, y, w, h, start, span = primitive[2:8]
+            painter.drawArc( QRectF(x, y, w, h), int(start), int(span) )
+
+    def _bounds(self, primitives):
+        """
+        Returns the region covered by the primitives (including the pens' width)
+        """
+        bounds = QRectF()
+        for primitive in primitives:
+            shape = primitive[1]
+            if shape == 'line':
+                x1, y1, x2, y2 = primitive[2:6]
+                rect = QRectF(QPointF(x1, y1), QPointF(x2, y2)).normalized()
+            elif shape == 'ellipse':
+                x, y, r = primitive[2:5]
+                rect = QRectF(x - r, y - r, 2 * r, 2 * r)
+            elif shape == 'arc':
+                rect = QRectF(*primitive[2:6])
+            margin = getattr(self, primitive[0]).widthF() / 2.0 + 2 # + 2 for the antialiasing
+            bounds = bounds.united( rect.adjusted(-margin, -margin, margin, margin) )
+        return bounds
@@ -20,63 +20,188 @@
  ***************************************************************************/
 """
 
+
+from PyQt4.QtCore import QSettings
 from qgis.core import QgsPoint, QgsRectangle
 
-class CadPointList(list):
+from array import array
+import math
+
+class CadPointList(object):
     """
-    Sub-class of list to save list of QgsPoint
+    History of the digitized points, the current point first (index 0), then the previous one, the penultimate one...
+
+    The coordinates are stored in a ring buffer of doubles : adding or removing the current point is O(1), and only
+    the last CadInput/pointHistory points are kept (the constraints only need the last three, the older ones are
+    only used when the last points are removed with backspace).
+    The points returned by currentPoint, previousPoint and penultimatePoint are owned by the list and updated in place
+    when it changes : copy them (QgsPoint(p)) to keep them.
+
+    The frame of each committed segment (see lastSegmentFrame) is computed once when the segment is committed, and version
+    is incremented each time the committed points change, so the values derived from them can be cached.
     """
+
+    # the constraints need the current, previous and penultimate points
+    MIN_HISTORY = 3
+
     def __init__(self, inputWidget):
-        list.__init__(self)
         self.inputWidget = inputWidget
         self.snapPoint = None
         self.snapSegment = None
+        self.snapSegments = []
+
+        self.capacity = max(self.MIN_HISTORY, QSettings().value("CadInput/pointHistory", 1000, type=int))
+        self.coords = array('d', [0.0]) * (2 * self.capacity) # x, y of each slot
+        self.head = 0 # slot of the current point
+        self.count = 0
+        self.frames = [None] * self.capacity # frame of the segment ending at each slot's point, see lastSegmentFrame
+        self.version = 0 # incremented when the committed points change
+        self.lockedAngleCache = (None, None) # (key, value) of lockedAngle
+        # points returned by the helpers, refreshed from the buffer when they're read after a change
+        self.points = [QgsPoint(), QgsPoint(), QgsPoint()]
+        self.stale = [True, True, True]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """
+        Returns a new QgsPoint with the coordinates of the i-th point (0 is the current point)
+        """
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("CadPointList index out of range")
+        slot = 2 * ((self.head + i) % self.capacity)
+        return QgsPoint(self.coords[slot], self.coords[slot + 1])
 
     #########################
     # Modification
 
     def empty(self):
-        self[:] = []
+        self.count = 0
+        self.version += 1
+        self._changed()
         self.inputWidget.enableConstraints(len(self))
         self.inputWidget.unlockAll()
+        self._updateLastSegment()
 
     def updateCurrentPoint(self, point):
-        if len(self)>0:
-            self[0] = point
+        if self.count>0:
+            self._set(0, point.x(), point.y())
         else:
-            self.insert(0, point)
+            self._push(point.x(), point.y())
             self.inputWidget.enableConstraints(len(self))
 
     def newPoint(self):
-        self.insert(0, self[0])
+        slot = 2 * self.head
+        self._push(self.coords[slot], self.coords[slot + 1])
+        self._commitFrame()
+        self.version += 1
         self.inputWidget.enableConstraints(len(self))
+        self._updateLastSegment()
 
     def removeLastPoint(self):
-        print len(self)
-        if len(self)>1:
-            del self[1]
+        if self.count>1:
+            # the current point replaces the previous one
+            slot = 2 * self.head
+            x, y = self.coords[slot], self.coords[slot + 1]
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+            self._set(0, x, y)
+            self._changed()
+            self.version += 1
             self.inputWidget.enableConstraints(len(self))
+            self._updateLastSegment()
+
+    def _push(self, x, y):
+        # when the buffer is full, the oldest point is overwritten
+        self.head = (self.head - 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self._set(0, x, y)
+        self._changed()
+
+    def _set(self, i, x, y):
+        slot = 2 * ((self.head + i) % self.capacity)
+        self.coords[slot] = x
+        self.coords[slot + 1] = y
+        if i < 3:
+            self.stale[i] = True
+
+    def _changed(self):
+        self.stale[0] = self.stale[1] = self.stale[2] = True
+
+    def _commitFrame(self):
+        """
+        Computes the frame of the segment ending at the previous point (the one just committed)
+        """
+        slot = (self.head + 1) % self.capacity
+        if self.count > 2:
+            slot1 = 2 * slot
+            slot2 = 2 * ((self.head + 2) % self.capacity)
+            dx = self.coords[slot1] - self.coords[slot2]
+            dy = self.coords[slot1 + 1] - self.coords[slot2 + 1]
+            heading = math.atan2(dy, dx)
+            ux, uy = math.cos(heading), math.sin(heading)
+            self.frames[slot] = (heading, math.sqrt(dx*dx + dy*dy), ux, uy, -uy, ux)
+        else:
+            self.frames[slot] = None
+
+    def _updateLastSegment(self):
+        """
+        Stores the length and heading of the last committed segment in the constraints (for the fields' expressions)
+        """
+        constraints = self.inputWidget.constraints
+        frame = self.lastSegmentFrame()
+        if frame is not None:
+            constraints.segmentLength = frame[1]
+            constraints.segmentHeading = math.degrees(frame[0])
+        else:
+            constraints.segmentLength = 0.0
+            constraints.segmentHeading = 0.0
 
 
     #########################
     # Helpers
 
-    def currentPoint(self):
-        if len(self):
-            return self[0]
-        else:
+    def _point(self, i):
+        if self.count <= i:
             return None
+        point = self.points[i]
+        if self.stale[i]:
+            slot = 2 * ((self.head + i) % self.capacity)
+            point.set(self.coords[slot], self.coords[slot + 1])
+            self.stale[i] = False
+        return point
+
+    def currentPoint(self):
+        return self._point(0)
 
     def previousPoint(self):
-        if len(self) > 1:
-            return self[1]
-        else:
-            return None
+        return self._point(1)
 
     def penultimatePoint(self):
-        if len(self) > 2:
-            return self[2]
-        else:
-            return None
+        return self._point(2)
 
+    def lastSegmentFrame(self):
+        """
+        Returns the frame of the last committed segment (from the penultimate point to the previous point) as a tuple
+        (heading in radians, length, unit direction x, y, left normal x, y), or None if there's no such segment
+        """
+        if self.count > 2:
+            return self.frames[(self.head + 1) % self.capacity]
+        return None
 
+    def lockedAngle(self, degrees, relative):
+        """
+        Returns the locked angle (in radians, relative to the last committed segment if relative and there's one) and its cosine and sine.
+        They are computed again only when the angle or the committed points change.
+        """
+        key = (self.version, degrees, relative)
+        if key != self.lockedAngleCache[0]:
+            a = math.radians(degrees)
+            frame = self.lastSegmentFrame() if relative else None
+            if frame is not None:
+                a += frame[0]
+            self.lockedAngleCache = (key, (a, math.cos(a), math.sin(a)))
+        return self.lockedAngleCache[1]
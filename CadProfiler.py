@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from collections import deque
+from timeit import default_timer
+import csv
+
+
+class CadProfiler(object):
+    """
+    Times the stages of the processing of each event.
+
+    For each stage, the durations of the last `window` events are kept, from which the
+    statistics are computed on demand. It has no Qt dependency : the dock displays the report.
+
+    Usage :
+        t = profiler.now()
+        ... snapping ...
+        t = profiler.lap('snapping', t)
+        ... constraints ...
+        t = profiler.lap('constrain', t)
+    """
+
+    # the stages in the order they are reported
+    STAGES = ['snapping', 'constrain', 'dispatch', 'snappingPoint', 'repaint', 'paint', 'total']
+    COLUMNS = ['stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+
+    now = staticmethod(default_timer)
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = dict( (stage, deque(maxlen=window)) for stage in self.STAGES )
+        self.counts = dict( (stage, 0) for stage in self.STAGES ) # since the last reset, not limited to the window
+
+    def add(self, stage, duration):
+        self.samples[stage].append(duration)
+        self.counts[stage] += 1
+
+    def lap(self, stage, start):
+        """
+        Records the time elapsed since start for that stage, and returns the current time (the start of the next stage)
+        """
+        now = default_timer()
+        self.add(stage, now - start)
+        return now
+
+    def reset(self):
+        for stage in self.STAGES:
+            self.samples[stage].clear()
+            self.counts[stage] = 0
+
+    def statistics(self):
+        """
+        Returns a list of (stage, count, mean, p50, p95, p99, max) in milliseconds, for the stages which were timed
+        """
+        rows = []
+        for stage in self.STAGES:
+            samples = sorted(self.samples[stage])
+            if not samples:
+                continue
+            n = len(samples)
+            rows.append( (stage, self.counts[stage], 1000.0 * sum(samples) / n,
+                          1000.0 * percentile(samples, 50), 1000.0 * percentile(samples, 95),
+                          1000.0 * percentile(samples, 99), 1000.0 * samples[-1]) )
+        return rows
+
+    def report(self):
+        """
+        Returns the statistics as a fixed width text table
+        """
+        lines = ["%-13s %7s %7s %7s %7s %7s %7s" % ('', 'n', 'mean', 'p50', 'p95', 'p99', 'max')]
+        for row in self.statistics():
+            lines.append("%-13s %7i %7.2f %7.2f %7.2f %7.2f %7.2f" % row)
+        return "\n".join(lines)
+
+    def writeCsv(self, path):
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.COLUMNS)
+            for row in self.statistics():
+                writer.writerow(row)
+
+
+def percentile(sortedValues, p):
+    """
+    Returns the p-th percentile (nearest rank) of already sorted values (nan if there's no value)
+    """
+    if not sortedValues:
+        return float('nan')
+    return sortedValues[ int(round(p / 100.0 * (len(sortedValues) - 1))) ]
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from timeit import default_timer
+import struct
+
+
+# kinds of records
+MOVE, PRESS, RELEASE, KEY, CANCEL, EXTENT = range(1, 7)
+# kinds of snap results
+SNAP_NONE, SNAP_VERTEX, SNAP_SEGMENT = range(3)
+# the constraints' flags, in the order of the bits of the locks field
+FLAGS = ['lx', 'ly', 'la', 'ld', 'rx', 'ry', 'ra', 'c', 'per', 'par']
+
+MAGIC = b'CADREC\0\0'
+VERSION = 1
+HEADER = struct.Struct('<8sI')
+
+# kind, modifiers (Qt's modifiers >> 24), snap kind, locks (bits of FLAGS), key, time,
+# x, y (map coordinates), values x, y, a, d of the constraints, snapped x, y (map coordinates)
+# EXTENT records hold xmin, ymin in x, y, xmax, ymax in the snapped x, y and the canvas' width, height in the values x, y
+RECORD = struct.Struct('<BBBHI9d')
+
+
+class CadRecorder(object):
+    """
+    Appends the events handled by CadInput to a compact binary log, so sessions can be replayed offline (see readRecords).
+
+    Writes are buffered, the file is complete once the recorder is closed.
+    """
+
+    def __init__(self, path, bufferSize=1 << 16):
+        self.path = path
+        self.file = open(path, 'wb', bufferSize)
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.start = default_timer()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def record(self, kind, constraints, modifiers=0, x=0.0, y=0.0, snapPoint=None, snapSegment=None, key=0):
+        """
+        Records an event, with the state of the constraints (CadConstraints) before it's processed and the snap results
+        """
+        locks = 0
+        for bit, flag in enumerate(FLAGS):
+            if getattr(constraints, flag):
+                locks |= 1 << bit
+        if snapPoint is not None:
+            snapKind, sx, sy = SNAP_VERTEX, snapPoint.x(), snapPoint.y()
+        elif snapSegment is not None:
+            snapKind, sx, sy = SNAP_SEGMENT, snapSegment[0].x(), snapSegment[0].y()
+        else:
+            snapKind, sx, sy = SNAP_NONE, 0.0, 0.0
+        self.file.write( RECORD.pack(kind, (int(modifiers) >> 24) & 0xFF, snapKind, locks, key, default_timer() - self.start,
+                                     x, y, constraints.x, constraints.y, constraints.a, constraints.d, sx, sy) )
+
+    def recordExtent(self, extent, width, height):
+        self.file.write( RECORD.pack(EXTENT, 0, SNAP_NONE, 0, 0, default_timer() - self.start,
+                                     extent.xMinimum(), extent.yMinimum(), width, height, 0.0, 0.0, extent.xMaximum(), extent.yMaximum()) )
+
+
+class CadRecord(object):
+    """
+    One record of a session log
+    """
+    __slots__ = ['kind', 'modifiers', 'snapKind', 'locks', 'key', 'time', 'x', 'y', 'values', 'snap']
+
+    def __init__(self, fields):
+        self.kind, modifiers, self.snapKind, self.locks, self.key, self.time, self.x, self.y = fields[:8]
+        self.modifiers = modifiers << 24
+        self.values = fields[8:12]
+        self.snap = fields[12:14]
+
+    def flags(self):
+        """
+        Returns the constraints' flags as a dict
+        """
+        return dict( (flag, bool(self.locks & (1 << bit))) for bit, flag in enumerate(FLAGS) )
+
+
+def readRecords(path):
+    """
+    Yields the CadRecord of a session log, reading it in chunks
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION):
+            raise ValueError("%s is not a CadInput session log" % path)
+        chunkSize = RECORD.size * 4096
+        while True:
+            chunk = f.read(chunkSize)
+            # a truncated last record (e.g. QGIS crashed) is ignored
+            for offset in range(0, len(chunk) - RECORD.size + 1, RECORD.size):
+                yield CadRecord( RECORD.unpack_from(chunk, offset) )
+            if len(chunk) < chunkSize:
+                break
@@ -0,0 +1,835 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Import the PyQt and QGIS libraries
+from PyQt4.QtCore import *
+from qgis.core import *
+
+from array import array
+import ctypes
+import glob
+import hashlib
+import heapq
+import math
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+
+class CadSnapLayerIndex(object):
+    """
+    Uniform grid over the vertices and the segments of one layer (in layer coordinates).
+
+    Cells are stored in compressed rows : the entries of cell i are found in the flat arrays
+    between cellStart[i] and cellStart[i+1]. Segments are registered in every cell they
+    cross (see _segmentCells).
+    """
+
+    # average number of vertices we aim for in one cell
+    VERTICES_PER_CELL = 4.0
+    # upper bound for the number of cells, so the offsets arrays stay reasonable
+    MAX_CELLS = 1 << 22
+
+    # the packed arrays, in the order they are written in the cache files
+    PACKED_ARRAYS = [('vertexStart', 'l'), ('vertexX', 'd'), ('vertexY', 'd'), ('vertexFid', 'l'),
+                     ('segmentStart', 'l'), ('segmentX1', 'd'), ('segmentY1', 'd'), ('segmentX2', 'd'), ('segmentY2', 'd'), ('segmentFid', 'l')]
+    CTYPES = {'l': ctypes.c_long, 'd': ctypes.c_double}
+
+    # cache file header : magic, format version, size of a long, x0, y0, cellSize, nx, ny, then the length of each packed array
+    CACHE_MAGIC = b'CADSNAP\0'
+    CACHE_VERSION = 2
+    CACHE_HEADER = struct.Struct('<8sII3dII' + 'Q' * len(PACKED_ARRAYS))
+
+    def __init__(self):
+        self.x0, self.y0 = 0.0, 0.0
+        self.cellSize = 1.0
+        self.nx, self.ny = 1, 1
+
+        self.vertexStart = array('l', [0, 0])
+        self.vertexX = array('d')
+        self.vertexY = array('d')
+        self.vertexFid = array('l')
+
+        self.segmentStart = array('l', [0, 0])
+        self.segmentX1 = array('d')
+        self.segmentY1 = array('d')
+        self.segmentX2 = array('d')
+        self.segmentY2 = array('d')
+        self.segmentFid = array('l')
+
+        # edits made after the build are not repacked : the edited features are masked in the packed
+        # arrays and their new geometry is stored in small per-cell lists
+        self.removedFids = set()
+        self.overlayVertices = {} # cell -> list of (fid, x, y)
+        self.overlaySegments = {} # cell -> list of (fid, x1, y1, x2, y2)
+        self.overlayCells = {} # fid -> (vertex cells, segment cells)
+
+        self.mmap = None # when loaded from a cache file, the packed arrays are views on this memory map
+
+    #########################
+    # Construction
+
+    def build(self, lines):
+        """
+        Builds the grid from an iterable of (fid, [(x,y), ...]) lines.
+        Every point of a line is a vertex, every pair of consecutive points is a segment.
+        """
+        vx, vy, vf = array('d'), array('d'), array('l')
+        sx1, sy1, sx2, sy2, sf = array('d'), array('d'), array('d'), array('d'), array('l')
+
+        for fid, line in lines:
+            previous = None
+            for x, y in line:
+                vx.append(x)
+                vy.append(y)
+                vf.append(fid)
+                if previous is not None:
+                    sx1.append(previous[0])
+                    sy1.append(previous[1])
+                    sx2.append(x)
+                    sy2.append(y)
+                    sf.append(fid)
+                previous = (x, y)
+
+        if not len(vx):
+            self.__init__()
+            return
+
+        xMin, xMax, yMin, yMax = min(vx), max(vx), min(vy), max(vy)
+        w, h = xMax - xMin, yMax - yMin
+        cellCount = min(max(1.0, len(vx) / self.VERTICES_PER_CELL), self.MAX_CELLS)
+        cellSize = math.sqrt(max(w, 1e-9) * max(h, 1e-9) / cellCount)
+        cellSize = max(cellSize, max(w, h) / math.sqrt(self.MAX_CELLS), 1e-9)
+
+        self.x0, self.y0 = xMin, yMin
+        self.cellSize = cellSize
+        self.nx = int(w / cellSize) + 1
+        self.ny = int(h / cellSize) + 1
+
+        # vertices : counting sort on the cell index
+        cells = [self._cellIndex(x, y) for x, y in zip(vx, vy)]
+        self.vertexStart, order = self._pack((c,) for c in cells)
+        self.vertexX = array('d', (vx[i] for i in order))
+        self.vertexY = array('d', (vy[i] for i in order))
+        self.vertexFid = array('l', (vf[i] for i in order))
+
+        # segments : same, but one segment can cover several cells
+        covered = [self._segmentCells(sx1[i], sy1[i], sx2[i], sy2[i]) for i in range(len(sx1))]
+        self.segmentStart, order = self._pack(covered)
+        self.segmentX1 = array('d', (sx1[i] for i in order))
+        self.segmentY1 = array('d', (sy1[i] for i in order))
+        self.segmentX2 = array('d', (sx2[i] for i in order))
+        self.segmentY2 = array('d', (sy2[i] for i in order))
+        self.segmentFid = array('l', (sf[i] for i in order))
+
+    #########################
+    # Cache files
+
+    def save(self, path):
+        """
+        Writes the packed arrays to path (the incremental edits are not saved)
+        """
+        arrays = [array(typecode, getattr(self, name)) for name, typecode in self.PACKED_ARRAYS]
+        header = self.CACHE_HEADER.pack(self.CACHE_MAGIC, self.CACHE_VERSION, ctypes.sizeof(ctypes.c_long),
+                                        self.x0, self.y0, self.cellSize, self.nx, self.ny, *[len(a) for a in arrays])
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(header)
+            for a in arrays:
+                data = a.tostring()
+                f.write(data)
+                f.write(b'\0' * (-len(data) % 8)) # keep every array aligned on 8 bytes
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpPath, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the index saved in path, or None if the file can't be used.
+        The file is memory-mapped : the packed arrays are not copied in memory.
+        """
+        try:
+            with open(path, 'rb') as f:
+                fileMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (IOError, OSError, ValueError):
+            return None
+        if len(fileMap) < cls.CACHE_HEADER.size:
+            return None
+        header = cls.CACHE_HEADER.unpack_from(fileMap, 0)
+        magic, version, longSize, x0, y0, cellSize, nx, ny = header[:8]
+        if magic != cls.CACHE_MAGIC or version != cls.CACHE_VERSION or longSize != ctypes.sizeof(ctypes.c_long):
+            return None
+
+        index = cls()
+        index.x0, index.y0, index.cellSize, index.nx, index.ny = x0, y0, cellSize, nx, ny
+        offset = cls.CACHE_HEADER.size
+        for (name, typecode), length in zip(cls.PACKED_ARRAYS, header[8:]):
+            arrayType = cls.CTYPES[typecode] * length
+            if offset + ctypes.sizeof(arrayType) > len(fileMap):
+                return None
+            setattr(index, name, arrayType.from_buffer(fileMap, offset))
+            offset += ctypes.sizeof(arrayType)
+            offset += -offset % 8
+        index.mmap = fileMap
+        return index
+
+    #########################
+    # Incremental edits
+
+    def updateFeature(self, fid, lines):
+        """
+        Replaces the geometry of the feature fid (or adds it) by the given lines
+        """
+        self.removeFeature(fid)
+        vertexCells, segmentCells = set(), set()
+        for line in lines:
+            previous = None
+            for x, y in line:
+                c = self._cellIndex(x, y)
+                self.overlayVertices.setdefault(c, []).append((fid, x, y))
+                vertexCells.add(c)
+                if previous is not None:
+                    x1, y1 = previous
+                    for c in self._segmentCells(x1, y1, x, y):
+                        self.overlaySegments.setdefault(c, []).append((fid, x1, y1, x, y))
+                        segmentCells.add(c)
+                previous = (x, y)
+        self.overlayCells[fid] = (vertexCells, segmentCells)
+
+    def removeFeature(self, fid):
+        """
+        Removes the feature fid from the index
+        """
+        self.removedFids.add(fid)
+        vertexCells, segmentCells = self.overlayCells.pop(fid, ((), ()))
+        for c in vertexCells:
+            self.overlayVertices[c] = [v for v in self.overlayVertices[c] if v[0] != fid]
+        for c in segmentCells:
+            self.overlaySegments[c] = [s for s in self.overlaySegments[c] if s[0] != fid]
+
+    def removeTemporaryFeatures(self):
+        """
+        Removes the features with a negative fid (not yet saved features of the edit buffer)
+        """
+        for fid in [fid for fid in self.overlayCells if fid < 0]:
+            self.removeFeature(fid)
+
+    def _pack(self, cellsPerItem):
+        """
+        Returns the cellStart offsets and the order in which the items must be stored.
+        cellsPerItem gives, for each item, the cells it belongs to.
+        """
+        cellsPerItem = list(cellsPerItem)
+        counts = array('l', [0]) * (self.nx * self.ny + 1)
+        for cells in cellsPerItem:
+            for c in cells:
+                counts[c + 1] += 1
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        start = array('l', counts)
+        order = array('l', [0]) * counts[-1]
+        for item, cells in enumerate(cellsPerItem):
+            for c in cells:
+                order[counts[c]] = item
+                counts[c] += 1
+        return start, order
+
+    def _cellIndex(self, x, y):
+        ix = min(max(int((x - self.x0) / self.cellSize), 0), self.nx - 1)
+        iy = min(max(int((y - self.y0) / self.cellSize), 0), self.ny - 1)
+        return iy * self.nx + ix
+
+    def _cellRange(self, xMin, yMin, xMax, yMax):
+        """
+        Returns the indexes of the cells touched by the given rectangle.
+        Everything outside of the grid falls in the border cells.
+        """
+        ix0 = min(max(int((xMin - self.x0) / self.cellSize), 0), self.nx - 1)
+        iy0 = min(max(int((yMin - self.y0) / self.cellSize), 0), self.ny - 1)
+        ix1 = min(max(int((xMax - self.x0) / self.cellSize), 0), self.nx - 1)
+        iy1 = min(max(int((yMax - self.y0) / self.cellSize), 0), self.ny - 1)
+        return [iy * self.nx + ix for iy in range(iy0, iy1 + 1) for ix in range(ix0, ix1 + 1)]
+
+    def _segmentCells(self, x1, y1, x2, y2):
+        """
+        Returns the indexes of the cells crossed by the segment (supercover : the cells it only touches at a corner are included).
+        As the queries clamp their rectangle to the grid, the parts of the segment outside of the grid are registered
+        in the border cells they are clamped to.
+        """
+        # in cell units
+        u1, v1 = (x1 - self.x0) / self.cellSize, (y1 - self.y0) / self.cellSize
+        u2, v2 = (x2 - self.x0) / self.cellSize, (y2 - self.y0) / self.cellSize
+        du, dv = u2 - u1, v2 - v1
+
+        # split the segment where it leaves the grid, so clamping each piece keeps it straight
+        cuts = [0.0, 1.0]
+        for start, delta, bounds in ((u1, du, (0.0, self.nx)), (v1, dv, (0.0, self.ny))):
+            if delta:
+                cuts.extend(t for t in ((b - start) / delta for b in bounds) if 0.0 < t < 1.0)
+        cuts.sort()
+
+        cells = set()
+        for ta, tb in zip(cuts, cuts[1:]):
+            self._traverseCells(min(max(u1 + ta * du, 0.0), self.nx), min(max(v1 + ta * dv, 0.0), self.ny),
+                                min(max(u1 + tb * du, 0.0), self.nx), min(max(v1 + tb * dv, 0.0), self.ny), cells)
+        return list(cells)
+
+    def _traverseCells(self, u1, v1, u2, v2, cells):
+        """
+        Adds to cells the cells crossed by the segment u1, v1 - u2, v2 (in cell units, inside the grid), walking from cell to cell
+        """
+        nx = self.nx
+        ix, iy = min(int(u1), nx - 1), min(int(v1), self.ny - 1)
+        ex, ey = min(int(u2), nx - 1), min(int(v2), self.ny - 1)
+        du, dv = u2 - u1, v2 - v1
+        stepX = 1 if ex > ix else -1
+        stepY = 1 if ey > iy else -1
+        # parameter (0 at u1, v1, 1 at u2, v2) of the next vertical and horizontal cell borders
+        if du:
+            tMaxX, tDeltaX = ((ix + 1 if du > 0 else ix) - u1) / du, abs(1.0 / du)
+        else:
+            tMaxX, tDeltaX = float('inf'), float('inf')
+        if dv:
+            tMaxY, tDeltaY = ((iy + 1 if dv > 0 else iy) - v1) / dv, abs(1.0 / dv)
+        else:
+            tMaxY, tDeltaY = float('inf'), float('inf')
+
+        cells.add(iy * nx + ix)
+        while ix != ex or iy != ey:
+            if iy == ey or (ix != ex and tMaxX < tMaxY):
+                ix += stepX
+                tMaxX += tDeltaX
+            elif ix == ex or tMaxY < tMaxX:
+                iy += stepY
+                tMaxY += tDeltaY
+            else:
+                # through a corner : the two cells beside it are touched too
+                cells.add(iy * nx + ix + stepX)
+                cells.add((iy + stepY) * nx + ix)
+                ix += stepX
+                iy += stepY
+                tMaxX += tDeltaX
+                tMaxY += tDeltaY
+            cells.add(iy * nx + ix)
+
+    #########################
+    # Queries
+
+    def nearestVertex(self, x, y, tolerance):
+        """
+        Returns (squared distance, x, y) of the nearest vertex within tolerance, or None
+        """
+        best = None
+        bestDist = tolerance * tolerance
+        vertexX, vertexY, vertexFid, start = self.vertexX, self.vertexY, self.vertexFid, self.vertexStart
+        removed = self.removedFids
+        for c in self._cellRange(x - tolerance, y - tolerance, x + tolerance, y + tolerance):
+            for i in range(start[c], start[c + 1]):
+                if removed and vertexFid[i] in removed:
+                    continue
+                dx = vertexX[i] - x
+                dy = vertexY[i] - y
+                dist = dx * dx + dy * dy
+                if dist <= bestDist:
+                    bestDist = dist
+                    best = (dist, vertexX[i], vertexY[i])
+            for fid, vx, vy in self.overlayVertices.get(c, ()):
+                dist = (vx - x) ** 2 + (vy - y) ** 2
+                if dist <= bestDist:
+                    bestDist = dist
+                    best = (dist, vx, vy)
+        return best
+
+    def nearestSegment(self, x, y, tolerance):
+        """
+        Returns (squared distance, (x, y) of the closest point on the segment, (x1, y1), (x2, y2))
+        of the nearest segment within tolerance, or None
+        """
+        segments = self.nearestSegments(x, y, tolerance, 1)
+        return segments[0] if segments else None
+
+    def nearestSegments(self, x, y, tolerance, limit):
+        """
+        Returns the limit nearest segments within tolerance, sorted by distance, as a list of
+        (squared distance, (x, y) of the closest point on the segment, (x1, y1), (x2, y2))
+        """
+        found = []
+        seen = set() # segments crossing several cells are registered in each of them
+        tolerance2 = tolerance * tolerance
+        start = self.segmentStart
+        removed = self.removedFids
+        for c in self._cellRange(x - tolerance, y - tolerance, x + tolerance, y + tolerance):
+            candidates = [(self.segmentX1[i], self.segmentY1[i], self.segmentX2[i], self.segmentY2[i])
+                            for i in range(start[c], start[c + 1]) if not (removed and self.segmentFid[i] in removed)]
+            candidates.extend(segment[1:] for segment in self.overlaySegments.get(c, ()))
+            for candidate in candidates:
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                x1, y1, x2, y2 = candidate
+                fx, fy = closestPointOnSegment(x, y, x1, y1, x2, y2)
+                dist = (fx - x) ** 2 + (fy - y) ** 2
+                if dist <= tolerance2:
+                    found.append( (dist, (fx, fy), (x1, y1), (x2, y2)) )
+        return heapq.nsmallest(limit, found)
+
+
+class CadSnapIndexTaskSignals(QObject):
+    """
+    QRunnable is not a QObject, so the task emits its result through this object
+    """
+    finished = pyqtSignal(str, object)
+
+
+class CadSnapIndexCancelled(Exception):
+    """
+    Raised in the worker thread to stop a task which was cancelled
+    """
+
+
+class CadSnapIndexTask(QRunnable):
+    """
+    Builds the CadSnapLayerIndex of one layer in a worker thread.
+
+    The features are read from a feature source (made in the GUI thread, so the worker never uses the provider
+    the GUI thread is using), or, with QGIS < 2.4 which has no feature sources, read by the GUI thread in
+    chunks (see CadSnapIndex._readChunks) and only packed here.
+    Only the provider's features are read, the edit buffer is applied once the index is back in the GUI thread.
+    """
+
+    def __init__(self, layerId, source, cachePath=None):
+        QRunnable.__init__(self)
+        self.setAutoDelete(False) # the python side keeps the reference until the task is finished
+        self.layerId = layerId
+        self.source = source # QgsAbstractFeatureSource, or None if the features are read by the GUI thread
+        self.reader = None # iterator over the provider's features while the GUI thread reads them
+        self.lines = [] # (fid, line) read by the GUI thread
+        self.cachePath = cachePath # where to save the index once built (None to not save it)
+        self.signals = CadSnapIndexTaskSignals()
+        self.cancelled = False
+        self.running = False
+        self.lock = threading.Lock()
+        self.released = threading.Event() # set once the worker doesn't read the source anymore
+
+    def run(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.running = True
+        try:
+            index = CadSnapLayerIndex()
+            index.build(self._lines())
+            if self.cancelled:
+                return
+            if self.cachePath is not None:
+                self._saveCache(index)
+        except CadSnapIndexCancelled:
+            return
+        except Exception as e:
+            QgsMessageLog.logMessage("CadInput : could not build the snapping index of layer %s (%s)" % (self.layerId, e))
+            index = None
+        finally:
+            self.released.set()
+        if not self.cancelled:
+            self.signals.finished.emit(self.layerId, index)
+
+    def cancel(self):
+        """
+        Stops the task, and if it was already started, waits for the worker to stop reading the source (but not for the packing)
+        """
+        with self.lock:
+            self.cancelled = True
+            running = self.running
+        self.reader = None
+        if running:
+            self.released.wait()
+
+    def _saveCache(self, index):
+        """
+        Saves the index, and removes the files cached for older versions of the same layer
+        """
+        try:
+            index.save(self.cachePath)
+        except (IOError, OSError) as e:
+            QgsMessageLog.logMessage("CadInput : could not save the snapping index cache %s (%s)" % (self.cachePath, e))
+            return
+        prefix = self.cachePath.rsplit('_', 1)[0]
+        for path in glob.glob(prefix + '_*.idx'):
+            if path != self.cachePath:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # probably still memory-mapped (on windows)
+                    pass
+
+    def _lines(self):
+        try:
+            if self.source is None:
+                lines, self.lines = self.lines, []
+                for item in lines:
+                    if self.cancelled:
+                        raise CadSnapIndexCancelled()
+                    yield item
+            else:
+                request = QgsFeatureRequest().setSubsetOfAttributes([])
+                for feature in self.source.getFeatures(request):
+                    if self.cancelled:
+                        raise CadSnapIndexCancelled()
+                    for line in geometryLines(feature.geometry()):
+                        yield feature.id(), line
+        finally:
+            self.source = None
+            self.released.set()
+
+
+class CadSnapIndex(QObject):
+    """
+    This class replaces the QgsSnapper queries by lookups in in-memory grids (one per snap layer).
+
+    It is given the same list of QgsSnapper.SnapLayer as the snapper would be, and its snapPoint method
+    returns the same (snapPoint, snapSegment) as CadEventFilter._toMapSnap.
+
+    The indexes are built in worker threads (one task per layer) : a layer can only be snapped by the index
+    once isReady returns True for it. The indexes are then kept up to date with the layers' edit signals,
+    so only the touched features are patched.
+
+    The indexes of file based layers are also saved in a cache directory, keyed by the layer's source, CRS and
+    modification time, and memory-mapped back when the same layer is loaded again.
+    """
+
+    layerReady = pyqtSignal(str) # the index of that layer id is built
+    loadingChanged = pyqtSignal(list) # names of the layers whose index is being built
+
+    # at most that many segments are returned by snapPoint, so dense junctions don't slow the cursor down
+    MAX_SNAP_SEGMENTS = 64
+    # features read per event loop iteration when the GUI thread reads the layer (QGIS < 2.4, see _readChunks)
+    READ_CHUNK_SIZE = 1000
+    # number of indexes kept for the layers which are not snapped to anymore (e.g. hidden), so showing them again doesn't rebuild them
+    UNUSED_CACHE_SIZE = 8
+
+    def __init__(self, mapCanvas):
+        QObject.__init__(self)
+        self.mapCanvas = mapCanvas
+        self.snapLayers = []
+        self.layerIndexes = {} # layer id -> CadSnapLayerIndex
+        self.watchedLayers = {} # layer id -> layer whose edit signals are connected
+        self.pendingTasks = {} # layer id -> CadSnapIndexTask being run
+        self.pendingEdits = {} # layer id -> edits received while the index is being built
+        self.failedLayers = set() # layer ids whose index could not be built
+        self.usedLayers = OrderedDict() # watched layer ids, least recently snapped first
+
+        self.threadPool = QThreadPool()
+        self.readTimer = QTimer()
+        self.readTimer.setSingleShot(True)
+        self.readTimer.setInterval(0)
+        self.readTimer.timeout.connect(self._readChunks)
+
+        settings = QSettings()
+        defaultCacheDir = os.path.join(QgsApplication.qgisSettingsDirPath(), "cadinput", "snapcache")
+        self.cacheDir = settings.value("CadInput/snapCacheDir", defaultCacheDir) if settings.value("CadInput/snapCache", True, type=bool) else None
+        if self.cacheDir and not os.path.isdir(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                QgsMessageLog.logMessage("CadInput : could not create the snapping cache directory %s" % self.cacheDir)
+                self.cacheDir = None
+
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self.removeLayers)
+        QgsProject.instance().readProject.connect(self.clear)
+
+    def close(self):
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.disconnect(self.removeLayers)
+        QgsProject.instance().readProject.disconnect(self.clear)
+        self.clear()
+        self.readTimer.stop()
+
+    def setSnapLayers(self, snapLayers):
+        """
+        Sets the layers to snap to (list of QgsSnapper.SnapLayer) and starts building the missing indexes
+        """
+        self.snapLayers = snapLayers
+        started = False
+        for snapLayer in snapLayers:
+            layer = snapLayer.mLayer
+            if layer.id() not in self.watchedLayers:
+                self._watchLayer(layer)
+            self.usedLayers.pop(layer.id(), None)
+            self.usedLayers[layer.id()] = None
+            if not self.isReady(layer.id()) and layer.id() not in self.pendingTasks and layer.id() not in self.failedLayers:
+                if not self._startBuild(layer):
+                    started = True
+        if started:
+            self.loadingChanged.emit(self.loadingLayers())
+
+        # the indexes of the layers which aren't snapped to anymore are kept until there are too many of them
+        snapLayerIds = set(snapLayer.mLayer.id() for snapLayer in snapLayers)
+        unusedLayerIds = [layerId for layerId in self.usedLayers if layerId not in snapLayerIds]
+        if len(unusedLayerIds) > self.UNUSED_CACHE_SIZE:
+            self.removeLayers(unusedLayerIds[:len(unusedLayerIds) - self.UNUSED_CACHE_SIZE])
+
+    def isReady(self, layerId):
+        return layerId in self.layerIndexes
+
+    def loadingLayers(self):
+        return [self.watchedLayers[layerId].name() for layerId in self.pendingTasks]
+
+    def removeLayers(self, layerIds):
+        loadingChanged = False
+        for layerId in layerIds:
+            self.layerIndexes.pop(layerId, None)
+            self.pendingEdits.pop(layerId, None)
+            self.failedLayers.discard(layerId)
+            self.usedLayers.pop(layerId, None)
+            task = self.pendingTasks.pop(layerId, None)
+            if task is not None:
+                task.cancel()
+                loadingChanged = True
+            layer = self.watchedLayers.pop(layerId, None)
+            if layer is not None:
+                self._unwatchLayer(layer)
+        if loadingChanged:
+            self.loadingChanged.emit(self.loadingLayers())
+
+    def clear(self):
+        self.removeLayers(list(self.watchedLayers))
+        self.snapLayers = []
+
+    #########################
+    # Background construction
+
+    def _startBuild(self, layer):
+        """
+        Loads the index of the layer from the cache if possible (returns True), or starts building it (returns False)
+        """
+        cachePath = self._cachePath(layer)
+        if cachePath is not None and os.path.exists(cachePath):
+            index = CadSnapLayerIndex.load(cachePath)
+            if index is not None:
+                self._installIndex(layer.id(), index, [])
+                return True
+
+        # the worker must not use the provider, which is not thread-safe
+        provider = layer.dataProvider()
+        if hasattr(provider, 'featureSource'):
+            task = CadSnapIndexTask(layer.id(), provider.featureSource(), cachePath)
+        else:
+            task = CadSnapIndexTask(layer.id(), None, cachePath)
+            task.reader = iter( provider.getFeatures( QgsFeatureRequest().setSubsetOfAttributes([]) ) )
+        task.signals.finished.connect(self.buildFinished)
+        self.pendingTasks[layer.id()] = task
+        self.pendingEdits[layer.id()] = []
+        if task.reader is None:
+            self.threadPool.start(task)
+        else:
+            self.readTimer.start()
+        return False
+
+    def _readChunks(self):
+        """
+        Reads the next READ_CHUNK_SIZE features of the layers read by the GUI thread, and hands the layers
+        which are completely read to the workers
+        """
+        for task in list(self.pendingTasks.values()):
+            if task.reader is None:
+                continue
+            for i in range(self.READ_CHUNK_SIZE):
+                feature = next(task.reader, None)
+                if feature is None:
+                    task.reader = None
+                    self.threadPool.start(task)
+                    break
+                for line in geometryLines(feature.geometry()):
+                    task.lines.append( (feature.id(), line) )
+        if any(task.reader is not None for task in self.pendingTasks.values()):
+            self.readTimer.start()
+
+    def _cachePath(self, layer):
+        """
+        Returns the cache file of the layer's index, or None if the layer's source is not a file
+        """
+        if self.cacheDir is None:
+            return None
+        sourceFile = layer.source().split('|')[0]
+        if not os.path.isfile(sourceFile):
+            return None
+        key = hashlib.sha1( (u"%s|%s" % (layer.source(), layer.crs().toWkt())).encode('utf-8') ).hexdigest()
+        return os.path.join(self.cacheDir, "%s_%d.idx" % (key, int(os.path.getmtime(sourceFile) * 1000)))
+
+    def buildFinished(self, layerId, index):
+        task = self.pendingTasks.get(layerId)
+        if task is None or task.signals is not self.sender():
+            # the layer was removed (or rebuilt) in the meantime
+            return
+        del self.pendingTasks[layerId]
+        edits = self.pendingEdits.pop(layerId, [])
+
+        if index is None:
+            self.failedLayers.add(layerId)
+        else:
+            self._installIndex(layerId, index, edits)
+
+        self.loadingChanged.emit(self.loadingLayers())
+        self.layerReady.emit(layerId)
+
+    def _installIndex(self, layerId, index, edits):
+        """
+        Makes the index available for snapping, after having replayed the edits received
+        while it was built and applied the current content of the layer's edit buffer
+        """
+        for method, args in edits:
+            getattr(index, method)(*args)
+        editBuffer = self.watchedLayers[layerId].editBuffer()
+        if editBuffer is not None:
+            for fid, feature in editBuffer.addedFeatures().items():
+                index.updateFeature(fid, geometryLines(feature.geometry()))
+            for fid, geometry in editBuffer.changedGeometries().items():
+                index.updateFeature(fid, geometryLines(geometry))
+            for fid in editBuffer.deletedFeatureIds():
+                index.removeFeature(fid)
+        self.layerIndexes[layerId] = index
+
+    #########################
+    # Edit signals
+
+    def _edit(self, layerId, method, *args):
+        """
+        Applies the CadSnapLayerIndex method to the index of layerId, or keeps it for later if the index is being built
+        """
+        if layerId in self.pendingEdits:
+            self.pendingEdits[layerId].append((method, args))
+        elif layerId in self.layerIndexes:
+            getattr(self.layerIndexes[layerId], method)(*args)
+
+    def _watchLayer(self, layer):
+        self.watchedLayers[layer.id()] = layer
+        layer.featureAdded.connect(self.featureAdded)
+        layer.featureDeleted.connect(self.featureDeleted)
+        layer.geometryChanged.connect(self.geometryChanged)
+        layer.committedFeaturesAdded.connect(self.committedFeaturesAdded)
+
+    def _unwatchLayer(self, layer):
+        try:
+            layer.featureAdded.disconnect(self.featureAdded)
+            layer.featureDeleted.disconnect(self.featureDeleted)
+            layer.geometryChanged.disconnect(self.geometryChanged)
+            layer.committedFeaturesAdded.disconnect(self.committedFeaturesAdded)
+        except (RuntimeError, TypeError):
+            #RuntimeError : the underlying c++ layer is already deleted
+            #TypeError : the signals were not connected
+            pass
+
+    def featureAdded(self, fid):
+        layer = self.sender()
+        request = QgsFeatureRequest(fid).setSubsetOfAttributes([])
+        for feature in layer.getFeatures(request):
+            self._edit(layer.id(), 'updateFeature', fid, geometryLines(feature.geometry()))
+
+    def featureDeleted(self, fid):
+        self._edit(self.sender().id(), 'removeFeature', fid)
+
+    def geometryChanged(self, fid, geometry):
+        self._edit(self.sender().id(), 'updateFeature', fid, geometryLines(geometry))
+
+    def committedFeaturesAdded(self, layerId, features):
+        # once committed, the features of the edit buffer get their definitive ids
+        self._edit(layerId, 'removeTemporaryFeatures')
+        for feature in features:
+            self._edit(layerId, 'updateFeature', feature.id(), geometryLines(feature.geometry()))
+
+    def snapPoint(self, mapPoint):
+        """
+        returns the snapped point (if any), the snapped segment (if any) and all the segments within tolerance in map coordinates.
+        The snapped segment is returned as (snapped point on segment, startPoint, endPoint), and the segments within tolerance
+        as a list of (x1, y1, x2, y2) sorted by distance (the snapped segment first), limited to MAX_SNAP_SEGMENTS
+        """
+        renderer = self.mapCanvas.mapRenderer()
+        bestVertex, bestVertexDist = None, None
+        segments = [] # (squared distance, layer, result) of the segments within tolerance
+
+        for snapLayer in self.snapLayers:
+            layer = snapLayer.mLayer
+            index = self.layerIndexes.get(layer.id())
+            if index is None:
+                continue
+            layerPoint = renderer.mapToLayerCoordinates(layer, mapPoint)
+            tolerance = QgsTolerance.toleranceInMapUnits(snapLayer.mTolerance, layer, renderer, snapLayer.mUnitType)
+
+            if snapLayer.mSnapTo != QgsSnapper.SnapToSegment:
+                result = index.nearestVertex(layerPoint.x(), layerPoint.y(), tolerance)
+                if result is not None:
+                    vertex = renderer.layerToMapCoordinates(layer, QgsPoint(result[1], result[2]))
+                    dist = vertex.sqrDist(mapPoint)
+                    if bestVertex is None or dist < bestVertexDist:
+                        bestVertex, bestVertexDist = vertex, dist
+
+            if snapLayer.mSnapTo != QgsSnapper.SnapToVertex and bestVertex is None:
+                for result in index.nearestSegments(layerPoint.x(), layerPoint.y(), tolerance, self.MAX_SNAP_SEGMENTS):
+                    foot = renderer.layerToMapCoordinates(layer, QgsPoint(*result[1]))
+                    segments.append( (foot.sqrDist(mapPoint), layer, foot, result) )
+
+        # as with the QgsSnapper, a snapped vertex has priority over a snapped segment
+        if bestVertex is not None:
+            return bestVertex, None, []
+        if not segments:
+            return None, None, []
+
+        segments = heapq.nsmallest(self.MAX_SNAP_SEGMENTS, segments, key=lambda segment: segment[0])
+        points = [ (renderer.layerToMapCoordinates(layer, QgsPoint(*result[2])), renderer.layerToMapCoordinates(layer, QgsPoint(*result[3])))
+                    for dist, layer, foot, result in segments ]
+        bestSegment = (segments[0][2],) + points[0]
+        return None, bestSegment, [ (p1.x(), p1.y(), p2.x(), p2.y()) for p1, p2 in points ]
+
+
+def closestPointOnSegment(x, y, x1, y1, x2, y2):
+    """
+    Returns the point of the segment (x1,y1)-(x2,y2) which is the closest to (x,y)
+    """
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    if length2 == 0:
+        return x1, y1
+    t = min(max(((x - x1) * dx + (y - y1) * dy) / length2, 0.0), 1.0)
+    return x1 + t * dx, y1 + t * dy
+
+
+def geometryLines(geometry):
+    """
+    Returns the vertices of a QgsGeometry as a list of lines (lists of (x,y) tuples).
+    Points are returned as lines of one vertex, polygon rings as closed lines.
+    """
+    if geometry is None:
+        return []
+    geomType = geometry.type()
+    multi = geometry.isMultipart()
+    if geomType == QGis.Point:
+        points = geometry.asMultiPoint() if multi else [geometry.asPoint()]
+        lines = [[p] for p in points]
+    elif geomType == QGis.Line:
+        lines = geometry.asMultiPolyline() if multi else [geometry.asPolyline()]
+    elif geomType == QGis.Polygon:
+        polygons = geometry.asMultiPolygon() if multi else [geometry.asPolygon()]
+        lines = [ring for polygon in polygons for ring in polygon]
+    else:
+        lines = []
+    return [[(p.x(), p.y()) for p in line] for line in lines]
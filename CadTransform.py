@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Import the PyQt and QGIS libraries
+from PyQt4.QtCore import *
+from qgis.core import *
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    # the array conversions return lists
+    numpy = None
+
+
+class CadTransform(QObject):
+    """
+    Cached map <-> pixel transform of the map canvas.
+
+    The canvas' QgsMapToPixel is sampled once per view (extent, scale, rotation and size), and the points
+    are then converted with plain arithmetic on floats : pixel = (a*x + b*y + c, d*x + e*y + f).
+    When the canvas is not ready (its QgsMapToPixel returns NaNs), the conversions return NaNs too.
+    """
+
+    def __init__(self, mapCanvas):
+        QObject.__init__(self)
+        self.mapCanvas = mapCanvas
+        self.key = None # (extent, scale, rotation, size) of the cached coefficients
+        self.dirty = True # the view may have changed since the key was computed
+        self.valid = False
+        self.mapUnitsPerPixel = float('nan')
+        self.toPixelCoefficients = (float('nan'),) * 6
+        self.toMapCoefficients = (float('nan'),) * 6
+
+        self.mapCanvas.extentsChanged.connect(self.invalidate)
+        self.mapCanvas.scaleChanged.connect(self.invalidate)
+        if hasattr(self.mapCanvas, 'rotationChanged'):
+            self.mapCanvas.rotationChanged.connect(self.invalidate)
+
+    def close(self):
+        self.mapCanvas.extentsChanged.disconnect(self.invalidate)
+        self.mapCanvas.scaleChanged.disconnect(self.invalidate)
+        if hasattr(self.mapCanvas, 'rotationChanged'):
+            self.mapCanvas.rotationChanged.disconnect(self.invalidate)
+
+    def invalidate(self, *args):
+        self.dirty = True
+
+    def update(self):
+        """
+        Samples the canvas' transform again if the view changed since the last call
+        """
+        if not self.dirty:
+            return
+        self.dirty = False
+        canvas = self.mapCanvas
+        extent = canvas.extent()
+        rotation = canvas.rotation() if hasattr(canvas, 'rotation') else 0.0
+        key = (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(), canvas.scale(), rotation, canvas.width(), canvas.height())
+        if key == self.key:
+            return
+        self.key = key
+
+        mapToPixel = canvas.getCoordinateTransform()
+        mupp = mapToPixel.mapUnitsPerPixel()
+        self.mapUnitsPerPixel = mupp
+        if math.isnan(mupp) or mupp == 0:
+            # the canvas is not ready yet, we'll try again next time
+            self.setInvalid()
+            return
+
+        # sample around the center, where the precision matters
+        cx, cy = extent.center().x(), extent.center().y()
+        p0 = mapToPixel.transform( QgsPoint(cx, cy) )
+        px = mapToPixel.transform( QgsPoint(cx + mupp, cy) )
+        py = mapToPixel.transform( QgsPoint(cx, cy + mupp) )
+        a, b = (px.x() - p0.x()) / mupp, (py.x() - p0.x()) / mupp
+        d, e = (px.y() - p0.y()) / mupp, (py.y() - p0.y()) / mupp
+        c, f = p0.x() - a * cx - b * cy, p0.y() - d * cx - e * cy
+        det = a * e - b * d
+        if math.isnan(det) or det == 0:
+            self.setInvalid()
+            return
+
+        self.valid = True
+        self.toPixelCoefficients = (a, b, c, d, e, f)
+        self.toMapCoefficients = (e / det, -b / det, (b * f - c * e) / det, -d / det, a / det, (c * d - a * f) / det)
+
+    def setInvalid(self):
+        self.valid = False
+        self.key = None
+        self.dirty = True
+        self.toPixelCoefficients = (float('nan'),) * 6
+        self.toMapCoefficients = (float('nan'),) * 6
+
+    def toPixel(self, x, y):
+        """
+        Returns the pixel coordinates (floats) of the map coordinates x, y
+        """
+        self.update()
+        a, b, c, d, e, f = self.toPixelCoefficients
+        return a * x + b * y + c, d * x + e * y + f
+
+    def toMap(self, px, py):
+        """
+        Returns the map coordinates of the pixel coordinates px, py
+        """
+        self.update()
+        a, b, c, d, e, f = self.toMapCoefficients
+        return a * px + b * py + c, d * px + e * py + f
+
+    def toPixelArray(self, xs, ys):
+        """
+        Converts sequences of map coordinates, returns two arrays (or lists without numpy) of pixel coordinates
+        """
+        self.update()
+        return self._apply(self.toPixelCoefficients, xs, ys)
+
+    def toMapArray(self, pxs, pys):
+        """
+        Converts sequences of pixel coordinates, returns two arrays (or lists without numpy) of map coordinates
+        """
+        self.update()
+        return self._apply(self.toMapCoefficients, pxs, pys)
+
+    def _apply(self, coefficients, xs, ys):
+        a, b, c, d, e, f = coefficients
+        if numpy is not None:
+            xs, ys = numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float)
+            return a * xs + b * ys + c, d * xs + e * ys + f
+        return [a * x + b * y + c for x, y in zip(xs, ys)], [d * x + e * y + f for x, y in zip(xs, ys)]
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Traverses (bearing/distance legs, e.g. from a survey) and their closure adjustment, without Qt nor QGIS.
+"""
+
+from CadConstraintEngine import bearingToAngle, azimuthToAngle
+from CadExpression import CadExpression
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    # the vertices are computed leg by leg
+    numpy = None
+
+
+# closure adjustments
+NONE, BOWDITCH, TRANSIT = 'none', 'bowditch', 'transit'
+ADJUSTMENTS = [BOWDITCH, TRANSIT, NONE]
+
+
+def parseTraverse(lines):
+    """
+    Yields the items of a traverse, one per line, with the same values as CadConstraintEngine.run :
+
+        x=<value> y=<value>     the start point (first line), or the known end point (last line)
+        a=<value> d=<value>     a leg : its direction, as an angle (degrees, counterclockwise from the x axis),
+        ra=<value> d=<value>    an angle relative to the previous leg, an azimuth (degrees, clockwise from north)
+        az=<value> d=<value>    or a quadrant bearing, and its length
+        b=N45-30-15E d=<value>
+        close                   the traverse ends on its start point
+
+    as ('point', x, y), ('leg', angle in degrees, relative, distance) or ('close',).
+    Empty lines and lines starting with # are skipped.
+    """
+    expressions = CadExpression()
+    for number, line in enumerate(lines):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        try:
+            if words == ['close']:
+                yield ('close',)
+                continue
+            values = {}
+            for word in words:
+                key, sep, text = word.partition('=')
+                if not sep or key in values or key not in ('x', 'y', 'a', 'ra', 'az', 'b', 'd'):
+                    raise ValueError("unexpected %s" % word)
+                if key == 'b':
+                    values[key] = bearingToAngle(text)
+                else:
+                    values[key] = expressions.evaluate(text)
+                if values[key] is None:
+                    raise ValueError("invalid value %s" % word)
+            directions = [key for key in ('a', 'ra', 'az', 'b') if key in values]
+            if sorted(values) == ['x', 'y']:
+                yield ('point', values['x'], values['y'])
+            elif len(directions) == 1 and sorted(values) == sorted(directions + ['d']):
+                key = directions[0]
+                angle = azimuthToAngle(values[key]) if key == 'az' else values[key]
+                yield ('leg', angle, key == 'ra', values['d'])
+            else:
+                raise ValueError("expected x= y=, or a direction and d=")
+        except ValueError as e:
+            raise ValueError("line %i : %s (%s)" % (number + 1, e, line.strip()))
+
+
+class CadTraverse(object):
+    """
+    A traverse : its start point, its legs and, if it's known, the point it must end on
+    """
+
+    def __init__(self, items):
+        """
+        Reads the items of parseTraverse (or of any iterable of such items)
+        """
+        self.start = None
+        self.end = None # known end point, None if the traverse is open
+        self.angles = [] # degrees, as in CadInputWidget
+        self.relative = []
+        self.distances = []
+        for item in items:
+            if self.end is not None:
+                raise ValueError("the traverse must end with its end point (or close)")
+            if item[0] == 'point' and self.start is None:
+                self.start = item[1:]
+            elif item[0] == 'point':
+                self.end = item[1:]
+            elif item[0] == 'close':
+                self.end = self.start
+            elif item[0] == 'leg':
+                self.angles.append(item[1])
+                self.relative.append(item[2])
+                self.distances.append(item[3])
+            if self.start is None:
+                raise ValueError("the traverse must start with its start point")
+        if not self.distances:
+            raise ValueError("the traverse has no leg")
+
+    def headings(self):
+        """
+        Returns the heading (radians, counterclockwise from the x axis) of each leg.
+        A relative angle is added to the heading of the previous leg (to nothing for the first leg).
+        """
+        angles = [math.radians(angle) for angle in self.angles]
+        if numpy is None:
+            headings = []
+            heading = 0.0
+            for angle, relative in zip(angles, self.relative):
+                heading = heading + angle if relative else angle
+                headings.append(heading)
+            return headings
+        angles = numpy.array(angles)
+        absolute = ~numpy.array(self.relative, dtype=bool)
+        sums = numpy.cumsum(angles)
+        # each heading is the sum of the angles since the last absolute one, which starts from its own value
+        anchor = numpy.where(absolute, numpy.arange(len(angles)), -1)
+        anchor = numpy.maximum.accumulate(anchor)
+        offsets = numpy.where(anchor >= 0, angles[anchor] - sums[anchor], 0.0)
+        return sums + offsets
+
+    def legs(self):
+        """
+        Returns the dx, dy of each leg
+        """
+        headings = self.headings()
+        if numpy is None:
+            return ([d * math.cos(h) for d, h in zip(self.distances, headings)],
+                    [d * math.sin(h) for d, h in zip(self.distances, headings)])
+        distances = numpy.array(self.distances)
+        return distances * numpy.cos(headings), distances * numpy.sin(headings)
+
+    def misclosure(self):
+        """
+        Returns the misclosure (ex, ey) of the computed end point to the known one, or None if the traverse is open
+        """
+        if self.end is None:
+            return None
+        dx, dy = self.legs()
+        return self.start[0] + sum(dx) - self.end[0], self.start[1] + sum(dy) - self.end[1]
+
+    def vertices(self, adjustment=BOWDITCH):
+        """
+        Returns the x and y of the vertices (start point included), with the misclosure distributed :
+        BOWDITCH : in proportion to the length along the traverse,
+        TRANSIT : in proportion to the sum of the |dx| and of the |dy| along the traverse,
+        NONE (or if the traverse is open) : not distributed.
+        """
+        dx, dy = self.legs()
+        misclosure = self.misclosure()
+        if misclosure is None or adjustment not in (BOWDITCH, TRANSIT):
+            return cumulate(self.start[0], dx), cumulate(self.start[1], dy)
+        if adjustment == BOWDITCH:
+            weightsX = weightsY = [abs(d) for d in self.distances]
+        else:
+            weightsX, weightsY = [abs(v) for v in dx], [abs(v) for v in dy]
+        return (cumulate(self.start[0], dx, misclosure[0], weightsX),
+                cumulate(self.start[1], dy, misclosure[1], weightsY))
+
+    def report(self, adjustment=BOWDITCH):
+        """
+        Returns the description of the closure of the traverse
+        """
+        length = sum(self.distances)
+        lines = ["%i legs, length %.3f" % (len(self.distances), length)]
+        misclosure = self.misclosure()
+        if misclosure is None:
+            lines.append("open traverse : no misclosure")
+        else:
+            linear = math.hypot(*misclosure)
+            lines.append("misclosure : dx %.4f, dy %.4f, linear %.4f" % (misclosure[0], misclosure[1], linear))
+            lines.append("precision : 1:%.0f" % (length / linear) if linear else "precision : exact closure")
+            lines.append("adjustment : %s" % adjustment)
+        return "\n".join(lines)
+
+
+def cumulate(origin, deltas, misclosure=0.0, weights=None):
+    """
+    Returns origin followed by the cumulative sums of the deltas, minus the misclosure distributed in proportion
+    to the cumulative sums of the weights
+    """
+    if numpy is not None:
+        values = origin + numpy.concatenate(([0.0], numpy.cumsum(deltas)))
+        if weights is not None and misclosure:
+            cumulated = numpy.concatenate(([0.0], numpy.cumsum(weights)))
+            if cumulated[-1]:
+                values -= misclosure * cumulated / cumulated[-1]
+        return values
+    values = [origin]
+    for delta in deltas:
+        values.append(values[-1] + delta)
+    if weights is not None and misclosure:
+        total = float(sum(weights))
+        if total:
+            cumulated = 0.0
+            for i, weight in enumerate(weights):
+                cumulated += weight
+                values[i + 1] -= misclosure * cumulated / total
+    return values
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Runs CadInput without QGIS' main window, so the digitizing hot path can be measured.
+
+ The QGIS python bindings must be importable (set PYTHONPATH and QGIS_PREFIX_PATH as for any standalone
+ pyqgis script). The map canvas is never shown on screen : Qt builds with platform plugins run it
+ offscreen, with Qt4 on X11 run the benchmarks under xvfb-run.
+"""
+import os
+import random
+import sys
+from timeit import default_timer
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+# the plugin modules are imported from the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from qgis.core import *
+from qgis.gui import *
+
+# the benchmarks' statistics are the same as the plugin's ones (see CadProfiler)
+from CadProfiler import percentile
+
+
+def startApplication():
+    """
+    Starts a QgsApplication using its own settings (so neither the user's QGIS settings nor CadInput's ones are read or changed)
+    """
+    QCoreApplication.setOrganizationName("CadInputBenchmarks")
+    QCoreApplication.setApplicationName("CadInputBenchmarks")
+    app = QgsApplication([], True)
+    QgsApplication.setPrefixPath(os.environ.get("QGIS_PREFIX_PATH", "/usr"), True)
+    QgsApplication.initQgis()
+
+    settings = QSettings()
+    settings.setValue("Projections/defaultBehaviour", "useProject") # no CRS prompt for the technical snap layer
+    settings.setValue("CadInput/snapCache", False) # each run measures the same work
+    settings.setValue("CadInput/frameBudget", 0) # every move is processed
+    settings.setValue("CadInput/recordSessions", False)
+    settings.setValue("CadInput/profiling", False)
+    return app
+
+
+class StubLegendInterface(object):
+
+    def __init__(self, iface):
+        self.iface = iface
+
+    def currentLayer(self):
+        return self.iface.activeLayer()
+
+
+class StubIface(QObject):
+    """
+    The subset of QgisInterface used by CadInput, around a real (hidden) QgsMapCanvas
+    """
+
+    def __init__(self, width=800, height=600):
+        QObject.__init__(self)
+        self.window = QMainWindow()
+        self.canvas = QgsMapCanvas(self.window)
+        self.window.setCentralWidget(self.canvas)
+        self.window.resize(width, height)
+        self.window.show()
+        self.currentLayer = None
+        self.legend = StubLegendInterface(self)
+
+    def mapCanvas(self):
+        return self.canvas
+
+    def mainWindow(self):
+        return self.window
+
+    def legendInterface(self):
+        return self.legend
+
+    def activeLayer(self):
+        return self.currentLayer
+
+    def setActiveLayer(self, layer):
+        self.currentLayer = layer
+        return True
+
+    def addPluginToMenu(self, name, action):
+        pass
+
+    def removePluginMenu(self, name, action):
+        pass
+
+    def addToolBarIcon(self, action):
+        pass
+
+    def removeToolBarIcon(self, action):
+        pass
+
+
+def createLineLayer(vertexCount, extent=1000.0, verticesPerLine=10, seed=0):
+    """
+    Returns a memory layer of random walk polylines with vertexCount vertices in total, spread over [0, extent]²
+    """
+    rand = random.Random(seed)
+    layer = QgsVectorLayer("LineString?crs=EPSG:3857", "benchmark_%i" % vertexCount, "memory")
+    step = extent / 100.0
+    features = []
+    for i in range(max(1, vertexCount // verticesPerLine)):
+        x, y = rand.uniform(0, extent), rand.uniform(0, extent)
+        points = []
+        for j in range(verticesPerLine):
+            points.append( QgsPoint(x, y) )
+            x = min(max(x + rand.uniform(-step, step), 0), extent)
+            y = min(max(y + rand.uniform(-step, step), 0), extent)
+        feature = QgsFeature()
+        feature.setGeometry( QgsGeometry.fromPolyline(points) )
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    layer.updateExtents()
+    return layer
+
+
+class CadSession(object):
+    """
+    CadInput's objects, wired as in Cad.initGui, on a StubIface showing the given layers.
+    The layers are added to the layer registry and snapped with the given tolerance (in pixels),
+    unless tolerance is None : then they must be in the registry and the project's snap settings are used.
+    """
+
+    def __init__(self, layers, tolerance=10):
+        # the plugin's modules need the QgsApplication
+        from CadInputWidget import CadInputWidget
+        from CadEventFilter import CadEventFilter
+        from CadPaintWidget import CadPaintWidget
+        from CadPointList import CadPointList
+
+        self.iface = StubIface()
+        self.layers = layers
+        canvas = self.iface.mapCanvas()
+        self.ownLayers = tolerance is not None
+        if self.ownLayers:
+            QgsMapLayerRegistry.instance().addMapLayers(layers)
+            canvas.setCrsTransformEnabled(False)
+        canvas.setLayerSet( [QgsMapCanvasLayer(layer) for layer in layers] )
+        extent = QgsRectangle()
+        for layer in layers:
+            if self.ownLayers:
+                QgsProject.instance().setSnapSettingsForLayer(layer.id(), True, QgsSnapper.SnapToVertexAndSegment, QgsTolerance.Pixels, tolerance, False)
+            extent.combineExtentWith(layer.extent())
+        canvas.setExtent(extent)
+        if layers:
+            self.iface.setActiveLayer(layers[0])
+
+        self.inputWidget = CadInputWidget(self.iface)
+        self.cadPointList = CadPointList(self.inputWidget)
+        self.paintWidget = CadPaintWidget(canvas, self.inputWidget, self.cadPointList)
+        self.eventFilter = CadEventFilter(self.iface, self.cadPointList, self.inputWidget, self.paintWidget)
+        self.viewport = canvas.viewport()
+
+        # no edit map tool is set, so CadInput is activated by hand
+        self.inputWidget.active = True
+        self.inputWidget.enabled = True
+
+        self.waitForIndexes()
+
+        self.image = QImage(self.viewport.size(), QImage.Format_ARGB32_Premultiplied)
+        self.styleOption = QStyleOptionGraphicsItem()
+
+    def waitForIndexes(self):
+        """
+        Waits until the snapping indexes are built and installed
+        """
+        snapIndex = self.eventFilter.snapIndex
+        # with QGIS < 2.4, the layers are read by the GUI thread before being packed by the workers
+        while any(task.reader is not None for task in snapIndex.pendingTasks.values()):
+            QCoreApplication.processEvents()
+        snapIndex.threadPool.waitForDone()
+        QCoreApplication.processEvents()
+
+    def setView(self, extent, width, height):
+        """
+        Resizes the map canvas to width x height pixels and shows that extent
+        """
+        canvas = self.iface.mapCanvas()
+        if (canvas.width(), canvas.height()) != (width, height):
+            window = self.iface.mainWindow()
+            window.resize(window.width() + width - canvas.width(), window.height() + height - canvas.height())
+            QCoreApplication.processEvents()
+            self.image = QImage(self.viewport.size(), QImage.Format_ARGB32_Premultiplied)
+        canvas.setExtent(extent)
+
+    def close(self):
+        self.eventFilter.close()
+        self.inputWidget.close()
+        self.paintWidget.close()
+        self.iface.mapCanvas().scene().removeItem(self.paintWidget)
+        if self.ownLayers:
+            QgsMapLayerRegistry.instance().removeMapLayers([layer.id() for layer in self.layers])
+
+    def replay(self, event):
+        """
+        Feeds one trajectory event (see parseTrajectory) to the event filter, then paints the feedback
+        """
+        kind = event[0]
+        if kind in ('move', 'press', 'release'):
+            eventType = {'move': QEvent.MouseMove, 'press': QEvent.MouseButtonPress, 'release': QEvent.MouseButtonRelease}[kind]
+            button = Qt.NoButton if kind == 'move' else Qt.LeftButton
+            buttons = Qt.LeftButton if kind == 'press' else Qt.NoButton
+            self.eventFilter.eventFilter( self.viewport, SpontaneousMouseEvent(eventType, QPoint(event[1], event[2]), button, buttons, Qt.NoModifier) )
+        elif kind == 'key':
+            self.eventFilter.eventFilter( self.iface.mapCanvas(), SpontaneousKeyEvent(QEvent.KeyPress, event[1], event[2]) )
+        elif kind == 'set':
+            setattr(self.inputWidget, event[1], event[2])
+        self.paint()
+
+    def paint(self):
+        """
+        Paints the CadPaintWidget the way the scene would (the whole item is exposed)
+        """
+        self.image.fill(0)
+        painter = QPainter(self.image)
+        self.styleOption.exposedRect = self.paintWidget.boundingRect()
+        self.paintWidget.paint(painter, self.styleOption, None)
+        painter.end()
+
+
+class SpontaneousMouseEvent(QMouseEvent):
+    """
+    The event filter only handles events coming from the OS
+    """
+    def spontaneous(self):
+        return True
+
+
+class SpontaneousKeyEvent(QKeyEvent):
+    def spontaneous(self):
+        return True
+
+
+#########################
+# Trajectories
+
+KEYS = {'a': Qt.Key_A, 'd': Qt.Key_D, 'x': Qt.Key_X, 'y': Qt.Key_Y, 'c': Qt.Key_C, 'p': Qt.Key_P, 'esc': Qt.Key_Escape}
+MODIFIERS = {'alt': Qt.AltModifier, 'ctrl': Qt.ControlModifier, 'shift': Qt.ShiftModifier}
+
+def parseTrajectory(lines):
+    """
+    Parses a trajectory, one event per line (empty lines and lines starting with # are skipped) :
+
+        move <pixel x> <pixel y>
+        press <pixel x> <pixel y>
+        release <pixel x> <pixel y>
+        key <a|d|x|y|c|p|esc> [alt|ctrl|shift]    (CadInput's shortcuts, e.g. "key a alt" toggles the angle lock)
+        set <x|y|a|d> <value>                     (value typed in the dock)
+
+    and returns the list of events as tuples
+    """
+    events = []
+    for number, line in enumerate(lines):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        try:
+            if words[0] in ('move', 'press', 'release'):
+                events.append( (words[0], int(words[1]), int(words[2])) )
+            elif words[0] == 'key':
+                modifiers = MODIFIERS[words[2]] if len(words) > 2 else Qt.NoModifier
+                events.append( ('key', KEYS[words[1]], modifiers) )
+            elif words[0] == 'set' and words[1] in ('x', 'y', 'a', 'd'):
+                events.append( ('set', words[1], float(words[2])) )
+            else:
+                raise ValueError(words[0])
+        except (IndexError, KeyError, ValueError):
+            raise ValueError("invalid trajectory event at line %i : %s" % (number + 1, line.strip()))
+    return events
+
+def randomTrajectory(count, width=800, height=600, seed=0):
+    """
+    Returns a trajectory of count events : a random walk of the cursor, clicking a vertex every 25 moves,
+    and locking and unlocking the angle or the distance from time to time
+    """
+    rand = random.Random(seed)
+    x, y = width // 2, height // 2
+    events = []
+    while len(events) < count:
+        x = min(max(x + rand.randint(-15, 15), 0), width - 1)
+        y = min(max(y + rand.randint(-15, 15), 0), height - 1)
+        events.append( ('move', x, y) )
+        i = len(events)
+        if i % 25 == 0:
+            events.append( ('press', x, y) )
+            events.append( ('release', x, y) )
+        if i % 100 == 30:
+            events.append( ('set', 'a', float(rand.randint(0, 35) * 10)) )
+            events.append( ('key', Qt.Key_A, Qt.AltModifier) )
+        elif i % 100 == 60:
+            events.append( ('set', 'd', float(rand.randint(1, 50))) )
+            events.append( ('key', Qt.Key_D, Qt.AltModifier) )
+        elif i % 100 == 90:
+            events.append( ('key', Qt.Key_Escape, Qt.NoModifier) )
+    return events[:count]
+
+
+#########################
+# Statistics
+
+def measure(session, events):
+    """
+    Replays the events and returns the sorted per-event latencies (in seconds) and the total time
+    """
+    latencies = []
+    start = default_timer()
+    for event in events:
+        t0 = default_timer()
+        session.replay(event)
+        latencies.append(default_timer() - t0)
+    total = default_timer() - start
+    return sorted(latencies), total
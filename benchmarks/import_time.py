@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Checks what CadInput costs to QGIS' startup : importing the plugin and running initGui must stay
+ under the budget and must not load the modules which are only needed once CadInput is enabled.
+ The modules are checked once more after the first activation. Exits with 1 if a check fails.
+
+ Usage : python benchmarks/import_time.py [--budget 20]
+"""
+import argparse
+import sys
+from timeit import default_timer
+
+from harness import startApplication, StubIface
+
+# modules which must only be loaded when CadInput is enabled
+DEFERRED_MODULES = ['resources_rc', 'ui_dock', 'CadInputWidget', 'CadEventFilter', 'CadPaintWidget', 'CadSnapIndex', 'CadPointList', 'CadHelp',
+                    'CadConstraintEngine', 'CadTraverse']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CadInput startup cost")
+    parser.add_argument("--budget", type=float, default=20.0, help="maximum time (in ms) to import the plugin and run initGui")
+    args = parser.parse_args()
+
+    app = startApplication()
+    iface = StubIface()
+    # what QGIS has loaded anyway is not counted
+    loaded = set(sys.modules)
+
+    start = default_timer()
+    import Cad
+    plugin = Cad.Cad(iface)
+    plugin.initGui()
+    elapsed = 1000 * (default_timer() - start)
+
+    failed = False
+    print "import and initGui : %.2f ms (budget %.2f ms)" % (elapsed, args.budget)
+    if elapsed > args.budget:
+        print "FAILED : over budget"
+        failed = True
+    early = [name for name in DEFERRED_MODULES if name in sys.modules and name not in loaded]
+    if early:
+        print "FAILED : loaded at startup : %s" % ", ".join(early)
+        failed = True
+
+    # once enabled, CadInput must work as before
+    plugin.enableAction.setChecked(True)
+    missing = [name for name in DEFERRED_MODULES if name not in ('CadHelp', 'CadTraverse') and name not in sys.modules]
+    if plugin.inputWidget is None or missing:
+        print "FAILED : not loaded on activation : %s" % ", ".join(missing or ['CadInputWidget'])
+        failed = True
+    plugin.unload()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
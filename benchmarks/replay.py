@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Replays mouse trajectories through CadInput (event filter, snapping, constraints and painting)
+ on layers of different sizes, and reports the per-event latency and the events per second.
+
+ Usage : python benchmarks/replay.py [--sizes 1000,10000,100000] [--events 2000] [--trajectory file] [--csv file]
+"""
+import argparse
+import csv
+
+from harness import startApplication, createLineLayer, CadSession, parseTrajectory, randomTrajectory, percentile, measure
+from qgis.core import QgsApplication
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CadInput trajectory replay benchmark")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated numbers of vertices of the snapped layer")
+    parser.add_argument("--events", type=int, default=2000, help="number of events of the random trajectory")
+    parser.add_argument("--trajectory", help="replay this trajectory file rather than a random one (see harness.parseTrajectory)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--csv", help="also write the results to this CSV file")
+    args = parser.parse_args()
+
+    app = startApplication()
+
+    if args.trajectory:
+        with open(args.trajectory) as f:
+            events = parseTrajectory(f)
+    else:
+        events = randomTrajectory(args.events, seed=args.seed)
+
+    rows = []
+    print "%10s %8s %10s %10s %10s %12s" % ("vertices", "events", "p50 (ms)", "p95 (ms)", "p99 (ms)", "events/s")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        session = CadSession([createLineLayer(size, seed=args.seed)])
+        # a first pass warms the caches up (map renderer, index pages, compiled expressions)
+        measure(session, events[:100])
+        session.cadPointList.empty()
+        latencies, total = measure(session, events)
+        session.close()
+
+        row = (size, len(events), percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+               percentile(latencies, 99) * 1000, len(events) / total if total else float('inf'))
+        rows.append(row)
+        print "%10i %8i %10.3f %10.3f %10.3f %12.1f" % row
+
+    if args.csv:
+        with open(args.csv, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(["vertices", "events", "p50_ms", "p95_ms", "p99_ms", "events_per_second"])
+            writer.writerows(rows)
+
+    QgsApplication.exitQgis()
+
+
+if __name__ == "__main__":
+    main()
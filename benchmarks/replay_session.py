@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Replays a session recorded by CadInput (CadInput/recordSessions setting) against the same project :
+ each event is fed back through CadEventFilter with the constraints it was recorded with, the snap
+ results are compared with the recorded ones, and the per-event latency is reported.
+
+ Usage : python benchmarks/replay_session.py project.qgs session.cadrec [--profile] [--tolerance 1e-6]
+"""
+import argparse
+import sys
+from timeit import default_timer
+
+from harness import startApplication, CadSession, SpontaneousMouseEvent, SpontaneousKeyEvent, percentile
+from PyQt4.QtCore import *
+from qgis.core import *
+
+from CadRecorder import readRecords, MOVE, PRESS, RELEASE, KEY, CANCEL, EXTENT, SNAP_NONE, SNAP_VERTEX, SNAP_SEGMENT
+
+
+MOUSE_EVENTS = {MOVE: (QEvent.MouseMove, Qt.NoButton, Qt.NoButton),
+                PRESS: (QEvent.MouseButtonPress, Qt.LeftButton, Qt.LeftButton),
+                RELEASE: (QEvent.MouseButtonRelease, Qt.LeftButton, Qt.NoButton)}
+
+
+def replayRecord(session, record):
+    """
+    Feeds one record to the event filter of the session, after restoring the constraints it was recorded with
+    """
+    canvas = session.iface.mapCanvas()
+    if record.kind == EXTENT:
+        session.setView(QgsRectangle(record.x, record.y, record.snap[0], record.snap[1]), int(record.values[0]), int(record.values[1]))
+        return
+
+    for flag, value in record.flags().items():
+        setattr(session.inputWidget, flag, value)
+    session.inputWidget.x, session.inputWidget.y, session.inputWidget.a, session.inputWidget.d = record.values
+
+    if record.kind in MOUSE_EVENTS:
+        eventType, button, buttons = MOUSE_EVENTS[record.kind]
+        px, py = session.paintWidget.transform.toPixel(record.x, record.y)
+        event = SpontaneousMouseEvent(eventType, QPoint(int(round(px)), int(round(py))), button, buttons, Qt.KeyboardModifiers(record.modifiers))
+        session.eventFilter.eventFilter(session.viewport, event)
+    elif record.kind == KEY:
+        session.eventFilter.eventFilter(canvas, SpontaneousKeyEvent(QEvent.KeyPress, record.key, Qt.KeyboardModifiers(record.modifiers)))
+    elif record.kind == CANCEL:
+        session.eventFilter.eventFilter(session.viewport, SpontaneousMouseEvent(QEvent.MouseButtonRelease, QPoint(), Qt.RightButton, Qt.NoButton, Qt.NoModifier))
+    session.paint()
+
+def snapMatches(session, record, tolerance):
+    """
+    Returns whether the snap results of the replayed event are the recorded ones
+    """
+    pointList = session.cadPointList
+    if pointList.snapPoint is not None:
+        snapKind, snap = SNAP_VERTEX, pointList.snapPoint
+    elif pointList.snapSegment is not None:
+        snapKind, snap = SNAP_SEGMENT, pointList.snapSegment[0]
+    else:
+        snapKind, snap = SNAP_NONE, None
+    if snapKind != record.snapKind:
+        return False
+    return snap is None or (abs(snap.x() - record.snap[0]) <= tolerance and abs(snap.y() - record.snap[1]) <= tolerance)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a CadInput session log")
+    parser.add_argument("project", help="the QGIS project the session was recorded on")
+    parser.add_argument("session", help="the session log (.cadrec)")
+    parser.add_argument("--profile", action="store_true", help="also report the time spent in each stage (see CadProfiler)")
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="tolerance (in map units) when comparing the snap results")
+    args = parser.parse_args()
+
+    app = startApplication()
+    QSettings().setValue("CadInput/profiling", args.profile)
+    if not QgsProject.instance().read( QFileInfo(args.project) ):
+        sys.exit("could not read the project %s" % args.project)
+    layers = QgsMapLayerRegistry.instance().mapLayers().values()
+    session = CadSession(layers, tolerance=None)
+
+    latencies = []
+    mismatches = []
+    start = default_timer()
+    for number, record in enumerate(readRecords(args.session)):
+        t0 = default_timer()
+        replayRecord(session, record)
+        if record.kind in MOUSE_EVENTS:
+            latencies.append(default_timer() - t0)
+            if not snapMatches(session, record, args.tolerance):
+                mismatches.append(number)
+    total = default_timer() - start
+    latencies.sort()
+
+    print "%i mouse events replayed in %.3f s (%.1f events/s)" % (len(latencies), total, len(latencies) / total if total else float('inf'))
+    print "latency (ms) : p50 %.3f, p95 %.3f, p99 %.3f" % tuple(1000 * percentile(latencies, p) for p in (50, 95, 99))
+    print "%i snap results differ from the recorded ones%s" % (len(mismatches), " (records %s...)" % ", ".join(str(n) for n in mismatches[:10]) if mismatches else "")
+    if args.profile:
+        print session.inputWidget.profiler.report()
+
+    session.close()
+    QgsApplication.exitQgis()
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Checks the constraint engine's commands (doesn't need QGIS).
+
+ Usage : python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+# the plugin's modules are imported from the plugin's directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CadConstraintEngine import CadConstraintEngine
+
+
+class TestCadConstraintEngine(unittest.TestCase):
+
+    def runCommands(self, text):
+        return list(CadConstraintEngine().run(text.splitlines()))
+
+    def test_coordinates(self):
+        features = self.runCommands("x=1 y=1\nrx=2 ry=3\nend")
+        self.assertEqual(features, [([(1.0, 1.0), (3.0, 4.0)], False)])
+
+    def test_angle_and_distance(self):
+        features = self.runCommands("x=1 y=1\na=90 d=5\nend")
+        (x, y), = features[0][0][1:]
+        self.assertAlmostEqual(x, 1.0)
+        self.assertAlmostEqual(y, 6.0)
+
+    def test_coordinate_with_distance(self):
+        # the distance would override the locked x, (6, 1) instead of a point at x=3
+        with self.assertRaises(ValueError):
+            self.runCommands("x=1 y=1\nd=5 x=3")
+
+    def test_coordinate_with_angle(self):
+        with self.assertRaises(ValueError):
+            self.runCommands("x=1 y=1\na=45 ry=2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Checks the expressions' white list and cache (doesn't need QGIS).
+
+ Usage : python -m unittest discover tests
+"""
+import math
+import os
+import sys
+import unittest
+
+# the plugin's modules are imported from the plugin's directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CadExpression import CadExpression
+
+
+class TestCadExpression(unittest.TestCase):
+
+    def setUp(self):
+        self.expressions = CadExpression(cacheSize=4)
+
+    def test_values(self):
+        evaluate = self.expressions.evaluate
+        self.assertEqual(evaluate("1/2"), 0.5)
+        self.assertEqual(evaluate("2^3"), 8.0)
+        self.assertEqual(evaluate("-(1+2)*3"), -9.0)
+        self.assertAlmostEqual(evaluate("sin(pi/2)"), 1.0)
+        self.assertAlmostEqual(evaluate("deg(rad(30))"), 30.0)
+        self.assertEqual(evaluate("x+l*2", {'x': 1.0, 'l': 3.0}), 7.0)
+        # the variables which are not given are 0
+        self.assertEqual(evaluate("a+d"), 0.0)
+
+    def test_invalid(self):
+        evaluate = self.expressions.evaluate
+        for text in ("", "1+", "1/0", "sqrt(-1)", "10**10**7", "1j"):
+            self.assertIsNone(evaluate(text), text)
+
+    def test_rejected(self):
+        evaluate = self.expressions.evaluate
+        for text in ("foo", "True", "None", '"5"', "'a'*2",                   # names and constants
+                     "open(1)", "sin(1, 2)", "sin(x=1)", "pi(1)", "x(1)",   # calls
+                     "x.real", "(1).__class__", "sin.__name__",               # attributes
+                     "[1][0]", "x if 1 else 2", "1 < 2", "lambda: 1"):        # other nodes
+            self.assertIsNone(self.expressions.compile(text), text)
+            self.assertIsNone(evaluate(text), text)
+
+    def test_cache(self):
+        expressions = self.expressions
+        code = expressions.compile("1+1")
+        self.assertIs(expressions.compile("1+1"), code)
+        # the invalid texts are cached too
+        expressions.compile("foo")
+        self.assertIn("foo", expressions.cache)
+        # "1+1" is the least recently used text, so it's the first one dropped
+        for text in ("1+2", "1+3", "1+1", "1+4", "1+5"):
+            expressions.compile(text)
+        self.assertEqual(list(expressions.cache), ["1+3", "1+1", "1+4", "1+5"])
+        self.assertIs(expressions.compile("1+1"), code)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Checks the batch intersections against the scalar ones (needs QGIS' python bindings and numpy, skipped otherwise).
+
+ Usage : python -m unittest discover tests
+"""
+import math
+import os
+import sys
+import unittest
+
+# the plugin's modules are imported from the plugin's directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from qgis.core import QgsPoint
+    from CadIntersection import CadIntersection
+except ImportError:
+    CadIntersection = None
+
+# [x1, y1, x2, y2] rows : oblique, vertical, horizontal and degenerate segments
+SEGMENTS = [[0.0, 0.0, 4.0, 2.0],
+            [1.0, -3.0, 5.0, 7.0],
+            [-2.0, 5.0, 3.0, -1.5],
+            [3.0, 1.0, 3.0, 6.0],
+            [-1.0, 2.0, 6.0, 2.0],
+            [2.0, 2.0, 2.0, 2.0]]
+
+
+@unittest.skipIf(CadIntersection is None or not CadIntersection.BATCH, "needs QGIS' python bindings and numpy")
+class TestCadIntersectionBatch(unittest.TestCase):
+
+    def assertPointEqual(self, point, x, y):
+        self.assertAlmostEqual(point[0], x)
+        self.assertAlmostEqual(point[1], y)
+
+    def test_atX(self):
+        points, valid = CadIntersection.LineIntersectionAtXBatch(SEGMENTS, 1.5)
+        for segment, point, isValid in zip(SEGMENTS, points, valid):
+            x1, y1, x2, y2 = segment
+            # a vertical segment is parallel to the locked x
+            self.assertEqual(bool(isValid), x1 != x2)
+            if isValid:
+                y = CadIntersection.LineIntersectionAtX(QgsPoint(x1, y1), QgsPoint(x2, y2), 1.5)
+                self.assertPointEqual(point, 1.5, y)
+
+    def test_atY(self):
+        points, valid = CadIntersection.LineIntersectionAtYBatch(SEGMENTS, -0.5)
+        for segment, point, isValid in zip(SEGMENTS, points, valid):
+            x1, y1, x2, y2 = segment
+            self.assertEqual(bool(isValid), y1 != y2)
+            if isValid:
+                x = CadIntersection.LineIntersectionAtY(QgsPoint(x1, y1), QgsPoint(x2, y2), -0.5)
+                self.assertPointEqual(point, x, -0.5)
+
+    def test_angle(self):
+        origin, angle = (1.0, -1.0), math.radians(30.0)
+        points, valid = CadIntersection.LineAngleIntersectionBatch(SEGMENTS, origin, angle)
+        self.assertEqual(list(valid), [True, True, True, True, True, False])
+        for segment, point, isValid in zip(SEGMENTS, points, valid):
+            if isValid:
+                x1, y1, x2, y2 = segment
+                # the point is on the segment's line and on the locked angle's line
+                self.assertAlmostEqual((x2-x1) * (point[1]-y1) - (y2-y1) * (point[0]-x1), 0.0)
+                self.assertAlmostEqual(math.cos(angle) * (point[1]-origin[1]) - math.sin(angle) * (point[0]-origin[0]), 0.0)
+
+    def test_angleParallel(self):
+        # parallel to the first segment, and almost parallel (within the tolerance)
+        angle = math.atan2(2.0, 4.0)
+        for delta in (0.0, math.radians(0.00005)):
+            points, valid = CadIntersection.LineAngleIntersectionBatch(SEGMENTS[:1], (0.0, 1.0), angle + delta)
+            self.assertFalse(valid[0])
+
+    def test_circle(self):
+        center, r = (1.0, 1.0), 3.0
+        points1, points2, valid = CadIntersection.CircleLineIntersectionBatch(SEGMENTS, center, r)
+        for segment, point1, point2, isValid in zip(SEGMENTS, points1, points2, valid):
+            x1, y1, x2, y2 = segment
+            p1, p2 = CadIntersection.CircleLineIntersection(QgsPoint(x1, y1), QgsPoint(x2, y2), QgsPoint(*center), r)
+            self.assertEqual(bool(isValid), p1 is not None)
+            if isValid:
+                self.assertPointEqual(point1, p1.x(), p1.y())
+                self.assertPointEqual(point2, p2.x(), p2.y())
+
+    def test_circleTangent(self):
+        # the horizontal line y=2 is tangent to the circle of radius 1 centered on (0, 1), y=3 misses it
+        segments = [[-5.0, 2.0, 5.0, 2.0], [-5.0, 3.0, 5.0, 3.0]]
+        points1, points2, valid = CadIntersection.CircleLineIntersectionBatch(segments, (0.0, 1.0), 1.0)
+        self.assertEqual(list(valid), [False, False])
+        for x1, y1, x2, y2 in segments:
+            self.assertEqual(CadIntersection.CircleLineIntersection(QgsPoint(x1, y1), QgsPoint(x2, y2), QgsPoint(0.0, 1.0), 1.0), (None, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ CadInput
+                                 A QGIS plugin
+ Provides CAD-like input globally : digitize features with precise numerical input for the angle, the distance, and easily make constructions lines
+                              -------------------
+        begin                : 2014-01-15
+        copyright            : (C) 2014 by Olivier Dalang
+        email                : olivier.dalang@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Checks the traverses' closure adjustments and the quadrant bearings (doesn't need QGIS).
+
+ Usage : python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+# the plugin's modules are imported from the plugin's directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CadConstraintEngine import bearingToAngle
+from CadTraverse import CadTraverse, parseTraverse, BOWDITCH, TRANSIT, NONE
+
+# a 100 x 100 square whose last leg is 1 too short, so the misclosure is (0, 1)
+SQUARE = """x=0 y=0
+b=N90E d=100
+az=0 d=100
+a=180 d=100
+ra=90 d=99
+close"""
+
+
+class TestCadTraverse(unittest.TestCase):
+
+    def assertVertices(self, vertices, expected):
+        xs, ys = vertices
+        self.assertEqual(len(xs), len(expected))
+        for x, y, (ex, ey) in zip(xs, ys, expected):
+            self.assertAlmostEqual(x, ex)
+            self.assertAlmostEqual(y, ey)
+
+    def test_parse(self):
+        items = list(parseTraverse(SQUARE.splitlines()))
+        self.assertEqual(items[0], ('point', 0.0, 0.0))
+        self.assertEqual([item[2] for item in items[1:-1]], [False, False, False, True])
+        self.assertEqual(items[-1], ('close',))
+        with self.assertRaises(ValueError):
+            list(parseTraverse(["x=0 y=0", "a=10 b=N10E d=5"]))
+
+    def test_misclosure(self):
+        traverse = CadTraverse(parseTraverse(SQUARE.splitlines()))
+        ex, ey = traverse.misclosure()
+        self.assertAlmostEqual(ex, 0.0)
+        self.assertAlmostEqual(ey, 1.0)
+
+    def test_bowditch(self):
+        # the misclosure is distributed in proportion to the length along the traverse (399)
+        traverse = CadTraverse(parseTraverse(SQUARE.splitlines()))
+        self.assertVertices(traverse.vertices(BOWDITCH),
+                            [(0, 0), (100, -100/399.0), (100, 100 - 200/399.0), (0, 100 - 300/399.0), (0, 0)])
+
+    def test_transit(self):
+        # the misclosure in y is distributed in proportion to the |dy| along the traverse (199)
+        traverse = CadTraverse(parseTraverse(SQUARE.splitlines()))
+        self.assertVertices(traverse.vertices(TRANSIT),
+                            [(0, 0), (100, 0), (100, 100 - 100/199.0), (0, 100 - 100/199.0), (0, 0)])
+
+    def test_noAdjustment(self):
+        traverse = CadTraverse(parseTraverse(SQUARE.splitlines()))
+        self.assertVertices(traverse.vertices(NONE), [(0, 0), (100, 0), (100, 100), (0, 100), (0, 1)])
+
+    def test_bearings(self):
+        self.assertAlmostEqual(bearingToAngle("N45E"), 45.0)
+        self.assertAlmostEqual(bearingToAngle("S12.5W"), 257.5)
+        self.assertAlmostEqual(bearingToAngle("s30e"), 300.0)
+        self.assertAlmostEqual(bearingToAngle("N45-30-15W"), 90.0 + 45.0 + 30/60.0 + 15/3600.0)
+        for text in ("N45", "E45N", "N45-E", "45"):
+            self.assertIsNone(bearingToAngle(text))
+
+
+if __name__ == "__main__":
+    unittest.main()
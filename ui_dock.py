@@ -134,8 +134,35 @@ class Ui_CadInputDock(object):
         self.widD.setObjectName(_fromUtf8("widD"))
         self.gridLayout_2.addWidget(self.widD, 0, 2, 1, 1)
         self.gridLayout.addLayout(self.gridLayout_2, 1, 0, 1, 1)
+        self.widStatus = QtGui.QLabel(self.dockWidgetContents)
+        self.widStatus.setText(_fromUtf8(""))
+        self.widStatus.setWordWrap(True)
+        self.widStatus.setObjectName(_fromUtf8("widStatus"))
+        self.gridLayout.addWidget(self.widStatus, 2, 0, 1, 1)
+        self.widStats = QtGui.QGroupBox(self.dockWidgetContents)
+        self.widStats.setObjectName(_fromUtf8("widStats"))
+        self.verticalLayout = QtGui.QVBoxLayout(self.widStats)
+        self.verticalLayout.setObjectName(_fromUtf8("verticalLayout"))
+        self.widStatsText = QtGui.QLabel(self.widStats)
+        self.widStatsText.setText(_fromUtf8(""))
+        self.widStatsText.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
+        self.widStatsText.setObjectName(_fromUtf8("widStatsText"))
+        self.verticalLayout.addWidget(self.widStatsText)
+        self.horizontalLayout_2 = QtGui.QHBoxLayout()
+        self.horizontalLayout_2.setObjectName(_fromUtf8("horizontalLayout_2"))
+        self.widStatsLog = QtGui.QPushButton(self.widStats)
+        self.widStatsLog.setObjectName(_fromUtf8("widStatsLog"))
+        self.horizontalLayout_2.addWidget(self.widStatsLog)
+        self.widStatsCsv = QtGui.QPushButton(self.widStats)
+        self.widStatsCsv.setObjectName(_fromUtf8("widStatsCsv"))
+        self.horizontalLayout_2.addWidget(self.widStatsCsv)
+        self.widStatsReset = QtGui.QPushButton(self.widStats)
+        self.widStatsReset.setObjectName(_fromUtf8("widStatsReset"))
+        self.horizontalLayout_2.addWidget(self.widStatsReset)
+        self.verticalLayout.addLayout(self.horizontalLayout_2)
+        self.gridLayout.addWidget(self.widStats, 3, 0, 1, 1)
         spacerItem1 = QtGui.QSpacerItem(20, 40, QtGui.QSizePolicy.Minimum, QtGui.QSizePolicy.Expanding)
-        self.gridLayout.addItem(spacerItem1, 2, 0, 1, 1)
+        self.gridLayout.addItem(spacerItem1, 4, 0, 1, 1)
         CadInputDock.setWidget(self.dockWidgetContents)
         self.enableAction = QtGui.QAction(CadInputDock)
         self.enableAction.setCheckable(True)
@@ -166,6 +193,12 @@ class Ui_CadInputDock(object):
         self.label_3.setText(_translate("CadInputDock", "x", None))
         self.label_4.setText(_translate("CadInputDock", "y", None))
         self.label.setText(_translate("CadInputDock", "d", None))
+        self.widStats.setTitle(_translate("CadInputDock", "Timings (ms)", None))
+        self.widStatsLog.setToolTip(_translate("CadInputDock", "Write the timings to the QGIS message log", None))
+        self.widStatsLog.setText(_translate("CadInputDock", "Log", None))
+        self.widStatsCsv.setToolTip(_translate("CadInputDock", "Save the timings to a CSV file", None))
+        self.widStatsCsv.setText(_translate("CadInputDock", "CSV...", None))
+        self.widStatsReset.setText(_translate("CadInputDock", "Reset", None))
         self.enableAction.setText(_translate("CadInputDock", "Enable CAD input", None))
 
 import resources_rc